@@ -0,0 +1,690 @@
+#!/usr/bin/python3
+import sys
+import os
+import argparse
+import random
+import tempfile
+import time
+import tracemalloc
+import shutil
+import io
+import itertools
+import collections
+import json
+import platform
+import subprocess
+import fit
+
+def legacy_unescape_ver1(s):
+  rv = ''
+  last = ''
+  for c in s:
+    if last != '\\':
+      if c != '\\':
+        rv += c
+      last = c
+    else:
+      if c == 's':
+        rv += ';'
+      elif c == 'n':
+        rv += '\n'
+      else:
+        rv += c
+      last = ''
+  return rv
+
+def legacy_escape_ver1(s):
+  rv = ''
+  for c in s:
+    if c == ';':
+      rv += '\\s'
+    elif c == '\n':
+      rv += '\\n'
+    elif c == '\\':
+      rv += '\\\\'
+    else:
+      rv += c
+  return rv
+
+def legacy_escape(s, chars):
+  charmap = {'\n': 'n', '\r': 'r', '\t': 't'}
+  rv = ''
+  for c in s:
+    if c == '\\':
+      rv += '\\\\'
+    elif c in chars:
+      rv += '\\'
+      rv += charmap[c] if c in charmap else c
+    else:
+      rv += c
+  return rv
+
+def legacy_unescape(s, chars):
+  charmap = {'n': '\n', 'r': '\r', 't': '\t'}
+  rv = ''
+  last = ''
+  for c in s:
+    if last != '\\':
+      if c != '\\':
+        rv += c
+      last = c
+    else:
+      tstc = charmap[c] if c in charmap else c
+      if tstc in chars:
+        rv += tstc
+      else:
+        rv += '\\'
+        rv += c
+      last = ''
+  return rv
+
+class LegacyVer2Reader(object):
+  # the Version=2 entry reader as it was before the single-pass parser
+  def read_entries(self, datafile):
+    rows = []
+    while True:
+      row = self._read_row(datafile)
+      if row == []:
+        break
+      row.append(len(rows))
+      rows.append(row)
+    return rows
+  def _read_row(self, datafile):
+    values = []
+    rawvalues = ''
+    while True:
+      line = datafile.readline()
+      if len(line) == 0:
+        return []
+      line = line.strip()
+      if line == '----' or (len(rawvalues) == 0 and len(line) == 0):
+        break
+      elif len(line) > 0:
+        if line[-1] == '\"':
+          rawvalues += line.strip('\"')
+          values.append(legacy_unescape(rawvalues, '\"'))
+          rawvalues = ''
+        elif line[0] == '\"':
+          rawvalues += line[1:]
+          rawvalues += '\n'
+        else:
+          rawvalues += line
+          rawvalues += '\n'
+      else:
+          rawvalues += '\n'
+    return values
+
+def gen_text(rnd, words, nwords):
+  return ' '.join(rnd.choice(words) for i in range(nwords))
+
+def gen_vocabulary(size, seed = 1):
+  # made up words, repeated roughly along Zipf's law so a few are everywhere and most are rare
+  rnd = random.Random(seed)
+  letters = 'abcdefghijklmnopqrstuvwxyz'
+  vocabulary = [''.join(rnd.choice(letters) for i in range(rnd.randint(3, 9))) for j in range(size)]
+  return [w for rank, w in enumerate(vocabulary) for i in range(max(1, size // (10 * (rank + 1))))]
+
+def gen_db(filename, entries, seed = 1, words = None, comments = 0, wikis = 0, wiki_size = 20, statuses = None):
+  # entries rows of random type, each Todo and Bug followed by 0 to 2 * comments comments on it,
+  # then wikis wiki pages of about wiki_size paragraphs. same arguments, same file
+  rnd = random.Random(seed)
+  if words == None:
+    words = ['issue', 'fix', 'the', 'kanban', 'board', 'wiki', 'page', '\\"quoted\\"', 'markdown', 'server', 'C:\\\\temp']
+  status = statuses if statuses != None else ['Backlog', 'WIP', 'Done']
+  colors = ['#FF7777', '#77AAFF', '#77FF77']
+  ids = iter("{:08X}".format(i) for i in itertools.count())
+  def write_entry(values):
+    datafile.write("\"{}\"\n----\n".format('\"\n\"'.join(values)))
+  with open(filename, 'w', newline = '\n') as datafile:
+    datafile.write("Version=2\n[Config]\nStatus.Default={};\nType.Default=Todo;\nType=Todo;Comment;Bug;Wiki;\n"
+                   "Status={};\nStatus.Color={};\nType.Color=Green;Green;Red;Grey;\n"
+                   "Fields=Id;Type;Title;Description;Created;Modified;Parent;Status;\n[Entries]\n".format(
+                   status[0], ';'.join(status), ';'.join(colors[i % len(colors)] for i in range(len(status)))))
+    for i in range(entries):
+      desc = '\n'.join(gen_text(rnd, words, rnd.randint(5, 20)) for l in range(rnd.randint(1, 6)))
+      values = [next(ids), rnd.choice(['Todo', 'Bug', 'Comment']), gen_text(rnd, words, 5), desc,
+                '2020-01-01 10:00:00', '2020-01-01 10:00:00', 'none', rnd.choice(status)]
+      write_entry(values)
+      if comments > 0 and values[1] != 'Comment':
+        for c in range(rnd.randint(0, 2 * comments)):
+          write_entry([next(ids), 'Comment', '', gen_text(rnd, words, rnd.randint(5, 30)),
+                       '2020-01-02 10:00:00', '2020-01-02 10:00:00', values[0], status[0]])
+    for i in range(wikis):
+      desc = '\n\n'.join("# {}\n{}".format(gen_text(rnd, words, 3), gen_text(rnd, words, rnd.randint(10, 60)))
+                          for p in range(max(1, rnd.randint(wiki_size // 2, wiki_size * 3 // 2))))
+      write_entry([next(ids), 'Wiki', 'Page{}'.format(i), desc, '2020-01-03 10:00:00', '2020-01-03 10:00:00', 'none', status[0]])
+
+# what the benchmarks measured, see --json and --compare. keys end in their unit:
+# _s seconds, _rps requests per second, _mb megabytes
+results = collections.OrderedDict()
+
+def record(name, value):
+  results[name] = value
+
+def timed(f, *args):
+  start = time.perf_counter()
+  rv = f(*args)
+  return time.perf_counter() - start, rv
+
+def read_with(reader, filename):
+  with open(filename, 'r') as datafile:
+    while datafile.readline().strip() != '[Entries]':
+      pass
+    return reader(datafile)
+
+def bench_parse(filename):
+  t_old, old = timed(read_with, LegacyVer2Reader().read_entries, filename)
+  t_new, new = timed(read_with, fit.FlyEntrySerializerVer2()._read_entries, filename)
+  def scan():
+    n = 0
+    with fit.FlyDbStream(filename) as stream:
+      for row in stream:
+        n += 1
+    return n
+  t_iter, n = timed(scan)
+  record('parse.legacy_s', t_old)
+  record('parse.single_pass_s', t_new)
+  record('parse.streaming_scan_s', t_iter)
+  print("parse: {} entries, legacy {:.3f}s, single-pass {:.3f}s ({:.1f}x), streaming scan {:.3f}s".format(
+        len(new), t_old, t_new, t_old / t_new, t_iter))
+  # the legacy reader doubled backslashes and lost quotes at the end of lines, only the
+  # entries it finds are compared. a wiki page with a paragraph ending in a quote throws
+  # it off for good, gen_db writes them last and they are left out
+  issues = [r[0] for r in new if r[1] != 'Wiki']
+  if [r[0] for r in old[:len(issues)]] != issues or n != len(new):
+    print("parse: MISMATCH between legacy and single-pass reader")
+    return False
+  return True
+
+def bench_rows(filename):
+  # list rows plus a dict per read, as FlyDb kept them before FlyRow
+  with fit.FlyDbStream(filename) as stream:
+    fields = stream.cfg['Fields']
+    values = list(stream)
+  def build_lists():
+    return [v + [i] for i, v in enumerate(values)]
+  def build_rows():
+    cls = fit.row_class(fields)
+    return [cls(v) for v in values]
+  sizes = []
+  for build in (build_lists, build_rows):
+    tracemalloc.start()
+    rows = build()
+    sizes.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+    del rows
+  record('rows.list_layout_mb', sizes[0] / 1e6)
+  record('rows.flyrow_mb', sizes[1] / 1e6)
+  print("rows: {} rows, list layout {:.1f}MB, FlyRow {:.1f}MB (strings excluded)".format(
+        len(values), sizes[0] / 1e6, sizes[1] / 1e6))
+  db = fit.FlyDb(filename)
+  lists = build_lists()
+  def old_as_dict():
+    return [{f: r[i] for i, f in enumerate(fields)} for r in lists if r[7].lower() == 'wip']
+  t_old, old = timed(old_as_dict)
+  t_new, new = timed(db.get_rows_as_dict, None, None, None, 'WIP')
+  record('rows.as_dict_wip_s', t_new)
+  print("rows: get_rows_as_dict(status='WIP') {} rows, dict copies {:.3f}s, views {:.3f}s".format(len(new), t_old, t_new))
+  return len(old) == len(new) and all(dict(a) == dict(b.items()) for a, b in zip(old, new))
+
+def codec_pairs():
+  return [('_escape', legacy_escape_ver1, fit._escape), ('_unescape', legacy_unescape_ver1, fit._unescape)] + \
+         [('escape({!r})'.format(chars), lambda s, c = chars: legacy_escape(s, c), lambda s, c = chars: fit.escape(s, c))
+          for chars in ['\"', ';\n', '\"\n\r\t\\']] + \
+         [('unescape({!r})'.format(chars), lambda s, c = chars: legacy_unescape(s, c), lambda s, c = chars: fit.unescape(s, c))
+          for chars in ['\"', ';\n', '\"\n\r\t\\', 'n']]
+
+def check_codecs(samples = 20000, seed = 1):
+  # adversarial inputs: trailing backslashes, quotes, \s, CRLF
+  rnd = random.Random(seed)
+  alphabet = ['\\', '\"', ';', 's', 'n', 'r', 't', '\n', '\r', '\r\n', 'a', ' ']
+  inputs = ['', '\\', '\\\\', 'a\\', '\\"', '\"\\', '\\s', 'x\r\ny\\']
+  inputs.extend(''.join(rnd.choice(alphabet) for i in range(rnd.randint(0, 12))) for j in range(samples))
+  ok = True
+  for name, old, new in codec_pairs():
+    for s in inputs:
+      if old(s) != new(s):
+        print("codecs: MISMATCH in {} for {!r}: {!r} != {!r}".format(name, s, old(s), new(s)))
+        ok = False
+        break
+  for s in inputs:
+    if fit._unescape(fit._escape(s)) != s:
+      print("codecs: Version=1 round trip failed for {!r}".format(s))
+      ok = False
+      break
+  return ok
+
+def bench_codecs(size = 4 << 20, seed = 1):
+  rnd = random.Random(seed)
+  text = ''.join(rnd.choice(['word ', 'line\n', '"q" ', 'a\\b ', 'semi; ', '\\"x\\" ']) for i in range(size // 6))
+  for name, old, new in codec_pairs():
+    t_old, a = timed(old, text)
+    t_new, b = timed(new, text)
+    record('codecs.{}_s'.format(name), t_new)
+    print("codecs: {:>26} on {:.1f}MB legacy {:.3f}s, new {:.4f}s ({:.0f}x)".format(
+          name, len(text) / 1e6, t_old, t_new, t_old / max(t_new, 1e-9)))
+
+def wsgi_iter(srv, path):
+  path, _, query = path.partition('?')
+  environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query}
+  return srv._serve(environ, lambda status, headers, exc_info = None: None)
+
+def wsgi_get(srv, path):
+  return b''.join(wsgi_iter(srv, path))
+
+def wsgi_post(srv, path, body):
+  environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': path, 'QUERY_STRING': '',
+             'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+  return b''.join(srv._serve(environ, lambda status, headers, exc_info = None: None))
+
+def bench_ops(filename, repeat = 1000, seed = 1):
+  # the FlyDb calls behind the views, on a copy so the moves don't change the file
+  copy = filename + '.ops'
+  shutil.copy(filename, copy)
+  t_load, db = timed(fit.FlyDb, copy)
+  t_save = timed(db.write_db)[0]
+  rnd = random.Random(seed)
+  ids = [r['Id'] for r in db.rows]
+  issues = [r['Id'] for r in db.get_rows(type = ['todo', 'bug'])]
+  status = db.get_config('Status')
+  queries = [('status', lambda: db.get_rows_as_dict(status = rnd.choice(status))),
+             ('type', lambda: db.get_rows_as_dict(type = 'todo')),
+             ('parent', lambda: db.get_rows_as_dict(type = ['comment'], parent = rnd.choice(issues))),
+             ('id', lambda: db.get_rows_as_dict(id = rnd.choice(ids))),
+             ('list_page', lambda: list(itertools.islice(db.iter_rows(type = 'todo'), 100)))]
+  print("ops: {} rows, load {:.3f}s, save {:.3f}s".format(db.count, t_load, t_save))
+  record('ops.load_s', t_load)
+  record('ops.save_s', t_save)
+  for name, query in queries:
+    n = repeat if name in ('parent', 'id', 'list_page') else 10
+    t = timed(lambda: [query() for i in range(n)])[0] / n
+    record('ops.query_{}_s'.format(name), t)
+    print("ops: {:>10} query {:.3f}ms".format(name, t * 1000))
+  def moves():
+    for i in range(repeat):
+      db.place_before(rnd.choice(ids), rnd.choice(ids))
+  def status_changes():
+    for i in range(repeat):
+      db.change_row(rnd.choice(ids), rnd.choice(status))
+  for name, f in (('move', moves), ('status', status_changes)):
+    t = timed(f)[0] / repeat
+    record('ops.{}_s'.format(name), t)
+    print("ops: {:>10} {:.1f}us".format(name, t * 1e6))
+  t_rows = timed(lambda: db.rows)[0]
+  record('ops.rows_after_moves_s', t_rows)
+  print("ops: rows list rebuilt after moves {:.3f}s".format(t_rows))
+
+def bench_wsgi(filename, duration = 1, seed = 1):
+  # endpoint throughput through the WSGI app without sockets. writes are held back for the
+  # run (write_delay) so moves measure the request and not rewriting the file
+  copy = filename + '.wsgi'
+  shutil.copy(filename, copy)
+  srv = fit.FlyServer(copy, 0, write_delay = 3600)
+  rnd = random.Random(seed)
+  try:
+    ids = [r['Id'] for r in srv.db.get_rows(type = ['todo', 'bug'])]
+    status = srv.db.get_config('Status')
+    issue = ids[0]
+    endpoints = [('/kanban', lambda: wsgi_get(srv, '/kanban')),
+                 ('/api/board', lambda: wsgi_get(srv, '/api/board')),
+                 ('/api/status', lambda: wsgi_get(srv, '/api/status/' + rnd.choice(status))),
+                 ('/api/issue', lambda: wsgi_get(srv, '/api/issue/' + rnd.choice(ids))),
+                 ('/list/issue', lambda: wsgi_get(srv, '/list/' + rnd.choice(ids))),
+                 ('/list?page', lambda: wsgi_get(srv, '/list?page={}'.format(rnd.randint(1, 10)))),
+                 ('/wiki', lambda: wsgi_get(srv, '/wiki?page=1')),
+                 ('/api/search', lambda: wsgi_get(srv, '/api/search?q=kanban+board')),
+                 ('/api/move', lambda: wsgi_get(srv, '/api/move/{}/{}/{}'.format(rnd.choice(ids), rnd.choice(status), rnd.choice(ids)))),
+                 ('/api/add', lambda: wsgi_post(srv, '/api/add', 'Id={}&Title=renamed'.format(rnd.choice(ids)).encode('utf-8'))),
+                 ('/api/md', lambda: wsgi_post(srv, '/api/md', "# Page\n\nSome *text* {}\n".format(rnd.random()).encode('utf-8')))]
+    for name, request in endpoints:
+      n = 0
+      start = time.perf_counter()
+      deadline = start + duration
+      while time.perf_counter() < deadline:
+        request()
+        n += 1
+      rps = n / (time.perf_counter() - start)
+      record('wsgi.{}_rps'.format(name), rps)
+      print("wsgi: {:>12} {:>8.0f} req/s".format(name, rps))
+  finally:
+    srv.close()
+
+def bench_views(filename, repeat = 5):
+  srv = fit.FlyServer(filename, 0)
+  try:
+    issue = srv.db.get_rows_as_dict(type = 'todo')[0]['Id']
+    paths = ['/kanban', '/list', '/list/' + issue, '/api/issue/' + issue, '/api/status/WIP', '/api/board', '/wiki']
+    for path in paths:
+      # first render fills the markdown cache
+      size = len(wsgi_get(srv, path))
+      def warm():
+        for i in range(repeat):
+          wsgi_get(srv, path)
+      def cold():
+        for i in range(repeat):
+          srv.fragments_cfg = None
+          wsgi_get(srv, path)
+      t_warm = timed(warm)[0] / repeat
+      t_cold = timed(cold)[0] / repeat
+      record('views.{}.warm_s'.format(path), t_warm)
+      record('views.{}.cold_s'.format(path), t_cold)
+      print("views: {:>22} {:.0f}KB, {:.2f}ms, {:.2f}ms with fragments rebuilt".format(
+            path, size / 1e3, t_warm * 1000, t_cold * 1000))
+  finally:
+    srv.close()
+
+def bench_stream(filename):
+  # time to the first chunk and the most memory held while the response is sent
+  srv = fit.FlyServer(filename, 0)
+  try:
+    for path in ['/list', '/list?page=10&per_page=100', '/wiki']:
+      tracemalloc.start()
+      start = time.perf_counter()
+      chunks = 0
+      size = 0
+      first = None
+      for chunk in wsgi_iter(srv, path):
+        if first == None:
+          first = time.perf_counter() - start
+        chunks += 1
+        size += len(chunk)
+      total = time.perf_counter() - start
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      record('stream.{}.first_chunk_s'.format(path), first)
+      record('stream.{}.all_s'.format(path), total)
+      record('stream.{}.peak_mb'.format(path), peak / 1e6)
+      print("stream: {:>28} {:.0f}KB in {} chunks, first chunk {:.2f}ms, all {:.2f}ms, peak {:.1f}MB".format(
+            path, size / 1e3, chunks, first * 1000, total * 1000, peak / 1e6))
+  finally:
+    srv.close()
+
+def bench_metrics(filename, requests = 20000):
+  # what timing every request costs on the cheapest route there is
+  for metrics in (False, True):
+    srv = fit.FlyServer(filename, 0, metrics = metrics)
+    try:
+      def run():
+        for i in range(requests):
+          wsgi_get(srv, '/api/version')
+      t = timed(run)[0]
+      record('metrics.{}.request_s'.format('on' if metrics else 'off'), t / requests)
+      print("metrics: {:>5}, {:.2f}us per /api/version".format(str(metrics), t / requests * 1e6))
+    finally:
+      srv.close()
+
+def bench_sync(filename):
+  # an outside edit of one entry, picked up by diffing against reloading everything
+  copy = filename + '.sync'
+  shutil.copy(filename, copy)
+  db = fit.FlyDb(copy)
+  with open(copy, 'r') as datafile:
+    text = datafile.read()
+  first = db.rows[0]
+  with open(copy, 'w', newline = '\n') as datafile:
+    datafile.write(text.replace("\"{}\"".format(fit.escape(first['Title'], '\"')), "\"edited by hand\"", 1))
+  t_sync, changed = timed(db.sync)
+  t_reload, ok = timed(db.reload_db)
+  record('sync.diff_s', t_sync)
+  record('sync.reload_s', t_reload)
+  print("sync: one entry edited outside, diff {:.3f}s, reload_db {:.3f}s".format(t_sync, t_reload))
+  return changed and ok and db.rows[0]['Title'] == 'edited by hand'
+
+def bench_write(filename, moves = 20):
+  # a burst of moves as the board sends them, written each time against written once
+  copy = filename + '.write'
+  shutil.copy(filename, copy)
+  for delay in (0, 0.05):
+    db = fit.FlyDb(copy, write_delay = delay)
+    ids = [r['Id'] for r in db.get_rows(status = 'WIP')[:moves + 1]]
+    def burst():
+      for i in range(moves):
+        db.place_before(ids[i], ids[i + 1])
+        db.flush()
+    t_burst = timed(burst)[0]
+    t_close = timed(db.close)[0]
+    record('write.burst_delay_{}.request_path_s'.format(delay), t_burst)
+    record('write.burst_delay_{}.close_s'.format(delay), t_close)
+    print("write: {} moves with write_delay {}, {:.3f}s on the request path, {:.3f}s at close".format(
+          moves, delay, t_burst, t_close))
+  t_write = timed(db.write_db)[0]
+  record('write.write_db_s', t_write)
+  print("write: write_db of {} entries {:.3f}s".format(db.count, t_write))
+
+def bench_search(entries, tmp):
+  filename = os.path.join(tmp, 'search.txt')
+  words = gen_vocabulary(20000)
+  gen_db(filename, entries, words = words)
+  t_plain = timed(fit.FlyDb, filename)[0]
+  t_build, db = timed(lambda: fit.FlyDb(filename, search = True, search_cache = True))
+  t_cached, cached = timed(lambda: fit.FlyDb(filename, search = True, search_cache = True))
+  record('search.load_s', t_plain)
+  record('search.load_building_index_s', t_build)
+  record('search.load_from_cache_s', t_cached)
+  print("search: {} entries, {} terms, load {:.3f}s, with index built {:.3f}s, from cache {:.3f}s".format(
+        entries, len(db.text_index.postings), t_plain, t_build, t_cached))
+  common, rare = words[0], words[-1]
+  queries = [(common, {}), (rare, {}), (common[:2] + '*', {}), ('{} {}'.format(common, words[len(words) // 2]), {}),
+             (common, {'type': 'bug', 'status': 'WIP'}), (rare[:3] + '* ' + common, {'type': ['todo', 'bug']})]
+  ok = True
+  for n, (q, filters) in enumerate(queries):
+    t, (total, found) = timed(lambda: db.search(q, limit = 20, **filters))
+    t_run = min(timed(lambda: db.search(q, limit = 20, **filters))[0] for i in range(5))
+    record('search.query{}_s'.format(n), t_run)
+    print("search: {:>24} {:>28} {:>6} matches, {:.2f}ms".format(q, str(filters) if filters else '', total, t_run * 1000))
+    again = cached.search(q, limit = 20, **filters)
+    ok = ok and total == again[0] and [r['Id'] for s, r in found] == [r['Id'] for s, r in again[1]]
+  if not ok:
+    print("search: MISMATCH between built and cached index")
+  return ok
+
+def bench_shard(entries, tmp, comments):
+  # the same database split into shard files, start up, open an issue and change its status
+  filename = os.path.join(tmp, 'shard.txt')
+  gen_db(filename, entries, words = gen_vocabulary(2000), comments = max(comments, 2))
+  t_load, db = timed(fit.FlyDb, filename)
+  issue = db.get_rows(type = 'todo')[len(db.get_rows(type = 'todo')) // 2]['Id']
+  def change(db):
+    db.get_rows(id = issue)
+    db.get_rows(type = 'comment', parent = issue)
+    db.change_row(issue, 'Done')
+    db.flush()
+  t_change = timed(change, db)[0]
+  record('shard.none.load_s', t_load)
+  record('shard.none.open_and_change_s', t_change)
+  print("shard: single file, load {:.3f}s, open an issue and change it {:.3f}s".format(t_load, t_change))
+  expected = [r.values() for r in db.rows]
+  ok = True
+  for sharding in ('type', 'parent', 'hash:64'):
+    copy = os.path.join(tmp, 'shard-{}.txt'.format(sharding.replace(':', '')))
+    shutil.copy(filename, copy)
+    t_split = timed(fit.FlyDb(copy).reshard, sharding)[0]
+    t_load, db = timed(fit.FlyDb, copy)
+    t_change = timed(change, db)[0]
+    total = len(set(db.shards) | db.unloaded)
+    record('shard.{}.split_s'.format(sharding), t_split)
+    record('shard.{}.load_s'.format(sharding), t_load)
+    record('shard.{}.open_and_change_s'.format(sharding), t_change)
+    print("shard: by {}, split {:.3f}s, load {:.3f}s, open an issue and change it {:.3f}s reading {} of {} shards".format(
+          sharding, t_split, t_load, t_change, total - len(db.unloaded), total))
+    if [r.values() for r in fit.FlyDb(copy).rows] != expected:
+      print("shard: by {}, rows differ from the single file".format(sharding))
+      ok = False
+  return ok
+
+def bench_lazy(entries, tmp, wikis, wiki_size):
+  # descriptions left in the file until read, on a database where they are most of it
+  filename = os.path.join(tmp, 'lazy.txt')
+  gen_db(filename, entries, words = gen_vocabulary(5000), comments = 1, wikis = max(wikis, entries // 10),
+         wiki_size = max(wiki_size, 50))
+  dbs = []
+  for lazy in (False, True):
+    t_load = min(timed(lambda: fit.FlyDb(filename, lazy = lazy))[0] for i in range(3))
+    tracemalloc.start()
+    db = fit.FlyDb(filename, lazy = lazy)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    t_read = timed(lambda: [r['Description'] for r in db.get_rows(type = 'wiki')])[0]
+    name = 'lazy' if lazy else 'eager'
+    record('lazy.{}.load_s'.format(name), t_load)
+    record('lazy.{}.rows_mb'.format(name), size / 1e6)
+    record('lazy.{}.read_wiki_s'.format(name), t_read)
+    print("lazy: {} of {:.0f}MB, load {:.3f}s, {:.1f}MB in memory, reading every wiki page {:.3f}s".format(
+          name, os.path.getsize(filename) / 1e6, t_load, size / 1e6, t_read))
+    dbs.append(db)
+  if [r.values() for r in dbs[0].rows] != [r.values() for r in dbs[1].rows]:
+    print("lazy: MISMATCH between eager and lazy rows")
+    return False
+  return True
+
+def bench_batch(filename, single = 10, ops = 1000):
+  # status changes one /api/move at a time, each writing the database, against one /api/batch
+  copy = filename + '.batch'
+  shutil.copy(filename, copy)
+  srv = fit.FlyServer(copy, 0, watch_interval = 0)
+  ids = [r['Id'] for r in srv.db.get_rows(type = 'todo')[:ops]]
+  def moves():
+    for id in ids[:single]:
+      wsgi_get(srv, '/api/move/{}/Done'.format(id))
+  t_single = timed(moves)[0] / single
+  body = ''.join(json.dumps({'op': 'move', 'Id': id, 'Status': 'WIP'}) + '\n' for id in ids).encode('utf-8')
+  t_batch, reply = timed(wsgi_post, srv, '/api/batch', body)
+  t_export, exported = timed(wsgi_get, srv, '/api/export')
+  srv.close()
+  record('batch.move_each_s', t_single)
+  record('batch.batch_of_{}_s'.format(len(ids)), t_batch)
+  record('batch.export_s', t_export)
+  print("batch: /api/move {:.3f}s per op, /api/batch of {} ops {:.3f}s ({:.5f}s per op), /api/export {:.1f}MB in {:.3f}s".format(
+        t_single, len(ids), t_batch, t_batch / len(ids), len(exported) / 1e6, t_export))
+  db = fit.FlyDb(copy)
+  return json.loads(reply.decode('utf-8')).get('applied') == len(ids) and all(db.rowmap[id]['Status'] == 'WIP' for id in ids)
+
+def bench_snapshot(filename):
+  # starting from the text file, the same start writing the snapshot and one reading it
+  copy = filename + '.snap'
+  shutil.copy(filename, copy)
+  t_text, text = timed(fit.FlyDb, copy)
+  t_save = timed(lambda: fit.FlyDb(copy, snapshot = True))[0]
+  t_load, db = timed(lambda: fit.FlyDb(copy, snapshot = True))
+  record('snapshot.text_load_s', t_text)
+  record('snapshot.load_and_save_s', t_save)
+  record('snapshot.load_s', t_load)
+  print("snapshot: load {:.3f}s from text, {:.3f}s writing the snapshot, {:.3f}s from the snapshot ({:.1f}x)".format(
+        t_text, t_save, t_load, t_text / t_load))
+  if [r.values() for r in text.rows] != [r.values() for r in db.rows] or text.cfg != db.cfg:
+    print("snapshot: MISMATCH between text and snapshot")
+    return False
+  return True
+
+def bench_convert(filename):
+  # the database to version 1 and back, entry by entry and each checked against its source
+  v1 = filename + '.v1'
+  v2 = filename + '.v2'
+  size = os.path.getsize(filename)
+  try:
+    n, t_v1, t_check = fit.convert_db(filename, v1, '1')
+    n, t_v2, t_check2 = fit.convert_db(v1, v2, '2')
+    fit._check_conversion(filename, v2, '2')
+  except ValueError as e:
+    print("convert: MISMATCH {}".format(e))
+    return False
+  tracemalloc.start()
+  fit.convert_db(filename, v1, '1', check = False)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  record('convert.to_v1_s', t_v1)
+  record('convert.check_v1_s', t_check)
+  record('convert.to_v2_s', t_v2)
+  record('convert.peak_mb', peak / 1e6)
+  print("convert: {} entries of {:.0f}MB, to version 1 {:.3f}s ({:.1f}MB/s) checked in {:.3f}s, back to 2 {:.3f}s, peak {:.1f}MB".format(
+        n, size / 1e6, t_v1, size / 1e6 / t_v1, t_check, t_v2, peak / 1e6))
+  return True
+
+suites = ['parse', 'rows', 'ops', 'views', 'stream', 'wsgi', 'metrics', 'sync', 'write', 'batch', 'search', 'snapshot', 'shard', 'lazy', 'convert', 'codecs']
+
+def git_commit():
+  try:
+    res = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+  except OSError:
+    return None
+  return res.stdout.decode('utf-8').strip() if res.returncode == 0 else None
+
+def compare(filename, threshold):
+  # times growing and rates dropping by more than threshold are flagged
+  with open(filename, 'r') as f:
+    old = json.load(f)
+  print("compare: against {} ({})".format(filename, old['meta'].get('commit')))
+  regressions = 0
+  for name, value in results.items():
+    before = old['results'].get(name)
+    if before == None or before == 0:
+      continue
+    ratio = value / before
+    worse = ratio < 1 - threshold if name.endswith('_rps') else ratio > 1 + threshold
+    regressions += worse
+    print("compare: {:>45} {:>12.6g} -> {:<12.6g} {:>6.2f}x{}".format(name, before, value, ratio, '  REGRESSION' if worse else ''))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description = 'fit benchmarks.')
+  parser.add_argument('-n', '--entries', type = int, default = 100000, help = 'entries in the synthetic database')
+  parser.add_argument('--comments', type = int, default = 0, help = 'average comments per issue')
+  parser.add_argument('--wikis', type = int, default = 0, help = 'wiki pages')
+  parser.add_argument('--wiki-size', type = int, dest = 'wiki_size', default = 20, help = 'average paragraphs per wiki page')
+  parser.add_argument('--statuses', type = str, default = 'Backlog;WIP;Done', help = 'board columns, separated by ;')
+  parser.add_argument('--seed', type = int, default = 1, help = 'seed of the generated database')
+  parser.add_argument('-s', '--suite', action = 'append', choices = suites, help = 'run only these, can be repeated')
+  parser.add_argument('--json', type = str, help = 'write the results to this file')
+  parser.add_argument('--compare', type = str, help = 'compare with the results in this file')
+  parser.add_argument('--threshold', type = float, default = 0.1, help = 'change flagged as a regression by --compare')
+  args = parser.parse_args()
+  run = args.suite if args.suite != None else suites
+  ok = True
+  with tempfile.TemporaryDirectory() as tmp:
+    filename = os.path.join(tmp, 'todo.txt')
+    gen_db(filename, args.entries, seed = args.seed, comments = args.comments, wikis = args.wikis,
+           wiki_size = args.wiki_size, statuses = args.statuses.split(';'))
+    if 'parse' in run:
+      ok = bench_parse(filename) and ok
+    if 'rows' in run:
+      ok = bench_rows(filename) and ok
+    if 'ops' in run:
+      bench_ops(filename)
+    if 'views' in run:
+      bench_views(filename)
+    if 'stream' in run:
+      bench_stream(filename)
+    if 'wsgi' in run:
+      bench_wsgi(filename)
+    if 'metrics' in run:
+      bench_metrics(filename)
+    if 'sync' in run:
+      ok = bench_sync(filename) and ok
+    if 'write' in run:
+      bench_write(filename)
+    if 'batch' in run:
+      ok = bench_batch(filename) and ok
+    if 'search' in run:
+      ok = bench_search(args.entries, tmp) and ok
+    if 'snapshot' in run:
+      ok = bench_snapshot(filename) and ok
+    if 'shard' in run:
+      ok = bench_shard(args.entries, tmp, args.comments) and ok
+    if 'lazy' in run:
+      ok = bench_lazy(args.entries, tmp, args.wikis, args.wiki_size) and ok
+    if 'convert' in run:
+      ok = bench_convert(filename) and ok
+  if 'codecs' in run:
+    ok = check_codecs() and ok
+    bench_codecs()
+  if args.json != None:
+    meta = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'args': vars(args)}
+    with open(args.json, 'w') as f:
+      json.dump({'meta': meta, 'results': results}, f, indent = 1)
+  if args.compare != None:
+    compare(args.compare, args.threshold)
+  sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+  main()
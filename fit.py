@@ -3,92 +3,296 @@ import sys
 import os
 import argparse
 import datetime
+import time
 import hashlib
 import urllib
 import markdown
 import subprocess
+import threading
+import json
+import csv
+import re
+import collections
+import socket
+import gzip
+import email.utils
+import socketserver
+import string
+import itertools
+import selectors
+import bisect
+import heapq
+import marshal
+import math
+import array
+import operator
+import shutil
+import signal
+import zlib
+import mmap
+import io
+import cProfile
+import pstats
+import html
+import concurrent.futures
+import xml.etree.ElementTree
+import markdown.inlinepatterns
 from markdown.extensions.wikilinks import WikiLinkExtension
 from wsgiref import simple_server, util
 
+GitCommit = collections.namedtuple('GitCommit', ['hash', 'author', 'date', 'message'])
+
 class Git(object):
-  def __init__(self):
-    pass
+  # the log is read a page at a time and kept for the HEAD it was read from. a new HEAD
+  # that descends from the old one only reads the commits in between, pages go on from
+  # the HEAD they were first read from so the order read stays the one shown. git runs
+  # in one worker thread, readers get at the results through attributes it swaps out
+  # whole and never wait for it, what isn't read yet raises TimeoutError
+  log_format = '--format=%H%x1f%an <%ae>%x1f%ad%x1f%B%x1e'
+  def __init__(self, path = None, timeout = 10, check_interval = 5):
+    self.path = path
+    self.timeout = timeout
+    self.check_interval = check_interval
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+    self.head = None
+    self.commits = [] # newest first, commits added on top of base then the start of 'git log <base>'
+    self.base = None
+    self.paged = 0 # of commits, read from 'git log <base>'
+    self.complete = True
+    self.hashes = [] # sorted, every commit reachable from head
+    self.found = dict() # hash -> commit, single ones looked up by commit()
+    self.version = 0 # bumped when hashes changes
+    self.checked = None
+    self.checking = None
+    self.fetching = None
   def _invoke_git(self, cmd):
     inv = ['git']
     inv.extend(cmd)
-    return subprocess.run(inv, capture_output=True)
-  def log(self):
-    res = self._invoke_git(['log'])
-    return res.stdout.decode('utf-8')
+    return subprocess.run(inv, capture_output=True, timeout = self.timeout, cwd = self.path)
+  def _output(self, cmd):
+    res = self._invoke_git(cmd)
+    if res.returncode != 0:
+      raise RuntimeError(res.stderr.decode('utf-8', 'replace').strip())
+    return res.stdout.decode('utf-8', 'replace')
+  def _log(self, cmd):
+    rv = []
+    for record in self._output(['log', self.log_format] + cmd).split('\x1e'):
+      fields = record.strip('\n').split('\x1f')
+      if len(fields) == 4:
+        rv.append(GitCommit(*fields))
+    return rv
+  def _update(self):
+    self.checked = time.monotonic()
+    res = self._invoke_git(['rev-parse', '--verify', '-q', 'HEAD'])
+    head = res.stdout.decode('utf-8').strip() if res.returncode == 0 else None
+    if head == self.head:
+      return
+    old = self.head
+    if old != None and head != None and self._invoke_git(['merge-base', '--is-ancestor', old, head]).returncode == 0:
+      span = '{}..{}'.format(old, head)
+      self.commits = self._log([span]) + self.commits
+      self.hashes = sorted(self.hashes + self._output(['rev-list', span]).split())
+    else:
+      self.commits = []
+      self.base = head
+      self.paged = 0
+      self.complete = head == None
+      self.hashes = sorted(self._output(['rev-list', head]).split()) if head != None else []
+    self.head = head
+    self.version += 1
+    # the first page is there by the time it is asked for
+    self._fetch(1)
+  def _fetch(self, count):
+    # log from where the pages end, fetched in pages of at least 100
+    have = len(self.commits)
+    if self.complete or have >= count:
+      return
+    page = max(count - have, 100)
+    more = self._log(['--skip={}'.format(self.paged), '--max-count={}'.format(page), self.base])
+    self.paged += len(more)
+    self.commits = self.commits + more
+    self.complete = len(more) < page
+  def _find(self, full):
+    found = self._log(['-1', full])
+    self.found[full] = found[0] if len(found) > 0 else None
+  def refresh(self, wait = None):
+    # looks for a new HEAD at most every check_interval seconds. wait = None returns
+    # right away, otherwise waits that long for the check and raises what it raised
+    if self.checking == None or (self.checking.done() and time.monotonic() - self.checked >= self.check_interval):
+      self.checking = self.executor.submit(self._update)
+    if wait != None:
+      self.checking.result(wait)
+  def _checked(self):
+    # raises what the last check raised, or TimeoutError while the first one runs
+    self.refresh()
+    if self.checking.done():
+      self.checking.result()
+    elif self.head == None:
+      raise concurrent.futures.TimeoutError()
+  def iter_commits(self, batch = 100):
+    # the log newest first as far as it is read. the worker reads the next batch once
+    # the iteration gets near the end of that
+    self._checked()
+    n = 0
+    while True:
+      commits = self.commits
+      if n + batch > len(commits) and not self.complete and (self.fetching == None or self.fetching.done()):
+        self.fetching = self.executor.submit(self._fetch, n + 2 * batch)
+      if n >= len(commits):
+        if self.complete:
+          return
+        raise concurrent.futures.TimeoutError()
+      yield commits[n]
+      n += 1
+  def resolve(self, prefix):
+    # the full hash of the one commit starting with prefix, None if there's none or more
+    hashes = self.hashes
+    i = bisect.bisect_left(hashes, prefix)
+    if i < len(hashes) and hashes[i].startswith(prefix) and (i + 1 == len(hashes) or not hashes[i + 1].startswith(prefix)):
+      return hashes[i]
+    return None
+  def commit(self, hash):
+    self._checked()
+    full = self.resolve(hash.lower())
+    if full == None:
+      return None
+    for c in self.commits:
+      if c.hash == full:
+        return c
+    if full in self.found:
+      return self.found[full]
+    self.executor.submit(self._find, full)
+    raise concurrent.futures.TimeoutError()
+  def close(self):
+    self.executor.shutdown(wait = False)
+
+class GitHashPattern(markdown.inlinepatterns.InlineProcessor):
+  # hex words that resolve to exactly one commit link to it
+  def __init__(self, git):
+    super().__init__(r'\b([0-9a-f]{7,40})\b')
+    self.git = git
+  def handleMatch(self, m, data):
+    full = self.git.resolve(m.group(1))
+    if full == None:
+      return None, None, None
+    el = xml.etree.ElementTree.Element('a')
+    el.set('href', '/git/{}'.format(full))
+    el.text = m.group(1)
+    return el, m.start(0), m.end(0)
+
+class GitHashExtension(markdown.extensions.Extension):
+  def __init__(self, git):
+    super().__init__()
+    self.git = git
+  def extendMarkdown(self, md):
+    md.inlinePatterns.register(GitHashPattern(self.git), 'githash', 65)
+
+_escape_pair = re.compile(r'\\(.?)', re.DOTALL)
+_unescape_ver1 = {'s': ';', 'n': '\n'}
+_escape_names = {'\n': 'n', '\r': 'r', '\t': 't'}
+_unescape_names = {'n': '\n', 'r': '\r', 't': '\t'}
+_sentinels = [chr(c) for c in range(32) if chr(c) not in '\n\r\t'] + ['\ufffe', '\uffff']
+_escapers = dict()
+_unescapers = dict()
+
+def _hide_pairs(s):
+  # replaces each escaped backslash with a char that does not occur in s, after
+  # that every backslash left starts a two char escape or is a lone one at the end
+  for sentinel in _sentinels:
+    if not sentinel in s:
+      return s.replace('\\\\', sentinel), sentinel
+  return None, None
+
+def _value_end(line, quote, backslash):
+  # where a version 2 value ends if this line closes it, -1 if it doesn't. str or bytes,
+  # the closing quote is the last one on the line after an even number of backslashes
+  line = line.rstrip()
+  end = len(line) - 1
+  if line[end:] != quote:
+    return -1
+  start = end
+  while start > 0 and line[start - 1:start] == backslash:
+    start -= 1
+  return end if (end - start) % 2 == 0 else -1
+
+# the last char before the newline of a line closing a value is one of these
+_closing_chars = set(' \t\r\f\v"')
+
+def _unescape_ver1_pair(m):
+  c = m.group(1)
+  return _unescape_ver1.get(c, c)
 
 def _unescape(s):
-  rv = ''
-  last = ''
-  for c in s:
-    if last != '\\':
-      if c != '\\':
-        rv += c
-      last = c
-    else:
-      if c == 's':
-        rv += ';'
-      elif c == 'n':
-        rv += '\n'
-      else:
-        rv += c
-      last = ''
-  return rv
+  if not '\\' in s:
+    return s
+  hidden, sentinel = _hide_pairs(s)
+  if hidden == None:
+    return _escape_pair.sub(_unescape_ver1_pair, s)
+  return hidden.replace('\\s', ';').replace('\\n', '\n').replace('\\', '').replace(sentinel, '\\')
 
 def _escape(s):
-  rv = ''
-  for c in s:
-    if c == ';':
-      rv += '\\s'
-    elif c == '\n':
-      rv += '\\n'
-    elif c == '\\':
-      rv += '\\\\'
-    else:
-      rv += c
-  return rv
+  return s.replace('\\', '\\\\').replace(';', '\\s').replace('\n', '\\n')
+
+def _make_unescaper(chars):
+  # pairs that decode to one of chars, every other pair is kept as is
+  # and a lone backslash at the end is dropped
+  table = dict()
+  for c in set(chars) | set(_unescape_names):
+    tstc = _unescape_names.get(c, c)
+    if tstc in chars:
+      table[c] = tstc
+  backslash = table.pop('\\', '\\\\')
+  pairs = [('\\' + c, tstc) for c, tstc in table.items()]
+  def unescape_pair(m):
+    c = m.group(1)
+    if len(c) == 0:
+      return ''
+    if c == '\\':
+      return backslash
+    tstc = table.get(c)
+    return tstc if tstc != None else '\\' + c
+  def unescaper(s):
+    hidden, sentinel = _hide_pairs(s)
+    if hidden == None:
+      return _escape_pair.sub(unescape_pair, s)
+    if hidden[-1] == '\\':
+      hidden = hidden[:-1]
+    for pair, tstc in pairs:
+      if pair in hidden:
+        hidden = hidden.replace(pair, tstc)
+    return hidden.replace(sentinel, backslash)
+  return unescaper
+
+def _make_escaper(chars):
+  replacements = [('\\', '\\\\')] + [(c, '\\' + _escape_names.get(c, c)) for c in chars if c != '\\']
+  def escaper(s):
+    for c, rep in replacements:
+      if c in s:
+        s = s.replace(c, rep)
+    return s
+  return escaper
 
 def unescape(s, chars):
-  charmap = {'n': '\n', 'r': '\r', 't': '\t'}
-  rv = ''
-  last = ''
-  for c in s:
-    if last != '\\':
-      if c != '\\':
-        rv += c
-      last = c
-    else:
-      tstc = charmap[c] if c in charmap else c
-      if tstc in chars:
-        rv += tstc
-      else:
-        rv += '\\'
-        rv += c
-      last = ''
-  return rv
+  if not '\\' in s:
+    return s
+  unescaper = _unescapers.get(chars)
+  if unescaper == None:
+    unescaper = _unescapers[chars] = _make_unescaper(chars)
+  return unescaper(s)
 
 def escape(s, chars):
-  charmap = {'\n': 'n', '\r': 'r', '\t': 't'}
-  rv = ''
-  for c in s:
-    if c == '\\':
-      rv += '\\\\'
-    elif c in chars:
-      rv += '\\'
-      rv += charmap[c] if c in charmap else c
-    else:
-      rv += c
-  return rv
+  escaper = _escapers.get(chars)
+  if escaper == None:
+    escaper = _escapers[chars] = _make_escaper(chars)
+  return escaper(s)
 
 class FlyEntrySerializer(object):
   def read_all(self, datafile):
     raise NotImplementedError("Should implement")
   def write_all(self, datafile, data):
     raise NotImplementedError("Should implement")
+  def iter_entries(self, datafile):
+    raise NotImplementedError("Should implement")
 
 class FlyEntrySerializerVer1(FlyEntrySerializer):
   def __init__(self):
@@ -103,12 +307,10 @@ class FlyEntrySerializerVer1(FlyEntrySerializer):
         break
     return rv
   def write_all(self, datafile, data):
-    print("[Config]", file = datafile)
-    for k, v in data["Config"].items():
-      print("{}={};".format(k, ';'.join(v)), file = datafile)
-    print("[Entries]", file = datafile)
-    for r in data["Entries"]:
-      print("{};".format(';'.join([_escape(rp) for rp in r[:-1]])), file = datafile)
+    datafile.write("[Config]\n")
+    datafile.writelines("{}={};\n".format(k, ';'.join(v)) for k, v in data["Config"].items())
+    datafile.write("[Entries]\n")
+    datafile.writelines("{};\n".format(';'.join([_escape(rp) for rp in r])) for r in data["Entries"])
   def _read_config(self, datafile):
     cfg = dict()
     while True:
@@ -121,18 +323,14 @@ class FlyEntrySerializerVer1(FlyEntrySerializer):
       cfg[keyval[0].strip()] = [v.strip() for v in keyval[1].split(';') if len(v.strip()) > 0]
     return cfg
   def _read_entries(self, datafile):
-    rows = []
-    while True:
-      row = self._read_row(datafile)
-      if row == []:
-        break
-      row.append(len(rows))
-      rows.append(row)
-    return rows
-  def _read_row(self, datafile):
-    rawvalues = datafile.readline().split(';')
-    values = [_unescape(f.strip()) for f in rawvalues] #if len(f.strip()) > 0]
-    return values[:-1]
+    return list(self.iter_entries(datafile))
+  def iter_entries(self, datafile):
+    for line in iter(datafile.readline, ''):
+      rawvalues = line.split(';')
+      values = [_unescape(f.strip()) for f in rawvalues[:-1]] #if len(f.strip()) > 0]
+      if len(values) == 0:
+        return
+      yield values
 
 class FlyEntrySerializerVer2(FlyEntrySerializer):
   def __init__(self):
@@ -147,12 +345,10 @@ class FlyEntrySerializerVer2(FlyEntrySerializer):
         break
     return rv
   def write_all(self, datafile, data):
-    print("[Config]", file = datafile)
-    for k, v in data["Config"].items():
-      print("{}={};".format(k, ';'.join(v)), file = datafile)
-    print("[Entries]", file = datafile)
-    for r in data["Entries"]:
-      print("\"{}\"\n----".format('\"\n\"'.join([escape(rp, '\"') for rp in r[:-1]])), file = datafile)
+    datafile.write("[Config]\n")
+    datafile.writelines("{}={};\n".format(k, ';'.join(v)) for k, v in data["Config"].items())
+    datafile.write("[Entries]\n")
+    datafile.writelines("\"{}\"\n----\n".format('\"\n\"'.join([escape(rp, '\"') for rp in r])) for r in data["Entries"])
   def _read_config(self, datafile):
     cfg = dict()
     while True:
@@ -165,53 +361,583 @@ class FlyEntrySerializerVer2(FlyEntrySerializer):
       cfg[keyval[0].strip()] = [v.strip() for v in keyval[1].split(';') if len(v.strip()) > 0]
     return cfg
   def _read_entries(self, datafile):
-    rows = []
-    while True:
-      row = self._read_row(datafile)
-      if row == []:
-        break
-      row.append(len(rows))
-      rows.append(row)
-    return rows
-  def _read_row(self, datafile):
+    return list(self.iter_entries(datafile))
+  def iter_entries(self, datafile):
+    # a value runs from its opening quote to the first line ending in a quote that isn't
+    # escaped, the lines in between are kept as they are ('----' and blank ones too)
     values = []
-    rawvalues = ''
-    while True:
-      line = datafile.readline()
-      if len(line) == 0:
-        return []
-      line = line.strip()
-      if line == '----' or (len(rawvalues) == 0 and len(line) == 0):
-        # done with this entry
-        break
-      elif len(line) > 0:
-        if line[-1] == '\"':
-          rawvalues += line.strip('\"')
-          values.append(unescape(rawvalues, '\"'))
-          rawvalues = ''
-        elif line[0] == '\"':
-          rawvalues += line[1:]
-          rawvalues += '\n'
+    parts = None
+    for line in iter(datafile.readline, ''):
+      if parts == None:
+        if line[0] != '\"':
+          stripped = line.strip()
+          if stripped == '----' or len(stripped) == 0:
+            # done with this entry
+            if len(values) == 0:
+              return
+            yield values
+            values = []
+            continue
+          line = line.lstrip()
+        if line[0] == '\"':
+          line = line[1:]
+      if line[-2:] == '\"\n' and line[-3:-2] != '\\':
+        end = len(line) - 2
+      elif line[-1:] == '\n' and line[-2:-1] not in _closing_chars:
+        end = -1
+      else:
+        end = _value_end(line, '\"', '\\')
+      if end < 0:
+        if parts == None:
+          parts = []
+        parts.append(line.rstrip('\n'))
+        parts.append('\n')
+      elif parts == None:
+        values.append(unescape(line[:end], '\"\\'))
+      else:
+        parts.append(line[:end])
+        values.append(unescape(''.join(parts), '\"\\'))
+        parts = None
+
+serializer_versions = {"1": FlyEntrySerializerVer1, "2": FlyEntrySerializerVer2}
+
+def _shard_name(value):
+  # usable as a file name anywhere, long values are hashed
+  name = re.sub(r'[^\w-]', '_', value.lower())
+  return name if len(name) <= 64 else "{:08x}".format(zlib.crc32(value.lower().encode('utf-8')))
+
+class FlyDbStream(object):
+  # iterates the entries of a database file one at a time without building FlyDb.rows
+  def __init__(self, filename):
+    self.datafile = open(filename, 'r')
+    try:
+      ver = self.datafile.readline().split('=')
+      self.version = ver[1].strip(' \n')
+      self.serializer = serializer_versions[self.version]()
+      self.cfg = None
+      while True:
+        tag = self.datafile.readline().strip().strip('[]')
+        if tag == 'Config':
+          self.cfg = self.serializer._read_config(self.datafile)
         else:
-          rawvalues += line
-          rawvalues += '\n'
+          break
+    except:
+      self.datafile.close()
+      raise
+  def __iter__(self):
+    return self.serializer.iter_entries(self.datafile)
+  def close(self):
+    self.datafile.close()
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+
+def _stat(path):
+  # what tells a file changed, None if it's missing
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+def _sync_dir(path):
+  # makes a rename into path durable, not possible (nor needed) everywhere
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+def convert_db(source, target, outver, check = True):
+  # streams the entries of source into target as version outver, only one entry is in memory
+  # at a time. the new file is written next to target and, with check, read back and compared
+  # with source before it replaces target, which may be source itself.
+  # returns the number of entries, the seconds converting and the seconds checking
+  ser = serializer_versions[outver]()
+  target = os.path.realpath(target)
+  tmp = "{}.tmp".format(target)
+  start = time.perf_counter()
+  count = 0
+  def entries(stream):
+    nonlocal count
+    for values in stream:
+      count += 1
+      yield values
+  try:
+    with FlyDbStream(source) as stream, open(tmp, 'w', newline = '\n', buffering = 1 << 20) as datafile:
+      cfg = stream.cfg if stream.cfg != None else dict()
+      if len(cfg.get('Shards', [])) > 0:
+        raise ValueError("{} is sharded, join it with --shard none first".format(source))
+      datafile.write("Version={}\n".format(outver))
+      ser.write_all(datafile, {"Config": cfg, "Entries": entries(stream)})
+      datafile.flush()
+      os.fsync(datafile.fileno())
+    t_convert = time.perf_counter() - start
+    if check:
+      _check_conversion(source, tmp, outver)
+    t_check = time.perf_counter() - start - t_convert
+    if os.path.exists(target):
+      shutil.copymode(target, tmp)
+  except:
+    try:
+      os.remove(tmp)
+    except OSError:
+      pass
+    raise
+  os.replace(tmp, target)
+  _sync_dir(os.path.dirname(target))
+  return count, t_convert, t_check
+
+def _check_conversion(source, converted, outver):
+  # both files read entry by entry, what doesn't read back the same is what the
+  # format of converted can't hold
+  with FlyDbStream(source) as a, FlyDbStream(converted) as b:
+    if (a.cfg or dict()) != (b.cfg or dict()):
+      raise ValueError("the config reads back differently as version {}".format(outver))
+    fields = [f.lower() for f in (a.cfg or dict()).get('Fields', [])]
+    pos = fields.index('id') if 'id' in fields else 0
+    differ = 0
+    first = None
+    n = 0
+    for n, (x, y) in enumerate(itertools.zip_longest(a, b), 1):
+      if x != y:
+        differ += 1
+        if first == None:
+          first = "entry {}".format(n) if x == None or pos >= len(x) else "entry {} ({})".format(n, x[pos])
+  if differ > 0:
+    raise ValueError("{} of {} entries read back differently as version {}, the first is {}".format(
+                     differ, n, outver, first))
+
+# the opening quote of a value and the quotes that may close it, see _value_end
+_lazy_open = re.compile(rb'\s*"?')
+_lazy_close = re.compile(rb'"[ \t\r\f\v]*(\n|$)')
+
+class LazySource(object):
+  # a version 2 database file mapped into memory. entries() parses it like
+  # FlyEntrySerializerVer2 but leaves some fields as the offset they start at, their
+  # lines are only skipped over and decoded when the value is read. plain ints keep
+  # the garbage collector from having to look at them.
+  # a file replaced by a rename (fit's own writes, git, most editors) leaves the mapping
+  # alone. one written in place shows through it, intact() tells and the rows are read
+  # again (on_change) instead of trusting offsets into what is there now
+  def __init__(self, filename):
+    fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+      self.buf = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+    except:
+      os.close(fd)
+      raise
+    # kept open to fstat what is mapped, the path may name another file by now
+    self.fd = fd
+    self.stat = self._fstat()
+    self.on_change = None
+    head = self.buf.find(b'\n[Entries]')
+    if self.buf[:9] != b'Version=2' or head < 0:
+      raise ValueError("{} is not a version 2 database".format(filename))
+    self.serializer = FlyEntrySerializerVer2()
+    header = self.buf[:head + 1].decode('utf-8').split('\n', 1)[1]
+    self.cfg = self.serializer.read_all(io.StringIO(header + '[Entries]\n')).get('Config', dict())
+    self.start = self.buf.find(b'\n', head + 1) + 1 or len(self.buf)
+  def entries(self, lazy):
+    # (values, hash) per entry, lazy are the lowercase names of the fields to leave undecoded.
+    # the hash is of the bytes of the entry, sync() tells unchanged entries apart with it
+    positions = {i for i, name in enumerate(self.cfg.get('Fields', ())) if name.lower() in lazy}
+    buf = self.buf
+    buf.seek(self.start)
+    first = self.start
+    values = []
+    parts = None
+    for raw in iter(buf.readline, b''):
+      if parts == None:
+        stripped = raw.strip()
+        if stripped == b'----' or len(stripped) == 0:
+          if len(values) == 0:
+            return
+          yield values, hash(buf[first:buf.tell() - len(raw)])
+          first = buf.tell()
+          values = []
+          continue
+        if len(values) in positions:
+          start = buf.tell() - len(raw)
+          end = self.end(start)
+          if end != None:
+            values.append(start)
+            buf.seek(end)
+            continue
+        raw = raw.lstrip()
+        if raw[:1] == b'\"':
+          raw = raw[1:]
+        parts = []
+      end = _value_end(raw, b'\"', b'\\')
+      if end >= 0:
+        parts.append(raw[:end])
+        values.append(unescape(b''.join(parts).decode('utf-8'), '\"\\'))
+        parts = None
       else:
-          rawvalues += '\n'
-    return values
+        parts.append(raw.rstrip(b'\r\n'))
+        parts.append(b'\n')
+  def _close(self, start):
+    # where the text of the value whose first line starts at start begins and the match
+    # of its closing quote, None if it is never closed
+    first = _lazy_open.match(self.buf, start).end()
+    pos = first
+    while True:
+      close = _lazy_close.search(self.buf, pos)
+      if close == None:
+        return None
+      line = self.buf.rfind(b'\n', pos, close.start()) + 1 or pos
+      if _value_end(self.buf[line:close.end()], b'\"', b'\\') >= 0:
+        return first, close
+      pos = close.end()
+  def __del__(self):
+    os.close(self.fd)
+  def _fstat(self):
+    st = os.fstat(self.fd)
+    return (st.st_mtime_ns, st.st_size)
+  def intact(self):
+    # False once the mapped file was written to. a truncated mapping faults when read
+    return self._fstat() == self.stat
+  def end(self, start):
+    span = self._close(start)
+    return span[1].end() if span != None else None
+  def decode(self, start):
+    # what FlyEntrySerializerVer2 reads, the lines of a value are kept as they are
+    first, close = self._close(start)
+    text = self.buf[first:close.start()].decode('utf-8')
+    if '\r' in text:
+      text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return unescape(text, '\"\\')
+  def decode_all(self, values):
+    return [self.decode(v) if type(v) is int else v for v in values]
+
+def _lazy_property(name, hidden):
+  # decoded on first use and kept, a page shown once is likely shown again
+  def get(self):
+    v = getattr(self, hidden)
+    if type(v) is int:
+      if not self.source.intact():
+        r = self.source.on_change(self)
+        return getattr(r, name) if r != None and r is not self else ''
+      v = self.source.decode(v)
+      setattr(self, hidden, v)
+    return v
+  def set(self, v):
+    setattr(self, hidden, v)
+  return property(get, set)
+
+class FlyRow(object):
+  # base for the row classes made by row_class(), one slot per configured field
+  # plus the rank and links FlyDb keeps its ordering with
+  __slots__ = ('extra', 'rank', 'prev', 'next', 'shard')
+  fields = []
+  field_slots = ()
+  slotmap = dict()
+  def __init__(self, values):
+    self.assign(values)
+    self.rank = 0
+    self.prev = None
+    self.next = None
+    self.shard = None
+  def assign(self, values):
+    for slot, v in zip(self.field_slots, values):
+      setattr(self, slot, v)
+    for slot in self.field_slots[len(values):]:
+      setattr(self, slot, '')
+    self.extra = tuple(values[len(self.field_slots):])
+  def values(self):
+    rv = [getattr(self, slot) for slot in self.field_slots]
+    rv.extend(self.extra)
+    return rv
+  def keys(self):
+    return list(self.fields)
+  def items(self):
+    return [(name, getattr(self, slot)) for name, slot in zip(self.fields, self.field_slots)]
+  def get(self, name, default = None):
+    slot = self.slotmap.get(name)
+    if slot == None:
+      slot = self.slotmap.get(name.lower())
+    return getattr(self, slot) if slot != None else default
+  def __getitem__(self, name):
+    slot = self.slotmap.get(name)
+    if slot == None:
+      slot = self.slotmap.get(name.lower())
+      if slot == None:
+        raise KeyError(name)
+    return getattr(self, slot)
+  def __contains__(self, name):
+    return name in self.slotmap or name.lower() in self.slotmap
+  def __iter__(self):
+    return iter(self.fields)
+  def __len__(self):
+    return len(self.fields)
+
+_row_classes = dict()
+
+def row_class(fields, lazy = ()):
+  # one FlyRow subclass per Fields config, the name to slot map is built once here.
+  # fields named in lazy (lowercase) may hold an offset into the LazySource set as
+  # source on the class, so those classes are made anew for every source
+  key = tuple(fields)
+  if len(lazy) == 0 and key in _row_classes:
+    return _row_classes[key]
+  slots = []
+  for name in fields:
+    slot = 'f_' + re.sub(r'\W', '_', name)
+    while slot in slots:
+      slot += '_'
+    slots.append(slot)
+  slotmap = dict()
+  for name, slot in zip(fields, slots):
+    slotmap.setdefault(name.lower(), slot)
+    slotmap.setdefault(name, slot)
+  attrs = {'__slots__': tuple(slots), 'fields': list(fields), 'field_slots': tuple(slots), 'slotmap': slotmap}
+  hidden = []
+  for name, slot in zip(fields, slots):
+    if name.lower() in lazy:
+      hidden.append('_lazy' + slot)
+      attrs[slot] = _lazy_property(slot, '_lazy' + slot)
+      attrs['source'] = None
+    else:
+      hidden.append(slot)
+  attrs['__slots__'] = tuple(hidden)
+  cls = type('FlyRow', (FlyRow,), attrs)
+  if len(lazy) == 0:
+    _row_classes[key] = cls
+  return cls
+
+_search_word = re.compile(r'\w+')
+_search_query = re.compile(r'(\w+)(\*?)')
+
+class SearchIndex(object):
+  # inverted index over Title and Description, term -> {row: weight} where a word in
+  # the title counts three times one in the description
+  title_weight = 3
+  def __init__(self, row_class):
+    self.title_slot = row_class.slotmap.get('title')
+    self.desc_slot = row_class.slotmap.get('description')
+    self.postings = collections.defaultdict(dict)
+    self.size = 0
+    self.sorted_terms = None
+    # rows of the terms in more than bucket_min rows by weight, see _buckets
+    self.buckets = dict()
+  bucket_min = 1000
+  def _terms(self, r):
+    weights = collections.Counter()
+    if self.desc_slot != None:
+      weights.update(_search_word.findall(getattr(r, self.desc_slot).lower()))
+    if self.title_slot != None:
+      weights.update(_search_word.findall(getattr(r, self.title_slot).lower()) * self.title_weight)
+    return weights
+  def add(self, r):
+    self.size += 1
+    postings = self.postings
+    n = len(postings)
+    for term, weight in self._terms(r).items():
+      postings[term][r] = weight
+      if len(self.buckets) > 0:
+        self.buckets.pop(term, None)
+    if len(postings) != n:
+      self.sorted_terms = None
+  def remove(self, r):
+    self.size -= 1
+    for term in self._terms(r):
+      if len(self.buckets) > 0:
+        self.buckets.pop(term, None)
+      rows = self.postings.get(term)
+      if rows != None:
+        rows.pop(r, None)
+        if len(rows) == 0:
+          del self.postings[term]
+          self.sorted_terms = None
+  def _expand(self, prefix):
+    if self.sorted_terms == None:
+      self.sorted_terms = sorted(self.postings)
+    i = bisect.bisect_left(self.sorted_terms, prefix)
+    j = bisect.bisect_left(self.sorted_terms, prefix + '\uffff', i)
+    return self.sorted_terms[i:j]
+  def _idf(self, term):
+    return math.log(1 + self.size / len(self.postings[term]))
+  def _group(self, terms):
+    # row -> score for one word of the query, all the words a prefix expands to summed up
+    if len(terms) == 1:
+      return self.postings[terms[0]], self._idf(terms[0])
+    terms = sorted(terms, key = lambda t: -len(self.postings[t]))
+    idf = self._idf(terms[0])
+    scores = {r: w * idf for r, w in self.postings[terms[0]].items()}
+    for t in terms[1:]:
+      idf = self._idf(t)
+      for r, w in self.postings[t].items():
+        scores[r] = scores.get(r, 0) + w * idf
+    return scores, 1
+  def _buckets(self, term):
+    # weight -> rows of a term, kept until a row of the term is added or removed
+    buckets = self.buckets.get(term)
+    if buckets == None:
+      buckets = collections.defaultdict(list)
+      for r, w in self.postings[term].items():
+        buckets[w].append(r)
+      self.buckets[term] = buckets
+    return buckets
+  def _search_word(self, terms, limit):
+    # one query word in many rows and nothing to narrow it down: the rows only the largest
+    # of its terms has are taken from that term's buckets, heaviest first, and only as many
+    # as can make it. the rest (in one of the other terms) are scored as _group() does
+    terms = sorted(terms, key = lambda t: -len(self.postings[t]))
+    big = self.postings[terms[0]]
+    idf = self._idf(terms[0])
+    others = set().union(*(self.postings[t] for t in terms[1:]))
+    both = others & big.keys()
+    scores = {r: big[r] * idf for r in both}
+    for t in terms[1:]:
+      tidf = self._idf(t)
+      for r, w in self.postings[t].items():
+        scores[r] = scores.get(r, 0) + w * tidf
+    total = len(big) + len(others) - len(both)
+    if limit <= 0:
+      return total, []
+    # a row of the other terms picked from a bucket keeps its score, it is at least as
+    # high and still beats the rows left out, so the buckets need no filtering
+    buckets = self._buckets(terms[0])
+    taken = 0
+    for w in sorted(buckets, reverse = True):
+      rows = buckets[w]
+      if taken + len(rows) >= limit:
+        rows = heapq.nsmallest(limit - taken, rows, key = operator.attrgetter('rank'))
+      for r in rows:
+        scores.setdefault(r, w * idf)
+      taken += len(rows)
+      if taken >= limit:
+        break
+    return total, [(scores[r], r) for r in self._best(scores, limit)]
+  def search(self, query, within = (), limit = 20):
+    # every word of the query has to match, 'word*' matches any word starting with it.
+    # within are sets of rows the matches have to be in. returns the number of matches
+    # and the best ones as (score, row), ties go to the row coming first
+    words = [self._expand(word) if star else [word] if word in self.postings else []
+             for word, star in _search_query.findall(query.lower())]
+    if len(words) == 0 or min(map(len, words)) == 0:
+      return 0, []
+    if len(words) == 1 and len(within) == 0 and max(len(self.postings[t]) for t in words[0]) > self.bucket_min:
+      return self._search_word(words[0], limit)
+    groups = [self._group(terms) for terms in words]
+    sets = [scores.keys() for scores, factor in groups] + list(within)
+    sets.sort(key = len)
+    matches = sets[0]
+    for other in sets[1:]:
+      if len(matches) == 0:
+        break
+      matches = matches & other
+    if len(matches) == 0:
+      return 0, []
+    if len(groups) == 1:
+      scores, factor = groups[0]
+      if len(matches) != len(scores):
+        scores = {r: scores[r] for r in matches}
+    else:
+      factor = 1
+      scores = {r: sum(g[r] * f for g, f in groups) for r in matches}
+    if limit <= 0:
+      return len(scores), []
+    return len(scores), [(scores[r] * factor, r) for r in self._best(scores, limit)]
+  def _best(self, scores, limit):
+    # the lowest score that makes it is found on the bare numbers, few distinct ones
+    # for a single word, rows are only compared by rank among those tied with it
+    limit = min(limit, len(scores))
+    counts = collections.Counter(scores.values())
+    above = 0
+    for bar in sorted(counts, reverse = True):
+      if above + counts[bar] >= limit:
+        break
+      above += counts[bar]
+    best = [r for r, sc in scores.items() if sc >= bar]
+    if len(best) > limit:
+      tied = [r for r in best if scores[r] == bar]
+      best = [r for r in best if scores[r] > bar]
+      best.extend(heapq.nsmallest(limit - len(best), tied, key = operator.attrgetter('rank')))
+    best.sort(key = lambda r: (-scores[r], r.rank))
+    return best
+  def save(self, filename, rows, stat):
+    # rows are stored by their position in the file, postings as arrays of machine ints
+    pos = {r: i for i, r in enumerate(rows)}
+    postings = {t: (array.array('I', map(pos.__getitem__, ps)).tobytes(), array.array('I', ps.values()).tobytes())
+                for t, ps in self.postings.items()}
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+      marshal.dump({'format': 2, 'stat': stat, 'count': len(rows), 'postings': postings}, f)
+    os.replace(tmp, filename)
+  def load(self, filename, rows, stat):
+    try:
+      with open(filename, 'rb') as f:
+        data = marshal.loads(f.read())
+      if data['format'] != 2 or data['stat'] != stat or data['count'] != len(rows):
+        return False
+      postings = collections.defaultdict(dict)
+      for t, (positions, weights) in data['postings'].items():
+        idx = array.array('I')
+        idx.frombytes(positions)
+        w = array.array('I')
+        w.frombytes(weights)
+        postings[t] = dict(zip(map(rows.__getitem__, idx), w))
+    except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+      return False
+    self.postings = postings
+    self.size = len(rows)
+    self.sorted_terms = None
+    self.buckets = dict()
+    return True
 
 class FlyDb(object):
-  def __init__(self, filename, outver = None):
+  def __init__(self, filename, outver = None, journal = False, journal_limit = 1000, search = False, search_cache = False,
+               write_delay = 0, write_buffer = 1 << 20, metrics = None, lazy = False, snapshot = False):
     self.filename = filename
+    # snapshot keeps the parsed file in .fit/ and starts from it while the file is unchanged
+    self.snapshot = snapshot
+    self.snapshot_stat = None
+    # lazy leaves descriptions in the file until they are read, see LazySource
+    self.lazy_fields = ('description',) if lazy else ()
+    self.metrics = metrics
+    if metrics != None:
+      metrics.family('fit_db_seconds', 'Time spent in database operations, by operation.', 'op')
+    self.search_enabled = search
+    self.search_cache = search_cache
     self.defaults = {'Id': self._gen_id, 'Created': self._get_date,
                      'Modified': self._get_date, 'Parent': self._return_fixed('none'),
                      'Status': self._return_cfg('Status.Default'), 'Type': self._return_cfg('Type.Default'),
                      'Title': self._return_fixed(''), 'Description': self._return_fixed('')}
-    self.serializers = {"1": FlyEntrySerializerVer1(), "2": FlyEntrySerializerVer2()}
+    self.serializers = {k: v() for k, v in serializer_versions.items()}
     self.inver = ""
     self.outver = outver
-    self.rows = []
-    self.rowmap = dict()
+    self.indexed = {'id': 'Id', 'type': 'Type', 'parent': 'Parent', 'status': 'Status'}
     self.cfg = self._default_cfg() #{'Status.Default': 'Backlog', 'Type.Default': 'Todo'}
+    self._clear_rows()
+    self.lock = threading.RLock()
+    self.journal = journal
+    self.journal_name = "{}.journal".format(filename)
+    self.journal_limit = journal_limit
+    self.journal_pending = []
+    self.journal_size = 0
+    self.replaying = False
+    self.batching = False
+    self.compactor = None
+    self.compactor_stop = threading.Event()
+    self.write_delay = write_delay
+    self.write_buffer = write_buffer
+    self.writer = None
+    self.watcher = None
+    self.watcher_stop = threading.Event()
+    self.file_stat = None
+    self.file_entries = None
+    self.file_generation = None
+    self.listeners = []
+    self.boot = "{:08x}".format(int(time.time()))
+    self.generation = 0
     self.reload_db()
   def _default_cfg(self):
     return {'Status.Default': ['Backlog'],
@@ -223,125 +949,976 @@ class FlyDb(object):
             'Fields': ['Id', 'Type', 'Title', 'Description', 'Created', 'Modified', 'Parent', 'Status']
             }
   def reload_db(self):
-    self.rows = []
-    self.rowmap = dict()
-    self.cfg = self._default_cfg() #self.cfg = {'Status.Default': 'Backlog', 'Type.Default': 'Todo'}
-    try:
-      with open(self.filename, 'r') as datafile:
-        ver = datafile.readline().split('=')
-        self.inver = ver[1].strip(' \n')
-        ser = self.serializers[self.inver]
-        data = ser.read_all(datafile)
-        self.cfg = data["Config"]
-        self.rows = data["Entries"]
-        for r in self.rows:
-          self.rowmap[r[0]] = r
-    except:
-      return False
+    with self.lock:
+      self.generation += 1
+      self.cfg = self._default_cfg() #self.cfg = {'Status.Default': 'Backlog', 'Type.Default': 'Todo'}
+      self._clear_rows()
+      self.file_stat = None
+      self.file_entries = None
+      start = time.perf_counter()
+      try:
+        stat = self._file_stat()
+        with open(self.filename, 'r') as datafile:
+          ver = datafile.readline().split('=')
+          self.inver = ver[1].strip(' \n')
+          ser = self.serializers[self.inver]
+          source = self._open_source()
+          snap = self._read_snapshot(stat) if source == None else None
+          if snap != None:
+            self.inver = snap['version']
+            data = {"Config": snap['cfg'], "Entries": snap['entries']}
+          else:
+            data = ser.read_all(datafile) if source == None else {"Config": source.cfg}
+          self.cfg = data["Config"]
+          self._clear_rows()
+          if self.sharding != None:
+            # the rest is the [Order] section of a manifest
+            stat = self._file_stat()
+            self._read_manifest(datafile)
+            entries = ()
+          elif source != None:
+            hashed = list(source.entries(self.lazy_fields))
+            entries = [values for values, h in hashed]
+            self.row_class.source = source
+            source.on_change = self._lazy_changed
+          else:
+            entries = data["Entries"]
+          for values in entries:
+            self._insert_row(self.row_class(values))
+          self._remember_file(stat, entries, [h for values, h in hashed] if source != None else None)
+      except:
+        return False
+      start = self._observe('parse', start)
+      if snap == None and source == None and self.sharding == None:
+        self._save_snapshot(stat, self.inver, self.cfg, entries)
+      if self.search_enabled and self.sharding == None and getattr(self.row_class, 'source', None) == None:
+        self._build_text_index()
+        start = self._observe('search_index', start)
+      if self.journal:
+        self._replay_journal()
+        self._observe('journal_replay', start)
+      self._notify('reload')
     return True
+  def _replay_journal(self):
+    self.journal_pending = []
+    self.journal_size = 0
+    try:
+      with open(self.journal_name, 'r') as jf:
+        lines = jf.readlines()
+    except FileNotFoundError:
+      return
+    ops = {'add': self.add_row_from_dict, 'update': self.update_row_from_dict,
+           'status': self.change_row, 'place': self.place_before}
+    self.replaying = True
+    try:
+      for line in lines:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          # torn tail from a crash mid-append, nothing after it was acknowledged
+          break
+        self.journal_size += 1
+        if entry['op'] == 'add' and entry['args'][0].get('Id') in self.rowmap:
+          # already in the database, written by a compaction that stopped before
+          # it got to remove the journal. the other ops give the same result twice
+          continue
+        ops[entry['op']](*entry['args'])
+    finally:
+      self.replaying = False
+  def _record(self, op, *args):
+    # every mutation ends up here, generation tells readers whether anything changed
+    self.generation += 1
+    if self.journal and not self.replaying:
+      self.journal_pending.append(json.dumps({'op': op, 'args': args}) + '\n')
+    if not self.replaying and not self.batching:
+      self._notify(op, *args)
+  def add_listener(self, listener):
+    # listener(op, args, generation) is told about every change, with the lock held.
+    # op and args are what goes into the journal, plus 'sync', 'reload' and 'batch'
+    self.listeners.append(listener)
+  def _notify(self, op, *args):
+    for listener in self.listeners:
+      listener(op, args, self.generation)
+  def _observe(self, op, start):
+    # records the time since start, returns now to time the next step from
+    now = time.perf_counter()
+    if self.metrics != None:
+      self.metrics.observe('fit_db_seconds', op, now - start)
+    return now
+  def flush(self):
+    if not self.journal:
+      if self.write_delay > 0:
+        # write behind, changes coming within write_delay of each other are written once
+        with self.lock:
+          if self.writer == None:
+            self.writer = threading.Timer(self.write_delay, self._write_behind)
+            self.writer.daemon = True
+            self.writer.start()
+        return
+      self.write_db()
+      return
+    with self.lock:
+      if len(self.journal_pending) > 0:
+        start = time.perf_counter()
+        with open(self.journal_name, 'a', newline = '\n') as jf:
+          jf.write(''.join(self.journal_pending))
+        self.journal_size += len(self.journal_pending)
+        self.journal_pending = []
+        self._observe('journal_append', start)
+      if self.journal_size >= self.journal_limit:
+        self.compact()
+  def compact(self):
+    with self.lock:
+      self.write_db()
+      self._clear_journal()
+  def _clear_journal(self):
+    # everything in the journal has just been written to the database
+    self.journal_pending = []
+    self.journal_size = 0
+    try:
+      os.remove(self.journal_name)
+    except FileNotFoundError:
+      pass
+  def _write_behind(self):
+    with self.lock:
+      if self.writer == None:
+        return
+      self.writer = None
+      self.write_db()
+  def _compact_loop(self, interval):
+    while not self.compactor_stop.wait(interval):
+      if self.journal_size > 0 or len(self.journal_pending) > 0:
+        self.compact()
+  def start_compactor(self, interval):
+    if not self.journal or self.compactor != None:
+      return
+    self.compactor = threading.Thread(target = self._compact_loop, args = (interval,), daemon = True)
+    self.compactor.start()
+  def close(self):
+    if self.watcher != None:
+      self.watcher_stop.set()
+      self.watcher.join()
+      self.watcher = None
+    if self.compactor != None:
+      self.compactor_stop.set()
+      self.compactor.join()
+      self.compactor = None
+    with self.lock:
+      if self.writer != None:
+        self.writer.cancel()
+        self.writer = None
+        self.write_db()
+    if self.journal:
+      self.compact()
+    with self.lock:
+      if getattr(self.row_class, 'source', None) == None:
+        self._refresh_snapshot()
+      if self.search_cache and self.text_index != None and self.sharding == None and self.generation == self.file_generation:
+        self._save_text_index()
+  def _snapshot_name(self):
+    return os.path.join(os.path.dirname(os.path.abspath(self.filename)), '.fit',
+                        os.path.basename(self.filename) + '.snapshot')
+  def _file_digest(self):
+    digest = hashlib.sha1()
+    with open(self.filename, 'rb') as datafile:
+      for block in iter(lambda: datafile.read(1 << 20), b''):
+        digest.update(block)
+    return digest.hexdigest()
+  def _read_snapshot(self, stat):
+    # what the parser read from exactly this file, None if it's missing or the file changed
+    if not self.snapshot or stat == None:
+      return None
+    start = time.perf_counter()
+    try:
+      # marshal.load() reads a file in small pieces, loads() of the whole file is several times faster
+      with open(self._snapshot_name(), 'rb') as f:
+        snap = marshal.loads(f.read())
+      if snap['format'] != 2 or snap['stat'] != stat or snap['sha1'] != self._file_digest():
+        return None
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+      return None
+    self.snapshot_stat = stat
+    self._observe('snapshot_load', start)
+    return snap
+  def _save_snapshot(self, stat, version, cfg, entries):
+    # entries have to be what the parser made of the file at stat, rows written by
+    # write_db can differ from what reading the file back gives
+    if not self.snapshot or stat == None:
+      return
+    start = time.perf_counter()
+    try:
+      digest = self._file_digest()
+      if self._file_stat() != stat:
+        return
+      name = self._snapshot_name()
+      os.makedirs(os.path.dirname(name), exist_ok = True)
+      with open(name + '.tmp', 'wb') as f:
+        marshal.dump({'format': 2, 'stat': stat, 'sha1': digest, 'version': version, 'cfg': cfg, 'entries': entries}, f)
+      os.replace(name + '.tmp', name)
+    except (OSError, ValueError) as e:
+      print("fit: writing the snapshot failed: {}".format(e), file = sys.stderr)
+      return
+    self.snapshot_stat = stat
+    self._observe('snapshot_save', start)
+  def _refresh_snapshot(self):
+    # the file was written since the snapshot was taken, parse it once more for the next start
+    stat = self._file_stat()
+    if not self.snapshot or stat == None or stat == self.snapshot_stat or self.sharding != None:
+      return
+    try:
+      with FlyDbStream(self.filename) as stream:
+        version = stream.version
+        cfg = stream.cfg
+        entries = list(stream)
+    except (OSError, KeyError, IndexError, ValueError):
+      return
+    if cfg != None:
+      self._save_snapshot(stat, version, cfg, entries)
+  def _search_cache_name(self):
+    return os.path.join(os.path.dirname(os.path.abspath(self.filename)), '.fit',
+                        os.path.basename(self.filename) + '.search')
+  def _build_text_index(self):
+    # rows are as the file has them here, the cache is only good for exactly that file
+    if self.sharding != None:
+      # every shard loaded first, loading one adds its rows to an index that exists
+      rows = self.rows
+      self.text_index = SearchIndex(self.row_class)
+      for r in rows:
+        self.text_index.add(r)
+      return
+    self.text_index = SearchIndex(self.row_class)
+    if self.search_cache and self.text_index.load(self._search_cache_name(), self.rows, self.file_stat):
+      return
+    for r in self.rows:
+      self.text_index.add(r)
+    if self.search_cache and self.file_stat != None:
+      self._save_text_index()
+  def _save_text_index(self):
+    try:
+      self.text_index.save(self._search_cache_name(), self.rows, self.file_stat)
+    except OSError as e:
+      print("fit: writing the search cache failed: {}".format(e), file = sys.stderr)
   def _gen_id(self):
-    return hashlib.sha1((datetime.datetime.today().isoformat() + str(len(self.rows))).encode('utf-8')).hexdigest()[:8].upper()
+    return hashlib.sha1((datetime.datetime.today().isoformat() + str(self.count)).encode('utf-8')).hexdigest()[:8].upper()
   def _get_date(self):
     return datetime.datetime.today().isoformat(' ', 'seconds')
   def _return_fixed(self, value):
     return lambda: value
   def _return_cfg(self, cfgval):
     return lambda: self.cfg[cfgval][0]
-  def _update_index(self):
+  def _clear_rows(self):
+    # rows are kept in a doubly linked list through their prev/next slots,
+    # rank increases along the list so a move only touches its neighbours
+    self.row_class = row_class(self.cfg['Fields'], self.lazy_fields)
+    self.slots = {k: self.row_class.slotmap.get(v.lower()) for k, v in self.indexed.items()}
+    self.rowmap = dict()
+    self.index = {k: dict() for k in self.indexed}
+    self.count = 0
+    self.first = None
+    self.last = None
+    self.ordered = []
+    # built once all rows are in, see _build_text_index
+    self.text_index = None
+    # a sharded database (Shards= in the config) keeps its rows in files under shard_dir,
+    # see _read_manifest
+    self.sharding = self.cfg['Shards'][0] if len(self.cfg.get('Shards', [])) > 0 else None
+    self.shard_dir = "{}.d".format(os.path.splitext(self.filename)[0])
+    self.shards = dict()
+    self.shard_types = dict()
+    self.stubs = dict()
+    self.unloaded = set()
+    self.dirty = set()
+    self.manifest_dirty = False
+    # (mtime, size) of the shard files read or written, see sync
+    self.shard_stats = dict()
+  def _insert_row(self, r):
+    self._link_last(r)
+    self.count += 1
+    self.rowmap[self._field(r, 'id')] = r
+    self._index_row(r)
+    if self.text_index != None:
+      self.text_index.add(r)
+  def _remove_row(self, r):
+    self._unlink(r)
+    self.count -= 1
+    del self.rowmap[self._field(r, 'id')]
+    self._unindex_row(r)
+    if self.text_index != None:
+      self.text_index.remove(r)
+    if r.shard != None:
+      self.shards.get(r.shard, set()).discard(r)
+      self.dirty.add(r.shard)
+      self.manifest_dirty = True
+  def _shard_of(self, r):
+    # 'type' puts each type in its own file, 'parent' gives every issue a file with its
+    # comments (rows without parent go by type) and 'hash:<n>' spreads rows over n files
+    type = _shard_name(self._field(r, 'type'))
+    if self.sharding == 'type':
+      return 'type-' + type
+    if self.sharding == 'parent':
+      parent = self._field(r, 'parent').lower()
+      return 'parent-' + _shard_name(parent) if parent not in ('', 'none') else 'type-' + type
+    n = int(self.sharding.partition(':')[2] or 16)
+    return "hash-{:02x}".format(zlib.crc32(self._field(r, 'id').lower().encode('utf-8')) % n)
+  def _open_source(self):
+    # a LazySource over the database file when it can be read lazily, None otherwise
+    if len(self.lazy_fields) == 0:
+      return None
+    try:
+      source = LazySource(self.filename)
+    except (OSError, ValueError):
+      return None
+    return source if not 'Shards' in source.cfg else None
+  def _lazy_changed(self, r):
+    # the file lazy row r reads from was written in place, its offsets mean nothing
+    # now. reads the file again (once) and answers with the row that replaced r
+    with self.lock:
+      if type(r) is self.row_class:
+        self.reload_db()
+      return self.rowmap.get(self._field(r, 'id'))
+  def _release_source(self):
+    # windows can't replace a file that is mapped, read what is still in it first
+    if getattr(self.row_class, 'source', None) == None or os.name != 'nt':
+      return
+    for r in self._iter_rows():
+      r.assign(r.values())
+    self.row_class.source = None
+  def _shard_file(self, name):
+    return os.path.join(self.shard_dir, name + '.txt')
+  def _read_manifest(self, datafile):
+    # 'Id;Type;Shard' per row in board order, escaped like version 1. rows are stubs holding
+    # only Id and Type until their shard is needed, they keep their place in the list meanwhile
+    id_pos = self.row_class.field_slots.index(self.slots['id'])
+    type_pos = self.row_class.field_slots.index(self.slots['type']) if self.slots['type'] != None else None
+    blank = [''] * len(self.row_class.field_slots)
+    for line in datafile:
+      fields = [_unescape(f) for f in line.rstrip('\n').split(';')]
+      if len(fields) < 3:
+        continue
+      values = list(blank)
+      values[id_pos] = fields[0]
+      if type_pos != None:
+        values[type_pos] = fields[1]
+      r = self.row_class(values)
+      r.shard = fields[2]
+      self._link_last(r)
+      self.count += 1
+      self.rowmap[fields[0]] = r
+      self.stubs.setdefault(r.shard, dict())[fields[0]] = r
+      self.shard_types.setdefault(r.shard, set()).add(fields[1].lower())
+    self.unloaded = set(self.stubs)
+    self.manifest_dirty = False
+  def _load_shard(self, name):
+    # fills in the stubs of a shard. rows only found in the file go to the end,
+    # stubs missing from it are dropped
+    start = time.perf_counter()
+    self.unloaded.discard(name)
+    stubs = self.stubs.pop(name, dict())
+    rows = self.shards.setdefault(name, set())
+    self.shard_stats[name] = _stat(self._shard_file(name))
+    try:
+      with FlyDbStream(self._shard_file(name)) as stream:
+        fields = stream.cfg.get('Fields', self.cfg['Fields']) if stream.cfg != None else self.cfg['Fields']
+        entries = list(stream)
+    except FileNotFoundError:
+      fields = self.cfg['Fields']
+      entries = []
+    if fields != self.cfg['Fields']:
+      entries = [[dict(zip(fields, values)).get(f, '') for f in self.cfg['Fields']] for values in entries]
+    id_pos = self.row_class.field_slots.index(self.slots['id'])
+    for values in entries:
+      r = stubs.pop(values[id_pos] if id_pos < len(values) else '', None)
+      if r == None:
+        r = self.row_class(values)
+        self._insert_row(r)
+        self.manifest_dirty = True
+      else:
+        r.assign(values)
+        self._index_row(r)
+        if self.text_index != None:
+          self.text_index.add(r)
+      r.shard = name
+      rows.add(r)
+    for r in stubs.values():
+      self._unlink(r)
+      self.count -= 1
+      del self.rowmap[self._field(r, 'id')]
+      self.manifest_dirty = True
+    self._observe('shard_load', start)
+  def _load_shards_for(self, type, parent, id):
+    # loads every shard that can hold a row matching the query
+    if len(self.unloaded) == 0:
+      return
+    if id != None and id in self.rowmap:
+      names = {self.rowmap[id].shard} & self.unloaded
+    else:
+      names = set(self.unloaded)
+      if type != None:
+        types = {type.lower()} if isinstance(type, str) else {t.lower() for t in type}
+        names = {n for n in names if len(self.shard_types.get(n, ()) & types) > 0}
+      if parent != None and self.sharding == 'parent':
+        parent = parent.lower()
+        if parent == 'none':
+          names = {n for n in names if n.startswith('type-')}
+        else:
+          names &= {'parent-' + _shard_name(parent)}
+    for name in names:
+      self._load_shard(name)
+  def _assign_shard(self, r):
+    if self.sharding == None:
+      return
+    name = self._shard_of(r)
+    if name in self.unloaded:
+      self._load_shard(name)
+    if r.shard != name:
+      if r.shard != None:
+        self.shards.get(r.shard, set()).discard(r)
+        self.dirty.add(r.shard)
+      self.manifest_dirty = True
+    r.shard = name
+    self.shards.setdefault(name, set()).add(r)
+    self.shard_types.setdefault(name, set()).add(self._field(r, 'type').lower())
+    self.dirty.add(name)
+  def _touch(self, r):
+    # r is about to change, its shard has to be read before it can be written
+    if r.shard == None:
+      return
+    if r.shard in self.unloaded:
+      self._load_shard(r.shard)
+    self.dirty.add(r.shard)
+  def reshard(self, sharding):
+    # splits the database into shard files by sharding ('type', 'parent', 'hash:<n>')
+    # next to a manifest in place of the database file, 'none' joins them into one again
+    sharding = None if sharding in (None, 'none') else sharding
+    with self.lock:
+      if sharding == self.sharding:
+        return
+      rows = self.rows
+      old = set(self.shards)
+      self.sharding = sharding
+      self.shards = dict()
+      self.shard_types = dict()
+      if sharding != None:
+        self.cfg['Shards'] = [sharding]
+      else:
+        self.cfg.pop('Shards', None)
+      for r in rows:
+        r.shard = None
+        self._assign_shard(r)
+      self.dirty |= old
+      # the config says how the rows are sharded
+      self.manifest_dirty = True
+      self.generation += 1
+      self.write_db()
+      self._clear_journal()
+      if sharding == None:
+        for name in old:
+          try:
+            os.remove(self._shard_file(name))
+          except FileNotFoundError:
+            pass
+        try:
+          os.rmdir(self.shard_dir)
+        except OSError:
+          pass
+  def _link_last(self, r):
+    r.rank = self.last.rank + 1 if self.last != None else 0
+    r.prev = self.last
+    r.next = None
+    if self.last != None:
+      self.last.next = r
+    else:
+      self.first = r
+    self.last = r
+    if self.ordered != None:
+      self.ordered.append(r)
+  def _link_before(self, r, target):
+    prev = target.prev
+    r.prev = prev
+    r.next = target
+    target.prev = r
+    if prev != None:
+      prev.next = r
+      r.rank = (prev.rank + target.rank) / 2
+      if not prev.rank < r.rank < target.rank:
+        # ran out of float precision between the two, spread the ranks out again
+        self._renumber()
+    else:
+      self.first = r
+      r.rank = target.rank - 1
+    self.ordered = None
+  def _unlink(self, r):
+    if r.prev != None:
+      r.prev.next = r.next
+    else:
+      self.first = r.next
+    if r.next != None:
+      r.next.prev = r.prev
+    else:
+      self.last = r.prev
+    r.prev = None
+    r.next = None
+    self.ordered = None
+  def _renumber(self):
     idx = 0
-    for r in self.rows:
-      r[8] = idx
+    for r in self._iter_rows():
+      r.rank = idx
       idx += 1
+  def _iter_rows(self):
+    r = self.first
+    while r != None:
+      yield r
+      r = r.next
+  @property
+  def rows(self):
+    # materialized only when someone needs the whole list, after a move
+    if len(self.unloaded) > 0:
+      with self.lock:
+        for name in list(self.unloaded):
+          self._load_shard(name)
+    if self.ordered == None:
+      self.ordered = list(self._iter_rows())
+    return self.ordered
   def printall(self):
     for h in self.cfg['Fields']:
       sys.stdout.write("|{}".format(h))
     sys.stdout.write("|\n")
     for r in self.rows:
-      for v in r:
+      for v in r.values():
         sys.stdout.write("|{}".format(v))
       sys.stdout.write("|\n")
   def write_db(self):
     outver = self.outver
     if outver == None:
-      outver = self.inver
+      # a new database gets the newest version
+      outver = self.inver or max(serializer_versions)
     ser = self.serializers[outver]
-    with open(self.filename, 'w', newline = '\n') as datafile:
-      print("Version={}".format(outver), file = datafile)
-      data = {"Config": self.cfg, "Entries": self.rows}
-      ser.write_all(datafile, data)
+    with self.lock:
+      start = time.perf_counter()
+      if self.sharding != None:
+        # the manifest needs sections, only version 2 has them
+        self._write_shards('2', self.serializers['2'])
+        self._observe('write', start)
+        self._remember_file(self._file_stat(), ())
+        return
+      def write(datafile):
+        datafile.write("Version={}\n".format(outver))
+        ser.write_all(datafile, {"Config": self.cfg, "Entries": (r.values() for r in self._iter_rows())})
+      self._release_source()
+      self._replace_file(self.filename, write)
+      self._observe('write', start)
+      # our own write, the watcher shouldn't take it for an edit. lazy rows would all have
+      # to be read for it, sync() then falls back to reload_db instead
+      lazy = getattr(self.row_class, 'source', None) != None
+      self._remember_file(self._file_stat(), (r.values() for r in self._iter_rows()) if not lazy else None)
+  def _write_shards(self, outver, ser):
+    # dirty shards first, then the manifest. after a crash in between the shards hold
+    # rows the manifest doesn't know yet, those are picked up at the end of the list.
+    # the manifest is only written when the order, a type or a row's shard changed
+    os.makedirs(self.shard_dir, exist_ok = True)
+    for name in sorted(self.dirty):
+      rows = sorted(self.shards.get(name, ()), key = lambda r: r.rank)
+      if len(rows) == 0:
+        self.shards.pop(name, None)
+        self.shard_types.pop(name, None)
+        self.shard_stats.pop(name, None)
+        try:
+          os.remove(self._shard_file(name))
+        except FileNotFoundError:
+          pass
+        continue
+      self.shard_types[name] = {self._field(r, 'type').lower() for r in rows}
+      def write(datafile):
+        datafile.write("Version={}\n".format(outver))
+        ser.write_all(datafile, {"Config": {'Fields': self.cfg['Fields']}, "Entries": (r.values() for r in rows)})
+      self._replace_file(self._shard_file(name), write)
+      self.shard_stats[name] = _stat(self._shard_file(name))
+    self.dirty = set()
+    if self.manifest_dirty or not os.path.exists(self.filename):
+      def write(datafile):
+        datafile.write("Version={}\n[Config]\n".format(outver))
+        datafile.writelines("{}={};\n".format(k, ';'.join(v)) for k, v in self.cfg.items())
+        datafile.write("[Order]\n")
+        datafile.writelines("{};{};{}\n".format(_escape(self._field(r, 'id')), _escape(self._field(r, 'type')), r.shard) for r in self._iter_rows())
+      self._replace_file(self.filename, write)
+      self.manifest_dirty = False
+  def _replace_file(self, filename, write):
+    # written next to the file and renamed over it once it's on disk, a crash
+    # leaves either the old or the new file. a symlinked file stays a symlink
+    target = os.path.realpath(filename)
+    tmp = "{}.tmp".format(target)
+    with open(tmp, 'w', newline = '\n', buffering = self.write_buffer) as datafile:
+      write(datafile)
+      datafile.flush()
+      os.fsync(datafile.fileno())
+    try:
+      shutil.copymode(target, tmp)
+    except OSError:
+      pass
+    os.replace(tmp, target)
+    _sync_dir(os.path.dirname(target))
+  def _file_stat(self):
+    return _stat(self.filename)
+  def _remember_file(self, stat, entries, hashes = None):
+    # a hash per entry of what the file held when it was last read or written, sync()
+    # diffs against it. without an Id field or with duplicate ids it falls back to reload_db
+    self.file_stat = stat
+    self.file_entries = None
+    self.file_generation = self.generation
+    slot = self.slots['id']
+    if slot == None or entries == None:
+      return
+    pos = self.row_class.field_slots.index(slot)
+    file_entries = dict()
+    n = 0
+    for values, h in zip(entries, hashes) if hashes != None else ((values, hash(tuple(values))) for values in entries):
+      file_entries[values[pos] if pos < len(values) else ''] = h
+      n += 1
+    if len(file_entries) == n:
+      self.file_entries = file_entries
+  def sync(self):
+    # picks up edits made to the file behind our back (by hand, git pull) and applies only
+    # the entries that changed since it was last read or written. an edited entry replaces
+    # the row as a whole, rows added here and not written yet are kept
+    stat = self._file_stat()
+    if stat == None or (stat == self.file_stat and self.sharding == None):
+      return False
+    if self.sharding != None:
+      # rows are only read on demand, read them again the same way. a shard not read
+      # yet is read as it is once needed, only the others are looked at
+      with self.lock:
+        if stat == self.file_stat and all(_stat(self._shard_file(name)) == st for name, st in self.shard_stats.items()):
+          return False
+        return stat == self._file_stat() and self.reload_db()
+    start = time.perf_counter()
+    try:
+      source = self._open_source()
+      if source != None:
+        version = '2'
+        cfg = source.cfg
+        hashed = list(source.entries(self.lazy_fields))
+      else:
+        with FlyDbStream(self.filename) as stream:
+          version = stream.version
+          cfg = stream.cfg
+          hashed = [(values, hash(tuple(values))) for values in stream]
+    except:
+      # most likely caught halfway through a write, the next poll tries again
+      return False
+    fields = cfg.get('Fields') if cfg != None else None
+    cls = row_class(fields) if fields != None else None
+    slot = cls.slotmap.get(self.indexed['id'].lower()) if cls != None else None
+    new = dict()
+    if slot != None:
+      pos = cls.field_slots.index(slot)
+      for values, h in hashed:
+        new[values[pos] if pos < len(values) else ''] = (h, values)
+    with self.lock:
+      if stat == self.file_stat or stat != self._file_stat():
+        return False
+      kept = getattr(self.row_class, 'source', None)
+      if self.file_entries == None or slot == None or fields != self.cfg['Fields'] or len(new) != len(hashed) or \
+         (kept != None and not kept.intact()):
+        # also when the file was written in place under the rows kept, see LazySource
+        return self.reload_db()
+      old = self.file_entries
+      self.inver = version
+      self.cfg = cfg
+      changed = []
+      for id in old:
+        if not id in new and id in self.rowmap:
+          self._remove_row(self.rowmap[id])
+          changed.append(id)
+      following = None
+      for id, (h, values) in reversed(new.items()):
+        r = self.rowmap.get(id)
+        if source != None and (r == None or old.get(id) != h):
+          # rows keep reading from the source they were loaded from, changed ones are decoded
+          values = source.decode_all(values)
+        if r == None:
+          r = self.row_class(values)
+          self._insert_row(r)
+          if following != None:
+            # keep the place it has in the file
+            self._unlink(r)
+            self._link_before(r, following)
+          changed.append(id)
+        elif old.get(id) != h:
+          self._unindex_row(r)
+          if self.text_index != None:
+            self.text_index.remove(r)
+          r.assign(values)
+          self._index_row(r)
+          if self.text_index != None:
+            self.text_index.add(r)
+          changed.append(id)
+        following = r
+      reordered = [id for id in old if id in new] != [id for id in new if id in old]
+      if reordered:
+        self._reorder([self.rowmap[id] for id in new])
+      self.file_stat = stat
+      self.file_entries = {id: v[0] for id, v in new.items()}
+      self.generation += 1
+      self._notify('sync', changed, reordered)
+    self._observe('sync', start)
+    return True
+  def _reorder(self, rows):
+    # the file was reordered, follow it. rows only we know about stay at the end
+    listed = set(rows)
+    rest = [r for r in self._iter_rows() if not r in listed]
+    self.first = None
+    self.last = None
+    self.ordered = []
+    for r in rows + rest:
+      self._link_last(r)
+  def _watch_loop(self, interval):
+    while not self.watcher_stop.wait(interval):
+      try:
+        self.sync()
+      except Exception as e:
+        print("fit: watching {} failed: {}".format(self.filename, e), file = sys.stderr)
+  def start_watcher(self, interval):
+    if interval <= 0 or self.watcher != None:
+      return
+    self.watcher = threading.Thread(target = self._watch_loop, args = (interval,), daemon = True)
+    self.watcher.start()
   def get_columns(self):
     return self.cfg['Fields']
   def get_row_count(self):
-    return len(self.rows)
+    return self.count
   def get_row(self, n):
     return self.rows[n]
   def get_all_rows(self):
     return self.rows
+  def _field(self, r, name):
+    slot = self.slots[name]
+    return getattr(r, slot) if slot != None else ''
   def _row_match(self, r, type, parent, id, status):
     rv = True
     if type != None:
       if isinstance(type, str):
-        rv = rv and r[1].lower() == type.lower()
+        rv = rv and self._field(r, 'type').lower() == type.lower()
       else: # assume list
-        rv = rv and r[1].lower() in type
+        rv = rv and self._field(r, 'type').lower() in type
     if parent != None:
-      rv = rv and r[6].lower() == parent.lower()
+      rv = rv and self._field(r, 'parent').lower() == parent.lower()
     if id != None:
-      rv = rv and r[0].lower() == id.lower()
+      rv = rv and self._field(r, 'id').lower() == id.lower()
     if status != None:
-      rv = rv and r[7].lower() == status.lower()
+      rv = rv and self._field(r, 'status').lower() == status.lower()
+    return rv
+  def _index_row(self, r):
+    for name in self.indexed:
+      self.index[name].setdefault(self._field(r, name).lower(), set()).add(r)
+  def _unindex_row(self, r):
+    for name in self.indexed:
+      key = self._field(r, name).lower()
+      bucket = self.index[name].get(key)
+      if bucket != None:
+        bucket.discard(r)
+        if len(bucket) == 0:
+          del self.index[name][key]
+  def _candidates(self, type, parent, id, status):
+    # smallest index bucket able to hold every match, None if nothing narrows it down
+    buckets = []
+    for name, value in (('id', id), ('parent', parent), ('status', status)):
+      if value != None:
+        buckets.append(self.index[name].get(value.lower(), ()))
+    if isinstance(type, str):
+      buckets.append(self.index['type'].get(type.lower(), ()))
+    elif type != None:
+      merged = set()
+      for t in type:
+        merged.update(self.index['type'].get(t, ()))
+      buckets.append(merged)
+    if len(buckets) == 0:
+      return None
+    return min(buckets, key = len)
+  def _select(self, type, parent, id, status):
+    with self.lock:
+      self._load_shards_for(type, parent, id)
+      candidates = self._candidates(type, parent, id, status)
+      if candidates == None:
+        return list(self.rows)
+      rv = [r for r in candidates if self._row_match(r, type, parent, id, status)]
+    rv.sort(key = lambda r: r.rank)
     return rv
   def _make_dict(self, r, f):
     rv = dict()
     for i in range(len(f)):
       rv[f[i]] = r[i]
     return rv
-  def _field_idx(self, name):
-    idx = 0
-    for n in self.cfg['Fields']:
-      if n.lower() == name.lower():
-        return idx
-      idx += 1
-    return -1
+  def _field_slot(self, name):
+    slot = self.row_class.slotmap.get(name)
+    return slot if slot != None else self.row_class.slotmap.get(name.lower())
   def add_row_from_dict(self, row):
-    newrow = []
-    for k in self.cfg['Fields']:
-      newrow.append(self.defaults[k]())
-    newrow.append(len(self.rows))
+    newrow = self.row_class([self.defaults[k]() for k in self.cfg['Fields']])
     for k, v in row.items():
-      idx = self._field_idx(k)
-      if idx >= 0:
-        newrow[idx] = v
-    self.rows.append(newrow)
-    self.rowmap[newrow[0]] = newrow
+      slot = self._field_slot(k)
+      if slot != None:
+        setattr(newrow, slot, v)
+    with self.lock:
+      self._assign_shard(newrow)
+      self._insert_row(newrow)
+      self._record('add', dict(newrow.items()))
   def update_row_from_dict(self, row):
-    if not 'Id' in row or not row['Id'] in self.rowmap:
-      return False
-    dbrow = self.rowmap[row['Id']]
-    for k, v in row.items():
-      idx = self._field_idx(k)
-      if idx >= 0:
-        dbrow[idx] = v
+    with self.lock:
+      if not 'Id' in row or not row['Id'] in self.rowmap:
+        return False
+      dbrow = self.rowmap[row['Id']]
+      self._touch(dbrow)
+      type = self._field(dbrow, 'type')
+      self._unindex_row(dbrow)
+      if self.text_index != None:
+        self.text_index.remove(dbrow)
+      for k, v in row.items():
+        slot = self._field_slot(k)
+        if slot != None:
+          setattr(dbrow, slot, v)
+      self._index_row(dbrow)
+      if self.text_index != None:
+        self.text_index.add(dbrow)
+      if dbrow.shard != None:
+        # the manifest lists types, a new type or parent may also mean a new shard
+        self.manifest_dirty |= type != self._field(dbrow, 'type')
+        self._assign_shard(dbrow)
+      self._record('update', row)
     return True
   def get_rows(self, type = None, parent = None, id = None, status = None):
-    return [r for r in self.rows if self._row_match(r, type, parent, id, status)]
+    return self._select(type, parent, id, status)
   def get_rows_as_dict(self, type = None, parent = None, id = None, status = None):
-    return [self._make_dict(r, self.cfg['Fields']) for r in self.rows if self._row_match(r, type, parent, id, status)]
+    # rows are read only views keyed by field name, no dict is copied per row
+    return self._select(type, parent, id, status)
+  def iter_rows(self, type = None, parent = None, id = None, status = None, batch = 1000):
+    # matching rows in order without building and sorting the whole selection. the list is
+    # walked a batch at a time under the lock, a row moved in between may be seen twice or not at all
+    with self.lock:
+      self._load_shards_for(type, parent, id)
+      candidates = self._candidates(type, parent, id, status)
+      if candidates != None and len(candidates) <= batch:
+        r = None
+        matches = self._select(type, parent, id, status)
+      else:
+        r = self.first
+        matches = []
+    yield from matches
+    while r != None:
+      matches = []
+      with self.lock:
+        for i in range(batch):
+          if (candidates == None or r in candidates) and self._row_match(r, type, parent, id, status):
+            matches.append(r)
+          r = r.next
+          if r == None:
+            break
+      yield from matches
+  def search(self, query, type = None, status = None, limit = 20):
+    # ranked full text search over Title and Description, see SearchIndex.search.
+    # returns the number of matches and the best (score, row) pairs
+    with self.lock:
+      if self.text_index == None and self.search_enabled:
+        # sharded and lazy databases are indexed on the first search, that reads every row
+        start = time.perf_counter()
+        self._build_text_index()
+        self._observe('search_index', start)
+      if self.text_index == None:
+        return 0, []
+      within = []
+      if isinstance(type, str):
+        within.append(self.index['type'].get(type.lower(), ()))
+      elif type != None:
+        merged = set()
+        for t in type:
+          merged.update(self.index['type'].get(t.lower(), ()))
+        within.append(merged)
+      if status != None:
+        within.append(self.index['status'].get(status.lower(), ()))
+      start = time.perf_counter()
+      rv = self.text_index.search(query, within, limit)
+      self._observe('search', start)
+      return rv
   def get_config(self, cfgname):
     return self.cfg[cfgname]
   def get_color_config(self, cfgname):
     return self._make_dict(self.cfg["{}.Color".format(cfgname)], self.cfg[cfgname])
   def change_row(self, id, status = None):
-    self.rowmap[id][7] = status
+    with self.lock:
+      row = self.rowmap[id]
+      self._touch(row)
+      self._unindex_row(row)
+      setattr(row, self.slots['status'], status)
+      self._index_row(row)
+      self._record('status', id, status)
   def place_before(self, id_first, id_after):
-    try:
-      moving_row = self.rowmap[id_first]
-      target_row = self.rowmap[id_after] if id_after != "empty" else self.rows[-1]
-      del self.rows[moving_row[8]]
-      self.rows.insert(target_row[8], moving_row)
-      self._update_index()
-    except:
-      pass
+    with self.lock:
+      try:
+        moving_row = self.rowmap[id_first]
+        target_row = self.rowmap[id_after] if id_after != "empty" else None
+        if moving_row is target_row:
+          return
+        self._unlink(moving_row)
+        if target_row != None:
+          self._link_before(moving_row, target_row)
+        else:
+          self._link_last(moving_row)
+        if self.sharding != None:
+          # the order is kept in the manifest, shard files don't change
+          self.manifest_dirty = True
+        self._record('place', id_first, id_after)
+      except:
+        pass
+  def apply_batch(self, ops):
+    # ops are dicts of fields plus 'op': 'add', 'update' or 'move' (Id, Status and/or
+    # Before, an Id or 'empty'), without 'op' an existing Id is updated and anything else
+    # added. all of them are checked before the first is applied, a bad one raises
+    # ValueError and changes nothing. listeners hear of one 'batch' and the caller
+    # flushes once. returns the number of ops applied
+    ops = list(ops)
+    with self.lock:
+      known = set(self.rowmap)
+      checked = []
+      for n, op in enumerate(ops, 1):
+        op = dict(op)
+        name = op.pop('op', None) or ('update' if op.get('Id') in known else 'add')
+        id = op.get('Id')
+        if id != None and (not isinstance(id, str) or len(id.strip()) == 0):
+          raise ValueError("op {}: unusable Id {}".format(n, json.dumps(id)))
+        for k, v in op.items():
+          if not isinstance(v, str):
+            # every field is text, anything else fails once applied or on the next write
+            raise ValueError("op {}: {} is {}, not a string".format(n, k, json.dumps(v)))
+        if name == 'add':
+          if id in known:
+            raise ValueError("op {}: {} already exists".format(n, id))
+        elif name in ('update', 'move'):
+          if id == None:
+            raise ValueError("op {}: {} without an Id".format(n, name))
+          if not id in known:
+            raise ValueError("op {}: no such id {}".format(n, id))
+          before = op.get('Before')
+          if name == 'move' and before != None and before != 'empty' and not before in known:
+            raise ValueError("op {}: no such id {}".format(n, before))
+        else:
+          raise ValueError("op {}: unknown op {}".format(n, name))
+        if id != None:
+          known.add(id)
+        checked.append((name, op))
+      self.batching = True
+      try:
+        for name, op in checked:
+          if name == 'add':
+            self.add_row_from_dict(op)
+          elif name == 'update':
+            self.update_row_from_dict(op)
+          else:
+            if op.get('Status') != None:
+              self.change_row(op['Id'], status = op['Status'])
+            if op.get('Before') != None:
+              self.place_before(op['Id'], op['Before'])
+      finally:
+        self.batching = False
+      self._notify('batch', len(checked))
+    return len(checked)
 
 def query_split(q):
   rv = dict()
@@ -351,6 +1928,39 @@ def query_split(q):
     rv[k] = urllib.parse.unquote(v)
   return rv
 
+def read_ops(lines, format = 'jsonl'):
+  # batch ops from JSON lines or from CSV with a header row, a column left out of the
+  # header or an empty cell leaves that field alone
+  if format == 'csv':
+    for row in csv.DictReader(lines):
+      yield {k: v for k, v in row.items() if k != None and v != None and v != ''}
+    return
+  for n, line in enumerate(lines, 1):
+    if len(line.strip()) == 0:
+      continue
+    try:
+      op = json.loads(line)
+    except ValueError as e:
+      raise ValueError("line {}: {}".format(n, e))
+    if not isinstance(op, dict):
+      raise ValueError("line {}: not an object".format(n))
+    yield op
+
+def export_lines(fields, rows, format = 'jsonl'):
+  # rows as JSON lines or CSV, what read_ops reads back
+  if format == 'csv':
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator = '\n')
+    writer.writerow(fields)
+    for r in rows:
+      writer.writerow(r.values()[:len(fields)])
+      yield out.getvalue()
+      out.seek(0)
+      out.truncate()
+    return
+  for r in rows:
+    yield json.dumps(dict(r.items())) + '\n'
+
 def js_query_split(l):
   rv = dict()
   for a in l:
@@ -387,36 +1997,566 @@ def replace_all(txt, vals):
         rv += ch
   return rv
 
+_md_fence = re.compile(r'^ {0,3}(```|~~~)')
+_md_refdef = re.compile(r'^ {0,3}\[[^\]]+\]:', re.M)
+_md_listitem = re.compile(r'^ {0,3}([-*+]|\d+[.)])\s')
+_md_quote = re.compile(r'^ {0,3}>')
+_md_html = re.compile(r'^ {0,3}<[A-Za-z/!?]', re.M)
+
+def _last_paragraph(block):
+  # first line of the last paragraph of a block markdown_blocks has joined up
+  rest = block[len(block) - block[::-1].index(''):] if '' in block else block
+  return rest[0]
+
+def markdown_blocks(txt):
+  # splits txt on blank lines into blocks markdown renders independently, fenced code,
+  # indented continuations, loose lists and quotes stay with the block they belong to
+  blocks = []
+  cur = []
+  fence = None
+  for line in txt.split('\n'):
+    if fence != None:
+      cur.append(line)
+      if line.strip().startswith(fence):
+        fence = None
+      continue
+    m = _md_fence.match(line)
+    if m != None:
+      fence = m.group(1)
+    if len(line.strip()) == 0 and fence == None:
+      if len(cur) > 0:
+        blocks.append(cur)
+        cur = []
+      continue
+    if len(cur) == 0 and len(blocks) > 0 and \
+       (line[0] in ' \t' or (_md_listitem.match(line) and _md_listitem.match(blocks[-1][0])) or
+        (_md_quote.match(line) and _md_quote.match(_last_paragraph(blocks[-1])))):
+      cur = blocks.pop()
+      cur.append('')
+    cur.append(line)
+  if len(cur) > 0:
+    blocks.append(cur)
+  return ['\n'.join(b) for b in blocks]
+
+class Template(object):
+  # str.format style page text. named fields only change with the config, bind() fills them
+  # in once and gives a template with just the positional per request fields left
+  def __init__(self, text):
+    self.text = text
+    self.format = text.format
+  def bind(self, **values):
+    parts = []
+    for literal, field, spec, conv in string.Formatter().parse(self.text):
+      parts.append(literal.replace('{', '{{').replace('}', '}}'))
+      if field == None:
+        continue
+      if field in values:
+        parts.append(format(values[field], spec).replace('{', '{{').replace('}', '}}'))
+      else:
+        parts.append("{{{}{}{}}}".format(field, '!' + conv if conv else '', ':' + spec if spec else ''))
+    return Template(''.join(parts))
+  def render(self, out, *args):
+    out.append(self.format(*args))
+
+class StaticAsset(object):
+  def __init__(self, data, content_type, mtime, size):
+    self.data = data
+    self.gzipped = gzip.compress(data, mtime = 0)
+    self.content_type = content_type
+    self.mtime = mtime
+    self.size = size
+    self.etag = "\"{}\"".format(hashlib.sha1(data).hexdigest()[:16])
+    self.etag_gzipped = "{}-gz\"".format(self.etag[:-1])
+    self.last_modified = email.utils.formatdate(mtime / 1e9, usegmt = True)
+
+class AssetCache(object):
+  # files under css/ and js/ with their gzipped form, reloaded when the file changes on disk
+  content_types = {'css': 'text/css', 'js': 'application/javascript'}
+  def __init__(self, root, size = 256):
+    self.root = root
+    self.size = size
+    self.entries = dict()
+    self.lock = threading.Lock()
+  def get(self, kind, name, params = ()):
+    path = os.path.join(self.root, kind, name)
+    st = os.stat(path)
+    key = (kind, name, params)
+    with self.lock:
+      asset = self.entries.get(key)
+    if asset != None and asset.mtime == st.st_mtime_ns and asset.size == st.st_size:
+      return asset
+    with open(path, 'rb') as datafile:
+      data = datafile.read()
+    if kind == 'js' and b'$(' in data:
+      data = replace_all(data.decode('utf-8'), js_query_split(params)).encode('utf-8')
+    asset = StaticAsset(data, self.content_types[kind], st.st_mtime_ns, st.st_size)
+    with self.lock:
+      if len(self.entries) >= self.size:
+        # templated scripts are cached per parameter set, don't let page names pile up
+        self.entries.clear()
+      self.entries[key] = asset
+    return asset
+
+class FlyServerHandler(simple_server.ServerHandler):
+  http_version = '1.1'
+  chunked = False
+  def cleanup_headers(self):
+    super().cleanup_headers()
+    if not 'Content-Length' in self.headers:
+      if self.environ.get('SERVER_PROTOCOL') == 'HTTP/1.1' and not self.status[:3] in ('204', '304'):
+        # streamed responses go out chunked so the connection stays usable
+        self.headers['Transfer-Encoding'] = 'chunked'
+        self.chunked = True
+      else:
+        # no way to tell where the body ends without a length
+        self.headers['Connection'] = 'close'
+        self.request_handler.close_connection = True
+  def write(self, data):
+    if not self.headers_sent:
+      self.bytes_sent = len(data)
+      self.send_headers()
+    else:
+      self.bytes_sent += len(data)
+    if self.chunked:
+      if len(data) == 0:
+        # an empty chunk would end the body
+        return
+      data = b"%x\r\n%s\r\n" % (len(data), data)
+    self._write(data)
+    self._flush()
+  def finish_content(self):
+    super().finish_content()
+    if self.chunked:
+      self._write(b"0\r\n\r\n")
+      self._flush()
+
+class FlyRequestHandler(simple_server.WSGIRequestHandler):
+  # serves requests on one connection until the client closes it or goes idle
+  protocol_version = 'HTTP/1.1'
+  timeout = 30
+  # headers and body go out in separate writes, don't let them wait for a delayed ack
+  disable_nagle_algorithm = True
+  server_handler = FlyServerHandler
+  def handle(self):
+    self.close_connection = True
+    self.handle_one_request()
+    while not self.close_connection:
+      self.handle_one_request()
+  def handle_one_request(self):
+    try:
+      self.raw_requestline = self.rfile.readline(65537)
+    except (socket.timeout, ConnectionError):
+      self.close_connection = True
+      return
+    if len(self.raw_requestline) == 0:
+      self.close_connection = True
+      return
+    if len(self.raw_requestline) > 65536:
+      self.requestline = ''
+      self.request_version = ''
+      self.command = ''
+      self.send_error(414)
+      return
+    if not self.parse_request():
+      return
+    if self.command == 'GET' and self.path.split('?')[0].rstrip('/') == '/api/events' and self.server.events != None:
+      self.subscribe()
+      return
+    handler = self.server_handler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                                  multithread = isinstance(self.server, socketserver.ThreadingMixIn))
+    handler.request_handler = self
+    handler.run(self.server.get_app())
+  def subscribe(self):
+    # an event stream never ends, rather than keeping this thread (or the whole single
+    # threaded server) waiting on it the socket is handed over to the EventHub
+    self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\n\r\n")
+    self.wfile.flush()
+    self.log_request(200)
+    self.close_connection = True
+    self.server.detach(self.request)
+    self.server.events.subscribe(self.request, self.headers.get('Last-Event-ID'))
+
+class FlySingleRequestHandler(FlyRequestHandler):
+  # the default server, one request per connection like the stock handler
+  protocol_version = 'HTTP/1.0'
+  timeout = None
+  disable_nagle_algorithm = False
+  server_handler = simple_server.ServerHandler
+  def handle(self):
+    self.handle_one_request()
+
+class FlyWSGIServer(simple_server.WSGIServer):
+  events = None
+  # a board reconnecting its event streams shouldn't find the listen queue full
+  request_queue_size = 128
+  def server_bind(self):
+    super().server_bind()
+    self.detached = set()
+  def detach(self, request):
+    # the socket lives on somewhere else, don't close it when the handler is done
+    self.detached.add(request)
+  def shutdown_request(self, request):
+    if request in self.detached:
+      self.detached.discard(request)
+      return
+    super().shutdown_request(request)
+
+class FlyThreadingServer(socketserver.ThreadingMixIn, FlyWSGIServer):
+  daemon_threads = True
+
+class EventHub(object):
+  # server-sent events for every FlyDb change. subscribers' sockets are all served from
+  # one thread with a selector, an idle one costs a socket and nothing else
+  def __init__(self, db, keepalive = 15, backlog = 256, limit = 1 << 20):
+    self.db = db
+    self.keepalive = keepalive
+    self.limit = limit
+    self.generation = db.generation
+    self.version = "{}-{}".format(db.boot, db.generation)
+    # recent events, a reconnecting client with a Last-Event-ID gets what it missed
+    self.recent = collections.deque(maxlen = backlog)
+    self.queue = collections.deque()
+    self.clients = dict()
+    self.selector = selectors.DefaultSelector()
+    self.wakeup, self.waker = socket.socketpair()
+    self.wakeup.setblocking(False)
+    self.waker.setblocking(False)
+    self.selector.register(self.wakeup, selectors.EVENT_READ)
+    self.stopping = False
+    db.add_listener(self.publish)
+    self.thread = threading.Thread(target = self._run, daemon = True)
+    self.thread.start()
+  def publish(self, op, args, generation):
+    self._post(('event', op, args, generation))
+  def subscribe(self, sock, last_id = None):
+    self._post(('subscribe', sock, last_id))
+  def _post(self, item):
+    self.queue.append(item)
+    try:
+      self.waker.send(b'.')
+    except (BlockingIOError, OSError):
+      # already woken up, or shutting down
+      pass
+  def _message(self, event, data, id = None):
+    msg = "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+    if id != None:
+      msg = "id: {}\n{}".format(id, msg)
+    return msg.encode('utf-8')
+  def _run(self):
+    while not self.stopping:
+      ready = self.selector.select(self.keepalive)
+      if len(ready) == 0:
+        for sock in list(self.clients):
+          self._send(sock, b": keepalive\n\n")
+      for key, mask in ready:
+        sock = key.fileobj
+        if sock is self.wakeup:
+          try:
+            while sock.recv(4096):
+              pass
+          except (BlockingIOError, OSError):
+            pass
+          continue
+        if mask & selectors.EVENT_READ:
+          # a subscriber has nothing to say, readable means it went away
+          try:
+            data = sock.recv(4096)
+          except BlockingIOError:
+            data = b'.'
+          except OSError:
+            data = b''
+          if len(data) == 0:
+            self._drop(sock)
+            continue
+        if mask & selectors.EVENT_WRITE and sock in self.clients:
+          self._send(sock, b'')
+      while len(self.queue) > 0:
+        item = self.queue.popleft()
+        if item[0] == 'event':
+          op, args, generation = item[1:]
+          self.generation = generation
+          self.version = "{}-{}".format(self.db.boot, generation)
+          msg = self._message(op, {'op': op, 'args': args}, self.version)
+          self.recent.append((generation, msg))
+          for sock in list(self.clients):
+            self._send(sock, msg)
+        elif item[0] == 'subscribe':
+          self._add(item[1], item[2])
+  def _add(self, sock, last_id):
+    sock.setblocking(False)
+    self.clients[sock] = b''
+    self.selector.register(sock, selectors.EVENT_READ)
+    missed = self._missed(last_id)
+    if missed == None:
+      # nothing to resume from, tell the client where things stand so it can refetch
+      self._send(sock, self._message('hello', {'version': "\"{}\"".format(self.version)}, self.version))
+    else:
+      self._send(sock, b''.join(missed))
+  def _missed(self, last_id):
+    if last_id == None:
+      return None
+    boot, _, generation = last_id.partition('-')
+    try:
+      generation = int(generation)
+    except ValueError:
+      return None
+    if boot != self.db.boot or generation > self.generation:
+      return None
+    if generation < self.generation and (len(self.recent) == 0 or self.recent[0][0] > generation + 1):
+      # more happened than is kept around
+      return None
+    return [msg for g, msg in self.recent if g > generation]
+  def _send(self, sock, data):
+    buf = self.clients.get(sock)
+    if buf == None:
+      return
+    buf += data
+    try:
+      sent = sock.send(buf) if len(buf) > 0 else 0
+    except BlockingIOError:
+      sent = 0
+    except OSError:
+      self._drop(sock)
+      return
+    buf = buf[sent:]
+    if len(buf) > self.limit:
+      # not reading, let it reconnect and catch up from its Last-Event-ID
+      self._drop(sock)
+      return
+    self.clients[sock] = buf
+    self.selector.modify(sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if len(buf) > 0 else 0))
+  def _drop(self, sock):
+    self.clients.pop(sock, None)
+    try:
+      self.selector.unregister(sock)
+    except (KeyError, ValueError):
+      pass
+    try:
+      sock.close()
+    except OSError:
+      pass
+  def count(self):
+    return len(self.clients)
+  def close(self):
+    self.stopping = True
+    self._post(('stop',))
+    self.thread.join()
+    for sock in list(self.clients):
+      self._drop(sock)
+    self.selector.close()
+    self.wakeup.close()
+    self.waker.close()
+
+class Histogram(object):
+  # counts per bucket of seconds, made cumulative when rendered
+  buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+  def __init__(self):
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+  def observe(self, seconds):
+    self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+    self.sum += seconds
+
+class Metrics(object):
+  # histograms by family name and label value, served in the Prometheus text format
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.families = collections.OrderedDict()
+  def family(self, name, help, label = None):
+    with self.lock:
+      if not name in self.families:
+        self.families[name] = (help, label, collections.OrderedDict())
+  def observe(self, name, value, seconds):
+    histograms = self.families[name][2]
+    with self.lock:
+      h = histograms.get(value)
+      if h == None:
+        h = histograms[value] = Histogram()
+      h.observe(seconds)
+  def render(self, gauges = []):
+    # gauges are (name, help, value)
+    out = []
+    with self.lock:
+      for name, (help, label, histograms) in self.families.items():
+        out.append("# HELP {} {}\n# TYPE {} histogram\n".format(name, help, name))
+        for value, h in histograms.items():
+          labels = "{}=\"{}\",".format(label, value.replace('\\', '\\\\').replace('"', '\\"')) if label != None else ''
+          total = 0
+          for le, n in zip(h.buckets + ('+Inf',), h.counts):
+            total += n
+            out.append("{}_bucket{{{}le=\"{}\"}} {}\n".format(name, labels, le, total))
+          labels = "{{{}}}".format(labels[:-1]) if label != None else ''
+          out.append("{}_sum{} {}\n{}_count{} {}\n".format(name, labels, h.sum, name, labels, total))
+    for name, help, value in gauges:
+      out.append("# HELP {} {}\n# TYPE {} gauge\n{} {}\n".format(name, help, name, name, value))
+    return ''.join(out)
+
+class MarkdownCache(object):
+  # rendered html keyed on a hash of the source, so edited rows simply miss.
+  # when version() changes, e.g. the commits extensions link to, everything is dropped
+  def __init__(self, size = 1024, extensions = [], version = None, metrics = None):
+    self.size = size
+    self.metrics = metrics
+    if metrics != None:
+      metrics.family('fit_markdown_seconds', 'Time spent rendering markdown that missed the cache.')
+    self.entries = collections.OrderedDict()
+    self.md = markdown.Markdown(extensions=[WikiLinkExtension(base_url='http://localhost/wiki/')] + extensions)
+    self.lock = threading.Lock()
+    self.version = version
+    self.seen_version = None
+    self.hits = 0
+    self.misses = 0
+  def render(self, txt):
+    key = hashlib.sha1(txt.encode('utf-8')).digest()
+    with self.lock:
+      if self.version != None and self.version() != self.seen_version:
+        self.seen_version = self.version()
+        self.entries.clear()
+      html = self.entries.get(key)
+      if html != None:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return html
+      self.misses += 1
+      start = time.perf_counter()
+      html = self.md.reset().convert(txt)
+      if self.metrics != None:
+        self.metrics.observe('fit_markdown_seconds', None, time.perf_counter() - start)
+      self.entries[key] = html
+      if len(self.entries) > self.size:
+        self.entries.popitem(last = False)
+    return html
+  def render_blocks(self, txt):
+    # only blocks that changed since the last render miss the cache. reference style
+    # links need the whole document and raw html may span blank lines, documents with
+    # either are rendered in one go
+    if _md_refdef.search(txt) or _md_html.search(txt):
+      return self.render(txt)
+    return '\n'.join(self.render(b) for b in markdown_blocks(txt))
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
+
 class FlyServer(object):
-  def __init__(self, dbfile, port = 80):
+  page_head = Template("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"UTF-8\">\n<title>{0}</title>\n"
+                       "<link rel=\"stylesheet\" href=\"/css/default.css\">\n{1}"
+                       "<script src=\"/js/default.js\"></script>\n{2}</head>\n<body onload=\"reload()\">\n{3}")
+  board_blob = Template("<div class=\"flyb-blob\" draggable=\"true\" ondragstart=\"drag(event)\" onclick=\"showIssue(\'{0}\')\" "
+                        "id=\"{0}\" style=\"background-color: {1}\"><div>{2}<p class=\"tiny\">{3}</p></div></div>")
+  issue_page = Template("<div><h3>{0}</h3>{1}<div style=\"display: none;\" id=\"edit_issue\">"
+                        "<form method=\"post\" target=\"formtarget\" onsubmit=\"submitIssue(\'{2}\')\" id=\"frm-issue\">{options}"
+                        "<input id=\"frm-Id\" type=\"hidden\" value=\"{3}\">"
+                        "<input id=\"frm-Title\" type=\"text\" value=\"{0}\" size=\"60\"><br>"
+                        "<textarea id=\"frm-Description\" cols=\"50\" rows=\"10\">{4}</textarea>\n"
+                        "<br><input type=\"submit\" value=\"Save\"></form></div><button id=\"btn-edit\" onclick=\"toggleEdit(\'{5}\')\">Edit</button>"
+                        "<h4>Comments</h4>\n")
+  issue_comment = Template("<p class=\"small\">{0}</p><p class=\"small\">{1}</p>")
+  issue_comment_form = Template("<form method=\"post\" target=\"formtarget\" onsubmit=\"submitComment(\'{0}\')\" id=\"frm-comment\">"
+                                "<textarea id=\"comment-Description\" cols=\"50\" rows=\"10\"></textarea>\n"
+                                "<br><input type=\"submit\" value=\"Add comment\"></form>")
+  list_link = Template("<tr><td><a href=\"/list/{0}\">{1}</a></td></tr>")
+  wiki_edit_page = Template("<iframe width=\"0\" height=\"0\" border=\"0\" name=\"formtarget\" id=\"formtarget\"></iframe>"
+                            "<h2>Edit {0}</h2><div id=\"preview\"></div>\n"
+                            "<hr><form target=\"formtarget\" method=\"post\">"
+                            "<textarea id=\"desc\" name=\"Description\" rows=\"20\" cols=\"60\" "
+                            "onkeyup=\"updatePreview()\" onchange=\"updatePreview()\">{1}</textarea><br>"
+                            "\n<button onclick=\"savePage(\'{0}\', true)\">Save & Close</button>"
+                            "<button onclick=\"savePage(\'{0}', false)\">Save</button>"
+                            "<button onclick=\"window.location.replace('/wiki/{0}')\">Cancel</button>\n"
+                            "</form></body></html>")
+  wiki_link = Template("<div><a href=\"/wiki/{0}\">{0}</a></div>")
+  git_commit = Template("<div><p class=\"tiny\"><a href=\"/git/{0}\">{1}</a> {2} {3}</p>{4}</div><hr>\n")
+  def __init__(self, dbfile, port = 80, journal = False, compact_interval = 30, threaded = False, watch_interval = 1, search_cache = False,
+               write_delay = 0, metrics = True, profile = 0, shard = None, lazy = False, snapshot = False, outver = None):
     self.fit_path = sys.path[0]
-    self.db = FlyDb(dbfile)
+    self.metrics = Metrics() if metrics else None
+    if self.metrics != None:
+      self.metrics.family('fit_request_seconds', 'Time to answer a request, by route.', 'route')
+    # profile = n runs one request in n under cProfile, stats are kept per route
+    self.profile = profile
+    self.profiles = dict()
+    self.profiling = threading.RLock()
+    self.requests = itertools.count()
+    self.db = FlyDb(dbfile, journal = journal, search = True, search_cache = search_cache, write_delay = write_delay,
+                    metrics = self.metrics, lazy = lazy, snapshot = snapshot, outver = outver)
+    if shard != None:
+      self.db.reshard(shard)
+    self.db.start_compactor(compact_interval)
+    self.db.start_watcher(watch_interval)
+    self.git = Git(os.path.dirname(os.path.abspath(dbfile)))
+    self.git.refresh()
+    self.md_cache = MarkdownCache(extensions = [GitHashExtension(self.git)], version = self._git_version, metrics = self.metrics)
+    self.assets = AssetCache(self.fit_path)
+    # newest preview seq per editor, the editors not heard from longest are forgotten first
+    self.previews = collections.OrderedDict()
+    self.previews_size = 256
+    self.previews_lock = threading.Lock()
     #self.db.printall()
     self.port = port
     self.option_elems = ['Type', 'Status']
     self.text_elems = [('Title', 'simple'), ('Description', 'multi')]
     self.views = [('Kanban', '/kanban'), ('List', '/list'), ('Wiki', '/wiki'), ('Git', '/git')]
+    # the nav bar of every view, '' for pages that aren't one of them
+    self.navs = {v.lower(): self._add_header_for(v) for v in [''] + [v[0] for v in self.views]}
+    self.fragments = dict()
+    self.fragments_cfg = None
+    self.page_size = 100
+    self.stream_batch = 500
     self.handlers = {'/': self._redirect_to('/kanban'), '/kanban': self._kanban, '/list': self._list, '/wiki': self._wiki, '/git': self._git,
                      '/api': self._api, '/favicon.ico': self._favicon, '/css': self._css, '/js': self._js}
     self.api_handlers = {'status': self._api_status, 'move': self._api_move, 'add': self._api_add, 'reload': self._api_reload,
-                         'md': self._api_md, 'issue': self._api_issue}
-    self.httpd = simple_server.make_server('', self.port, self._serve)
+                         'md': self._api_md, 'issue': self._api_issue, 'cache': self._api_cache, 'board': self._api_board,
+                         'version': self._api_version, 'events': self._api_events, 'search': self._api_search,
+                         'metrics': self._api_metrics, 'profile': self._api_profile, 'batch': self._api_batch,
+                         'export': self._api_export}
+    if threaded:
+      self.httpd = simple_server.make_server('', self.port, self._serve, server_class = FlyThreadingServer,
+                                             handler_class = FlyRequestHandler)
+    else:
+      self.httpd = simple_server.make_server('', self.port, self._serve, server_class = FlyWSGIServer,
+                                             handler_class = FlySingleRequestHandler)
+    self.events = EventHub(self.db)
+    self.httpd.events = self.events
   def _css(self, args, request_data, environ, respond):
     # '/css/default.css'
     # '/css/'
     # ['css', '']
-    with open("{}/css/{}".format(self.fit_path, args[1]), 'rb') as datafile:
-      data = datafile.read()
-    respond('200 OK', [('Content-Type', 'text/css')])
-    return [data]
+    return self._asset('css', args[1], (), environ, respond)
   def _js(self, args, request_data, environ, respond):
     # '/js/default.js'
     # '/js/WikiPage/wiki.js'
-    print("QS: {}".format(args))
-    with open("{}/js/{}".format(self.fit_path, args[-1]), 'r') as datafile:
-      data = datafile.read()
-    respond('200 OK', [('Content-Type', 'text/css')])
-    return [replace_all(data, js_query_split(args[1:-1])).encode('utf-8')]
+    return self._asset('js', args[-1], tuple(args[1:-1]), environ, respond)
+  def _asset(self, kind, name, params, environ, respond):
+    try:
+      asset = self.assets.get(kind, name, params)
+    except (FileNotFoundError, IsADirectoryError):
+      respond('404 Not Found', [('Content-Type', 'text/plain')])
+      return [b'not found']
+    use_gzip = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+    headers = [('ETag', asset.etag_gzipped if use_gzip else asset.etag), ('Last-Modified', asset.last_modified),
+               ('Cache-Control', 'no-cache'), ('Vary', 'Accept-Encoding')]
+    inm = environ.get('HTTP_IF_NONE_MATCH')
+    ims = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if inm != None:
+      tags = [t.strip() for t in inm.split(',')]
+      not_modified = asset.etag in tags or asset.etag_gzipped in tags or '*' in tags
+    elif ims != None:
+      try:
+        not_modified = email.utils.parsedate_to_datetime(ims).timestamp() >= asset.mtime // 1000000000
+      except (TypeError, ValueError):
+        not_modified = False
+    else:
+      not_modified = False
+    if not_modified:
+      respond('304 Not Modified', headers)
+      return [b'']
+    headers.append(('Content-Type', asset.content_type))
+    if use_gzip:
+      headers.append(('Content-Encoding', 'gzip'))
+      respond('200 OK', headers)
+      return [asset.gzipped]
+    respond('200 OK', headers)
+    return [asset.data]
   def _api(self, args, request_data, environ, respond):
     #try:
     f = self.api_handlers[args[1].lower()]
@@ -429,71 +2569,204 @@ class FlyServer(object):
     return [b'404 Not Found']
   def _api_add(self, args, request_data, environ, respond):
     qd = query_split(request_data.decode('utf-8'))
-    if 'Id' in qd:
-      self.db.update_row_from_dict(qd)
-    else:
-      self.db.add_row_from_dict(qd)
-    self.db.write_db()
+    with self.db.lock:
+      if 'Id' in qd:
+        self.db.update_row_from_dict(qd)
+      else:
+        self.db.add_row_from_dict(qd)
+      self.db.flush()
     respond('200 OK', [('Content-Type', 'text/html'), ('Access-Control-Allow-Origin', '*')])
     return [b'']
+  def _api_batch(self, args, request_data, environ, respond):
+    # POST a JSON line per op (or CSV with ?format=csv or Content-Type: text/csv), all of them
+    # are applied and written once, or none if one is bad. see FlyDb.apply_batch
+    qd = query_split(environ.get('QUERY_STRING', '')) if len(environ.get('QUERY_STRING', '')) > 0 else dict()
+    csv_body = qd.get('format') == 'csv' or environ.get('CONTENT_TYPE', '').startswith('text/csv')
+    try:
+      lines = request_data.decode('utf-8').splitlines(True)
+      with self.db.lock:
+        n = self.db.apply_batch(read_ops(lines, 'csv' if csv_body else 'jsonl'))
+        self.db.flush()
+    except (ValueError, AttributeError) as e:
+      respond('400 Bad Request', [('Content-Type', 'application/json'), ('Access-Control-Allow-Origin', '*')])
+      return [json.dumps({'error': str(e)}).encode('utf-8')]
+    respond('200 OK', [('Content-Type', 'application/json'), ('Access-Control-Allow-Origin', '*')])
+    return [json.dumps({'applied': n}).encode('utf-8')]
+  def _api_export(self, args, request_data, environ, respond):
+    # '/api/export?format=csv&type=todo,bug&status=wip', every matching row in board order
+    # as JSON lines (the default) or CSV, streamed as the rows are read
+    qd = query_split(request_data) if type(request_data) == str and len(request_data) > 0 else dict()
+    format = 'csv' if qd.get('format') == 'csv' else 'jsonl'
+    types = qd.get('type')
+    rows = self.db.iter_rows(type = types.lower().split(',') if types else None, status = qd.get('status') or None)
+    respond('200 OK', [('Content-Type', 'text/csv' if format == 'csv' else 'application/x-ndjson'),
+                       ('Access-Control-Allow-Origin', '*')])
+    return self._export(export_lines(self.db.get_columns(), rows, format))
+  def _export(self, lines):
+    out = []
+    for line in lines:
+      out.append(line)
+      if len(out) >= self.stream_batch:
+        yield ''.join(out).encode('utf-8')
+        out = []
+    yield ''.join(out).encode('utf-8')
   def _api_reload(self, args, request_data, environ, respond):
-    self.db.reload_db()
+    self.db.sync()
     respond('200 OK', [('Content-Type', 'text/html'), ('Access-Control-Allow-Origin', '*')])
     return [b'']
   def _api_move(self, args, request_data, environ, respond):
-    self.db.change_row(args[1], status = args[2])
-    if len(args) > 3:
-      self.db.place_before(args[1], args[3])
-    self.db.write_db()
+    with self.db.lock:
+      self.db.change_row(args[1], status = args[2])
+      if len(args) > 3:
+        self.db.place_before(args[1], args[3])
+      self.db.flush()
     respond('200 OK', [('Content-Type', 'text/html'), ('Access-Control-Allow-Origin', '*')])
     return [b'']
+  def _board_blob(self, row, type_color):
+    return self.board_blob.format(row['Id'], type_color[row['Type']], row['Title'], row['Description'])
   def _api_status(self, args, request_data, environ, respond):
     type_color = self.db.get_color_config("Type")
-    doc = ""
-    for row in self.db.get_rows_as_dict(type = ['todo', 'bug'], status = args[1]):
-      doc += "<div class=\"flyb-blob\" draggable=\"true\" ondragstart=\"drag(event)\" onclick=\"showIssue(\'{}\')\" ".format(row['Id'])
-      doc += "id=\"{}\" style=\"background-color: {}\"><div>{}<p class=\"tiny\">{}</p></div></div>".format(row['Id'], type_color[row['Type']], row['Title'], row['Description'])
-    doc += "<div id=\"empty\">&nbsp;</div>"
+    blob = self._board_blob
+    out = [blob(row, type_color) for row in self.db.get_rows_as_dict(type = ['todo', 'bug'], status = args[1])]
+    out.append("<div id=\"empty\">&nbsp;</div>")
     respond('200 OK', [('Content-Type', 'text/html'), ('Access-Control-Allow-Origin', '*')])
-    return [doc.encode('utf-8')]
+    return [''.join(out).encode('utf-8')]
+  def _api_board(self, args, request_data, environ, respond):
+    # every column in one response, {status: html}
+    etag = "\"{}-{}\"".format(self.db.boot, self.db.generation)
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache'), ('Access-Control-Allow-Origin', '*')]
+    if environ.get('HTTP_IF_NONE_MATCH') == etag:
+      respond('304 Not Modified', headers)
+      return [b'']
+    type_color = self.db.get_color_config("Type")
+    with self.db.lock:
+      etag = "\"{}-{}\"".format(self.db.boot, self.db.generation)
+      all_status = self.db.get_config("Status")
+      columns = {s.lower(): [] for s in all_status}
+      for row in self.db.get_rows_as_dict(type = ['todo', 'bug']):
+        column = columns.get(row['Status'].lower())
+        if column != None:
+          column.append(self._board_blob(row, type_color))
+    board = {s: "{}<div id=\"empty\">&nbsp;</div>".format(''.join(columns[s.lower()])) for s in all_status}
+    headers[0] = ('ETag', etag)
+    respond('200 OK', [('Content-Type', 'application/json')] + headers)
+    return [json.dumps(board).encode('utf-8')]
+  def _api_version(self, args, request_data, environ, respond):
+    # the ETag /api/board would answer with right now, open boards poll this and only
+    # fetch the board when it moved on
+    respond('200 OK', [('Content-Type', 'application/json'), ('Cache-Control', 'no-cache'), ('Access-Control-Allow-Origin', '*')])
+    return [json.dumps({'version': "\"{}-{}\"".format(self.db.boot, self.db.generation)}).encode('utf-8')]
+  def _api_events(self, args, request_data, environ, respond):
+    # FlyRequestHandler takes the stream over before it gets here, other servers can't hold it
+    respond('503 Service Unavailable', [('Content-Type', 'text/plain'), ('Access-Control-Allow-Origin', '*')])
+    return [b'event stream not available']
+  def _api_search(self, args, request_data, environ, respond):
+    # '/api/search?q=kanban+board*&type=todo,bug&status=wip&limit=20', every word has to
+    # match, a trailing '*' matches words starting with it
+    try:
+      # the query string on a GET, the body of a POST
+      if isinstance(request_data, bytes):
+        request_data = request_data.decode('utf-8')
+      qd = query_split(request_data.replace('+', ' ')) if len(request_data) > 0 else dict()
+      limit = int(qd.get('limit', 20))
+    except ValueError:
+      respond('400 Bad Request', [('Content-Type', 'text/plain'), ('Access-Control-Allow-Origin', '*')])
+      return [b'bad query']
+    types = qd.get('type')
+    total, found = self.db.search(qd.get('q', ''), type = types.lower().split(',') if types else None,
+                                  status = qd.get('status') or None, limit = max(limit, 0))
+    results = [{'id': r['Id'], 'type': r['Type'], 'status': r['Status'], 'title': r['Title'], 'parent': r['Parent'],
+                'score': round(score, 3)} for score, r in found]
+    respond('200 OK', [('Content-Type', 'application/json'), ('Cache-Control', 'no-cache'), ('Access-Control-Allow-Origin', '*')])
+    return [json.dumps({'total': total, 'results': results}).encode('utf-8')]
+  def _api_metrics(self, args, request_data, environ, respond):
+    if self.metrics == None:
+      respond('404 Not Found', [('Content-Type', 'text/plain'), ('Access-Control-Allow-Origin', '*')])
+      return [b'metrics are off']
+    md = self.md_cache.stats()
+    gauges = [('fit_rows', 'Rows in the database.', self.db.count),
+              ('fit_generation', 'Changes since the database was loaded.', self.db.generation),
+              ('fit_markdown_cache_hits', 'Markdown renders answered from the cache.', md['hits']),
+              ('fit_markdown_cache_misses', 'Markdown renders that missed the cache.', md['misses']),
+              ('fit_event_subscribers', 'Open /api/events streams.', self.events.count())]
+    respond('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Cache-Control', 'no-cache'), ('Access-Control-Allow-Origin', '*')])
+    return [self.metrics.render(gauges).encode('utf-8')]
+  def _api_profile(self, args, request_data, environ, respond):
+    # '/api/profile' lists the profiled routes, '/api/profile/api/board' shows where the time went
+    route = '/' + '/'.join(args[1:])
+    with self.profiling:
+      if route == '/':
+        text = ''.join("{} {} requests\n".format(r, n) for r, (stats, n) in sorted(self.profiles.items()))
+      elif route in self.profiles:
+        out = io.StringIO()
+        stats, n = self.profiles[route]
+        out.write("{} requests\n".format(n))
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(40)
+        text = out.getvalue()
+      else:
+        text = 'not profiled (yet), start fit with --profile\n'
+    respond('200 OK', [('Content-Type', 'text/plain'), ('Cache-Control', 'no-cache'), ('Access-Control-Allow-Origin', '*')])
+    return [text.encode('utf-8')]
+  def _api_cache(self, args, request_data, environ, respond):
+    respond('200 OK', [('Content-Type', 'application/json'), ('Access-Control-Allow-Origin', '*')])
+    return [json.dumps({'markdown': self.md_cache.stats(), 'events': {'subscribers': self.events.count()}}).encode('utf-8')]
   def _api_md(self, args, request_data, environ, respond):
+    # '/api/md' renders the whole text
+    # '/api/md/<editor>/<seq>' is a live preview, a request older than the newest
+    # one seen from the same editor is dropped with 204
+    if len(args) < 3:
+      respond('200 OK', [('Content-Type', 'text/html'), ('Access-Control-Allow-Origin', '*')])
+      return [self._encode_wiki(request_data.decode('utf-8')).encode('utf-8')]
+    editor = args[1]
+    try:
+      seq = int(args[2])
+    except ValueError:
+      respond('400 Bad Request', [('Content-Type', 'text/plain'), ('Access-Control-Allow-Origin', '*')])
+      return [b'bad sequence number']
+    with self.previews_lock:
+      stale = seq < self.previews.get(editor, -1)
+      if not stale:
+        self.previews[editor] = seq
+        self.previews.move_to_end(editor)
+        if len(self.previews) > self.previews_size:
+          self.previews.popitem(last = False)
+    if stale:
+      respond('204 No Content', [('Access-Control-Allow-Origin', '*')])
+      return [b'']
+    doc = self.md_cache.render_blocks(request_data.decode('utf-8'))
+    if seq < self.previews.get(editor, -1):
+      respond('204 No Content', [('Access-Control-Allow-Origin', '*')])
+      return [b'']
     respond('200 OK', [('Content-Type', 'text/html'), ('Access-Control-Allow-Origin', '*')])
-    return [self._encode_wiki(request_data.decode('utf-8')).encode('utf-8')]
+    return [doc.encode('utf-8')]
   def _api_issue(self, args, request_data, environ, respond):
-    doc = ""
+    out = []
     for row in self.db.get_rows_as_dict(type = ['todo', 'bug'], id = args[1]):
-      doc += "<div><h3>{}</h3>{}".format(row['Title'], self._encode_wiki(row['Description']))
-      doc += "<div style=\"display: none;\" id=\"edit_issue\">"
-      doc += "<form method=\"post\" target=\"formtarget\" onsubmit=\"submitIssue(\'{}\')\" id=\"frm-issue\">".format(args[1])
-      doc += "\n    <table>\n      <tr>\n"
-      for oe in self.option_elems:
-        doc += "        <td>{}</td>".format(oe)
-      doc += "      </tr>\n      <tr>\n"
-      for oe in self.option_elems:
-        doc += "        <td><select id=\"frm-{0}\" name=\"{0}\">".format(oe)
-        for opt in self.db.get_config(oe):
-          doc += "<option value=\"{0}\">{0}</option>".format(opt)
-        doc += "</td>\n"
-      doc += "      </tr>\n    </table>\n"
-      doc += "<input id=\"frm-Id\" type=\"hidden\" value=\"{0}\">".format(row['Id'])
-      doc += "<input id=\"frm-Title\" type=\"text\" value=\"{0}\" size=\"60\"><br>".format(row['Title'])
-      doc += "<textarea id=\"frm-Description\" cols=\"50\" rows=\"10\">{}</textarea>\n".format(row['Description'])
-      doc += "<br><input type=\"submit\" value=\"Save\"></form></div><button id=\"btn-edit\" onclick=\"toggleEdit(\'{}\')\">Edit</button>".format(row['Status'])
-      doc += "<h4>Comments</h4>\n"
+      page = self._fragment('issue', lambda: self.issue_page.bind(options = self._option_table()))
+      page.render(out, row['Title'], self._encode_wiki(row['Description']), args[1], row['Id'], row['Description'], row['Status'])
       for comment in self.db.get_rows_as_dict(type = ['comment'], parent = args[1]):
-        doc += "<p class=\"small\">{}</p><p class=\"small\">{}</p>".format(comment['Created'], self._encode_wiki(comment['Description']))
-      doc += "<form method=\"post\" target=\"formtarget\" onsubmit=\"submitComment(\'{}\')\" id=\"frm-comment\">".format(args[1])
-      doc += "<textarea id=\"comment-Description\" cols=\"50\" rows=\"10\"></textarea>\n"
-      doc += "<br><input type=\"submit\" value=\"Add comment\"></form>"
+        self.issue_comment.render(out, comment['Created'], self._encode_wiki(comment['Description']))
       # add comment form
-    doc += "\n</div><div><hr><button onclick=\"closeIssue()\">Close</button></div>\n"
+      self.issue_comment_form.render(out, args[1])
+    out.append("\n</div><div><hr><button onclick=\"closeIssue()\">Close</button></div>\n")
     respond('200 OK', [('Content-Type', 'text/html'), ('Access-Control-Allow-Origin', '*')])
-    return [doc.encode('utf-8')]
+    return [''.join(out).encode('utf-8')]
   def _redirect_to(self, view):
     return lambda args, request_data, environ, respond: self._redirect(view, args, request_data, environ, respond)
   def _redirect(self, view, args, request_data, environ, respond):
     respond('301 Moved Permanently', [('Location', view), ('Access-Control-Allow-Origin', '*')])
     return [b'301 Moved Permanently']
+  def _fragment(self, name, build):
+    # html that only depends on the config, built once and dropped when the config changes
+    if self.db.cfg != self.fragments_cfg:
+      self.fragments_cfg = {k: list(v) for k, v in self.db.cfg.items()}
+      self.fragments = dict()
+    frag = self.fragments.get(name)
+    if frag == None:
+      frag = build()
+      self.fragments[name] = frag
+    return frag
   def _add_header_for(self, self_view):
     doc = "<div class=\"flyb-header\">"
     for v in self.views:
@@ -503,138 +2776,150 @@ class FlyServer(object):
         doc += "<div>{}</div>".format(v[0])
     doc += "</div>\n"
     return doc
-  def _provide_header_for(self, self_view, support_drag_drop = False, additional_scripts = []):
-    doc = "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"UTF-8\">\n<title>{}</title>\n".format(self_view)
-    doc += "<link rel=\"stylesheet\" href=\"/css/default.css\">\n"
-    if support_drag_drop:
-      doc += "<link rel=\"stylesheet\" href=\"/css/drag.css\">\n"
-    doc += "<script src=\"/js/default.js\"></script>\n"
-    if support_drag_drop:
-      doc += "<script src=\"/js/drag.js\"></script>\n"
-    for s in additional_scripts:
-      doc += "<script src=\"/js/{}\"></script>\n".format(s)
-    doc += "</head>\n<body onload=\"reload()\">\n"
-    doc += self._add_header_for(self_view)
-    return doc
+  def _provide_header_for(self, out, self_view, support_drag_drop = False, additional_scripts = []):
+    styles = "<link rel=\"stylesheet\" href=\"/css/drag.css\">\n" if support_drag_drop else ""
+    scripts = ["<script src=\"/js/drag.js\"></script>\n"] if support_drag_drop else []
+    scripts.extend("<script src=\"/js/{}\"></script>\n".format(s) for s in additional_scripts)
+    self.page_head.render(out, self_view, styles, ''.join(scripts), self.navs.get(self_view.lower(), self.navs['']))
   def _text_elem(self, te):
     if te[1] == 'multi':
       return "<textarea id=\"frm-{0}\" name=\"{0}\" rows=\"10\" cols=\"60\"></textarea>".format(te[0])
     return "<input id=\"frm-{0}\" type=\"text\" name=\"{0}\" size=\"60\">".format(te[0])
-  def _provide_form_add_html(self):
-    doc = "\n<iframe width=\"0\" height=\"0\" border=\"0\" name=\"formtarget\" id=\"formtarget\"></iframe>"
-    doc += "\n<div id=\"add_issue\" class=\"overlay\">\n<div class=\"flyb-form\"><h2>Add issue</h2>\n<div class=\"flyb-header\">\n" \
-           "<form id=\"frm-add\" onsubmit=\"submitIssue(null)\" target=\"formtarget\" method=\"post\">\n    <table>\n      <tr>\n"
+  def _option_table(self):
+    out = ["\n    <table>\n      <tr>\n"]
+    out.extend("        <td>{}</td>".format(oe) for oe in self.option_elems)
+    out.append("      </tr>\n      <tr>\n")
     for oe in self.option_elems:
-      doc += "        <td>{}</td>".format(oe)
-    doc += "      </tr>\n      <tr>\n"
-    for oe in self.option_elems:
-      doc += "        <td><select id=\"frm-{0}\" name=\"{0}\">".format(oe)
-      for opt in self.db.get_config(oe):
-        doc += "<option value=\"{0}\">{0}</option>".format(opt)
-      doc += "</td>\n"
-    doc += "      </tr>\n    </table>\n"
-    for te in self.text_elems:
-      doc += "    <div>{0}</div>{1}<br>".format(te[0], self._text_elem(te))
-    doc += "    <input type=\"submit\" value=\"Add issue\" onclick=\"closeAdd()\">&nbsp;<input type=\"reset\" value=\"Cancel\" onclick=\"closeAdd()\">\n"
-    doc += "  </form>\n  </div>\n</div></div>"
-    return doc
+      out.append("        <td><select id=\"frm-{0}\" name=\"{0}\">".format(oe))
+      out.extend("<option value=\"{0}\">{0}</option>".format(opt) for opt in self.db.get_config(oe))
+      out.append("</td>\n")
+    out.append("      </tr>\n    </table>\n")
+    return ''.join(out)
+  def _provide_form_add_html(self):
+    return self._fragment('form_add', self._build_form_add_html)
+  def _build_form_add_html(self):
+    out = ["\n<iframe width=\"0\" height=\"0\" border=\"0\" name=\"formtarget\" id=\"formtarget\"></iframe>"
+           "\n<div id=\"add_issue\" class=\"overlay\">\n<div class=\"flyb-form\"><h2>Add issue</h2>\n<div class=\"flyb-header\">\n"
+           "<form id=\"frm-add\" onsubmit=\"submitIssue(null)\" target=\"formtarget\" method=\"post\">", self._option_table()]
+    out.extend("    <div>{0}</div>{1}<br>".format(te[0], self._text_elem(te)) for te in self.text_elems)
+    out.append("    <input type=\"submit\" value=\"Add issue\" onclick=\"closeAdd()\">&nbsp;<input type=\"reset\" value=\"Cancel\" onclick=\"closeAdd()\">\n"
+               "  </form>\n  </div>\n</div></div>")
+    return ''.join(out)
   def _kanban(self, args, request_data, environ, respond):
+    # the columns are filled in by /api/board, so the page itself only changes with the config
+    page = self._fragment('kanban', self._build_kanban)
+    respond('200 OK', [('Content-Type', 'text/html')])
+    return [page]
+  def _build_kanban(self):
     status_color = self.db.get_color_config("Status")
     all_status = self.db.get_config("Status")
-    doc = self._provide_header_for('Kanban', True, ['kanban.js'])
-    doc += "\n<div id=\"view_issue\" class=\"overlay\"></div>"
-    doc += self._provide_form_add_html()
-    doc += "<div class=\"flyb-title\">"
-    for s in all_status:
-      doc += "<div class=\"flyb-column\"><div>{}</div></div>".format(s)
-    doc += "</div>\n<div class=\"flyb-row\">\n"
+    out = []
+    self._provide_header_for(out, 'Kanban', True, ['kanban.js'])
+    out.append("\n<div id=\"view_issue\" class=\"overlay\"></div>")
+    out.append(self._provide_form_add_html())
+    out.append("<div class=\"flyb-title\">")
+    out.extend("<div class=\"flyb-column\"><div>{}</div></div>".format(s) for s in all_status)
+    out.append("</div>\n<div class=\"flyb-row\">\n")
     for s in all_status:
-      doc += "<div class=\"flyb-column\" ondrop=\"drop(event)\" ondragover=\"allowDrop(event)\" id=\"{}\" style=\"background-color: {};\">\n".format(s, status_color[s])
-      doc += "</div>\n"
-    doc += "</div>\n<div class=\"flyb-title\">"
-    for s in all_status:
-      doc += "<div><div id=\"add-{0}\" class=\"flyb-button\" style=\"width: 310px;\" onclick=\"openAdd(\'{0}\')\">+</div></div>\n".format(s)
-    doc += "</div></body>\n</html>\n"
-    respond('200 OK', [('Content-Type', 'text/html')])
-    return [doc.encode('utf-8')]
+      out.append("<div class=\"flyb-column\" ondrop=\"drop(event)\" ondragover=\"allowDrop(event)\" id=\"{}\" style=\"background-color: {};\">\n".format(s, status_color[s]))
+      out.append("</div>\n")
+    out.append("</div>\n<div class=\"flyb-title\">")
+    out.extend("<div><div id=\"add-{0}\" class=\"flyb-button\" style=\"width: 310px;\" onclick=\"openAdd(\'{0}\')\">+</div></div>\n".format(s) for s in all_status)
+    out.append("</div></body>\n</html>\n")
+    return ''.join(out).encode('utf-8')
   def _list(self, args, request_data, environ, respond):
-    doc = self._provide_header_for('List', False)
-    doc += "<table>\n"
+    out = []
+    self._provide_header_for(out, 'List', False)
+    out.append("<table>\n")
     if len(args) == 1:
-      for row in self.db.get_rows_as_dict(type = 'todo'):
-        doc += "<tr>"
-        doc += "<td><a href=\"/list/{}\">{}</a></td>".format(row['Id'], row['Title'])
-        doc += "</tr>"
+      rows, pages = self._paginate('/list', self.db.iter_rows(type = 'todo'), request_data)
+      link = self.list_link.format
+      respond('200 OK', [('Content-Type', 'text/html')])
+      return self._stream(out, rows, lambda row: link(row['Id'], row['Title']), "</table>{}</body></html>".format(pages))
     else:
-      doc += "<tr>"
-      for c in self.db.get_columns():
-        doc += "<td>{}</td>".format(c)
-      doc += "</tr>"
-      for row in self.db.get_rows(type = 'todo', id = args[1]):
-        doc += "<tr>"
-        for v in row:
-          doc += "<td>{}</td>".format(v)
-        doc += "</tr>"
-      for row in self.db.get_rows(type = 'comment', parent = args[1]):
-        doc += "<tr>"
-        for v in row:
-          doc += "<td>{}</td>".format(v)
-        doc += "</tr>"
-    doc += "</table></body></html>"
+      out.append(self._fragment('list_columns', lambda: "<tr>{}</tr>".format(''.join("<td>{}</td>".format(c) for c in self.db.get_columns()))))
+      for row in self.db.get_rows(type = 'todo', id = args[1]) + self.db.get_rows(type = 'comment', parent = args[1]):
+        out.append("<tr>")
+        out.extend("<td>{}</td>".format(v) for v in row.values())
+        out.append("</tr>")
+    out.append("</table></body></html>")
     respond('200 OK', [('Content-Type', 'text/html')])
-    return [doc.encode('utf-8')]
+    return [''.join(out).encode('utf-8')]
+  def _paginate(self, view, rows, request_data, per_page = 0):
+    # '?page=2&per_page=50' picks a slice of rows and adds links to the other pages,
+    # without either per_page rows are shown, every row for 0
+    try:
+      qd = query_split(request_data) if type(request_data) == str and len(request_data) > 0 else dict()
+      page = int(qd.get('page', 1))
+      per_page = int(qd.get('per_page', self.page_size if 'page' in qd and per_page == 0 else per_page))
+    except ValueError:
+      return rows, ''
+    if per_page <= 0:
+      return rows, ''
+    page = max(page, 1)
+    # one row past the page tells whether there is a next one
+    rows = list(itertools.islice(rows, (page - 1) * per_page, page * per_page + 1))
+    links = []
+    if page > 1:
+      links.append("<div><a href=\"{}?page={}&amp;per_page={}\">&lt;</a></div>".format(view, page - 1, per_page))
+    links.append("<div>{}</div>".format(page))
+    if len(rows) > per_page:
+      links.append("<div><a href=\"{}?page={}&amp;per_page={}\">&gt;</a></div>".format(view, page + 1, per_page))
+    return rows[:per_page], "<div class=\"flyb-header\">{}</div>".format(''.join(links))
+  def _stream(self, out, rows, render, tail):
+    # yields the page a batch of rows at a time, the whole document never exists as one string
+    for row in rows:
+      out.append(render(row))
+      if len(out) >= self.stream_batch:
+        yield ''.join(out).encode('utf-8')
+        out = []
+    out.append(tail)
+    yield ''.join(out).encode('utf-8')
   def _wiki_create(self, args, request_data, environ, respond):
-    page = self.db.get_rows_as_dict(type = 'wiki', id = args[1])
-    if len(page) == 0:
-      row = {'Id': args[1], 'Type': 'Wiki', 'Title': args[1], 'Status': 'none'}
-      self.db.add_row_from_dict(row)
-      self.db.write_db()
+    with self.db.lock:
+      page = self.db.get_rows_as_dict(type = 'wiki', id = args[1])
+      if len(page) == 0:
+        row = {'Id': args[1], 'Type': 'Wiki', 'Title': args[1], 'Status': 'none'}
+        self.db.add_row_from_dict(row)
+        self.db.flush()
     respond('301 Moved Permanently', [('Location', '/wiki/{}/edit'.format(args[1])), ('Access-Control-Allow-Origin', '*')])
     return [b'301 Moved Permanently']
   def _wiki_save(self, args, request_data, environ, respond):
     row = {'Id': args[1], 'Description': request_data.decode('utf-8')}
-    self.db.update_row_from_dict(row)
-    self.db.write_db()
+    with self.db.lock:
+      self.db.update_row_from_dict(row)
+      self.db.flush()
     respond('200 OK', [('Content-Type', 'text/html')])
     return [b'']
   def _wiki_edit(self, args, request_data, environ, respond):
     page = self.db.get_rows_as_dict(type = 'wiki', id = args[1])
-    doc = self._provide_header_for('Wiki', False, additional_scripts = ["Page={}/wiki.js".format(args[1])])
-    doc += "<iframe width=\"0\" height=\"0\" border=\"0\" name=\"formtarget\" id=\"formtarget\"></iframe>"
-    doc += "<h2>Edit {}</h2>".format(args[1])
-    doc += "<div id=\"preview\"></div>\n"
-    doc += "<hr><form target=\"formtarget\" method=\"post\">" \
-           "<textarea id=\"desc\" name=\"Description\" rows=\"20\" cols=\"60\" " \
-           "onkeyup=\"updatePreview()\" onchange=\"updatePreview()\">{}</textarea><br>".format(page[0]['Description'])
-    doc += "\n<button onclick=\"savePage(\'{}\', true)\">Save & Close</button>".format(args[1])
-    doc += "<button onclick=\"savePage(\'{}', false)\">Save</button>".format(args[1])
-    doc += "<button onclick=\"window.location.replace('/wiki/{0}')\">Cancel</button>\n".format(args[1])
-    doc += "</form>"
-    doc += "</body></html>"
+    out = []
+    self._provide_header_for(out, 'Wiki', False, additional_scripts = ["preview.js", "Page={}/wiki.js".format(args[1])])
+    self.wiki_edit_page.render(out, args[1], page[0]['Description'])
     respond('200 OK', [('Content-Type', 'text/html')])
-    return [doc.encode('utf-8')]
+    return [''.join(out).encode('utf-8')]
   def _wiki_show(self, args, request_data, environ, respond):
-    doc = self._provide_header_for('Wiki' if len(args) < 2 else args[1], False)
+    out = []
+    self._provide_header_for(out, 'Wiki' if len(args) < 2 else args[1], False)
     if len(args) == 2:
       page = self.db.get_rows_as_dict(type = 'wiki', id = args[1])
       if len(page) == 0:
-        doc += "<hr>\n<button onclick=\"window.location.replace('/wiki/{}/create')\">Create</button>\n".format(args[1])
+        out.append("<hr>\n<button onclick=\"window.location.replace('/wiki/{}/create')\">Create</button>\n".format(args[1]))
       else:
-      #try:
-        doc += self._encode_wiki(page[0]['Description'])
-        doc += "<hr>\n<button onclick=\"window.location.replace('/wiki/{}/edit')\">Edit</button>\n".format(args[1])
-      #except:
-      #  doc += "Doesn't exist"
+        out.append(self._encode_wiki(page[0]['Description']))
+        out.append("<hr>\n<button onclick=\"window.location.replace('/wiki/{}/edit')\">Edit</button>\n".format(args[1]))
     else:
       try:
-        pages = self.db.get_rows_as_dict(type = 'Wiki')
-        for p in pages:
-          doc += "<div><a href=\"/wiki/{}\">{}</a></div>".format(p['Id'], p['Id'])
+        rows, pages = self._paginate('/wiki', self.db.iter_rows(type = 'Wiki'), request_data)
       except:
-        doc += "err..."
-    doc += "</body></html>"
+        out.append("err...")
+      else:
+        link = self.wiki_link.format
+        respond('200 OK', [('Content-Type', 'text/html')])
+        return self._stream(out, rows, lambda row: link(row['Id']), "{}</body></html>".format(pages))
+    out.append("</body></html>")
     respond('200 OK', [('Content-Type', 'text/html')])
-    return [doc.encode('utf-8')]
+    return [''.join(out).encode('utf-8')]
   def _wiki(self, args, request_data, environ, respond):
     wiki_options = {'edit': self._wiki_edit, 'create': self._wiki_create, 'save': self._wiki_save}
     if len(args) > 2:
@@ -642,12 +2927,34 @@ class FlyServer(object):
     else:
       return self._wiki_show(args, request_data, environ, respond)
   def _git(self, args, request_data, environ, respond):
-    doc = self._provide_header_for('Git', False)
-    git = Git()
-    doc += "<div>{}</div>".format(self._encode_wiki(git.log()))
-    doc += "</body></html>"
+    # '/git?page=2&per_page=50' pages through the log, '/git/<hash>' shows one commit
+    out = []
+    self._provide_header_for(out, 'Git', False)
+    try:
+      if len(args) == 1:
+        commits, pages = self._paginate('/git', self.git.iter_commits(), request_data, self.page_size)
+        for c in commits:
+          self._git_commit(out, c)
+        out.append(pages)
+      else:
+        c = self.git.commit(args[1])
+        if c != None:
+          self._git_commit(out, c)
+        else:
+          out.append("<p>No commit {}</p>".format(html.escape(args[1])))
+    except (concurrent.futures.TimeoutError, subprocess.TimeoutExpired):
+      # read meanwhile by the worker, the page asks again by itself
+      out.append("<meta http-equiv=\"refresh\" content=\"1\"><p>git is taking its time, try again in a moment.</p>")
+    except (OSError, RuntimeError) as e:
+      out.append("<p>git failed: {}</p>".format(html.escape(str(e))))
+    out.append("</body></html>")
     respond('200 OK', [('Content-Type', 'text/html')])
-    return [doc.encode('utf-8')]
+    return [''.join(out).encode('utf-8')]
+  def _git_commit(self, out, c):
+    self.git_commit.render(out, c.hash, c.hash[:10], html.escape(c.author), c.date, self._encode_wiki(c.message))
+  def _git_version(self):
+    self.git.refresh()
+    return self.git.version
   def _favicon(self, args, request_data, environ, respond):
     try:
       with open("{}/img/fit.png".format(self.fit_path), 'rb') as datafile:
@@ -669,29 +2976,171 @@ class FlyServer(object):
         request_body = environ['QUERY_STRING']
     #try:
     f = self.handlers['/' + parts[0] if len(parts) > 0 else '/']
-    return f(parts, request_body, environ, respond)
+    if self.metrics == None and self.profile == 0:
+      return f(parts, request_body, environ, respond)
+    route = '/' + '/'.join(parts[:2 if len(parts) > 1 and parts[0] == 'api' else 1])
+    if self.profile > 0 and next(self.requests) % self.profile == 0 and self.profiling.acquire(False):
+      try:
+        return self._profiled(route, f, parts, request_body, environ, respond)
+      finally:
+        self.profiling.release()
+    start = time.perf_counter()
+    result = f(parts, request_body, environ, respond)
+    if self.metrics == None:
+      return result
+    if type(result) == list:
+      self.metrics.observe('fit_request_seconds', route, time.perf_counter() - start)
+      return result
+    return self._timed(route, start, result)
     #except KeyError:
     #  respond('404 Not Found', [('Content-Type', 'text/plain')])
     #  return [b'not found']
+  def _timed(self, route, start, result):
+    # a streamed response is done when the last chunk is out
+    try:
+      yield from result
+    finally:
+      self.metrics.observe('fit_request_seconds', route, time.perf_counter() - start)
+  def _profiled(self, route, f, parts, request_body, environ, respond):
+    # one request at a time, a streamed response is rendered in full while profiled
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+      result = list(f(parts, request_body, environ, respond))
+    finally:
+      profiler.disable()
+    if self.metrics != None:
+      self.metrics.observe('fit_request_seconds', route, time.perf_counter() - start)
+    stats, n = self.profiles.get(route, (None, 0))
+    if stats == None:
+      stats = pstats.Stats(profiler)
+    else:
+      stats.add(profiler)
+    self.profiles[route] = (stats, n + 1)
+    return result
+  def _save_profiles(self):
+    # one pstats file per route in .fit/profile, for snakeviz, 'python -m pstats' and friends
+    path = os.path.join(os.path.dirname(os.path.abspath(self.db.filename)), '.fit', 'profile')
+    os.makedirs(path, exist_ok = True)
+    with self.profiling:
+      for route, (stats, n) in self.profiles.items():
+        stats.dump_stats(os.path.join(path, (route.strip('/').replace('/', '_') or 'root') + '.prof'))
+    print("fit: profiles of {} routes written to {}".format(len(self.profiles), path), file = sys.stderr)
   def _encode_wiki(self, txt):
-    # for now...
-    return "{}".format(markdown.markdown(txt, extensions=[WikiLinkExtension(base_url='http://localhost/wiki/')]))
+    return self.md_cache.render(txt)
   def serve_forever(self):
     self.httpd.serve_forever()
+  def close(self):
+    self.httpd.server_close()
+    self.events.close()
+    self.git.close()
+    if len(self.profiles) > 0:
+      self._save_profiles()
+    self.db.close()
+
+def batch_main(args):
+  # 'fit batch ops.jsonl' applies the ops as /api/batch does, without a server
+  db = FlyDb(args.filename, journal = args.journal, snapshot = args.snapshot)
+  format = args.format or ('csv' if args.input.lower().endswith('.csv') else 'jsonl')
+  try:
+    if args.input == '-':
+      n = db.apply_batch(read_ops(sys.stdin, format))
+    else:
+      with open(args.input, 'r', newline = '') as f:
+        n = db.apply_batch(read_ops(f, format))
+  except (OSError, ValueError) as e:
+    print("fit: batch: {}".format(e), file = sys.stderr)
+    return 1
+  db.flush()
+  db.close()
+  print("fit: {} ops applied to {}".format(n, args.filename), file = sys.stderr)
+  return 0
+
+def export_main(args):
+  # 'fit export issues.csv' writes the rows as /api/export does, without a server
+  db = FlyDb(args.filename, lazy = args.lazy, snapshot = args.snapshot)
+  format = args.format or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+  rows = db.iter_rows(type = args.type.lower().split(',') if args.type else None, status = args.status)
+  lines = export_lines(db.get_columns(), rows, format)
+  if args.output == '-':
+    sys.stdout.writelines(lines)
+  else:
+    with open(args.output, 'w', newline = '') as f:
+      f.writelines(lines)
+  return 0
+
+def convert_main(args):
+  # 'fit convert --to 1 old.txt' writes the database in another version without loading it
+  target = args.output if args.output != None else args.filename
+  try:
+    size = os.path.getsize(args.filename)
+    n, t_convert, t_check = convert_db(args.filename, target, args.to, check = args.check)
+  except KeyError as e:
+    print("fit: convert: {} has an unknown version {}".format(args.filename, e), file = sys.stderr)
+    return 1
+  except (OSError, IndexError, ValueError) as e:
+    print("fit: convert: {}".format(e), file = sys.stderr)
+    return 1
+  checked = ", checked in {:.2f}s".format(t_check) if args.check else ""
+  print("fit: {} entries of {} written to {} as version {} in {:.2f}s ({:.1f}MB/s, {:.0f} entries/s){}".format(
+        n, args.filename, target, args.to, t_convert, size / 1e6 / max(t_convert, 1e-9), n / max(t_convert, 1e-9), checked),
+        file = sys.stderr)
+  return 0
 
 def main():
   parser = argparse.ArgumentParser(description = 'Flyweight Issue Tracker.')
   parser.add_argument('--config', action = 'store_true', help = 'writes config to .fit/config')
   parser.add_argument('-f', '--file', type = str, dest = 'filename', default = 'todo.txt', help = 'path to database file.')
   parser.add_argument('-p', '--port', type = str, dest = 'port', default = '80', help = 'webserver port')
+  parser.add_argument('--threaded', action = 'store_true', help = 'serve requests in parallel threads and keep connections alive')
+  parser.add_argument('--journal', action = 'store_true', help = 'append changes to a journal next to the database and compact it in the background')
+  parser.add_argument('--compact-interval', type = float, dest = 'compact_interval', default = 30, help = 'seconds between background journal compactions')
+  parser.add_argument('--search-cache', action = 'store_true', dest = 'search_cache', help = 'keep the search index in .fit/ so large databases start faster')
+  parser.add_argument('--write-delay', type = float, dest = 'write_delay', default = 0, help = 'seconds to wait for more changes before rewriting the database, 0 writes every change right away')
+  parser.add_argument('--no-metrics', action = 'store_false', dest = 'metrics', help = 'don\'t time requests and database operations for /api/metrics')
+  parser.add_argument('--profile', type = int, nargs = '?', const = 10, default = 0, metavar = 'N', help = 'run one request in N (10) under cProfile, see /api/profile and .fit/profile')
+  parser.add_argument('--shard', type = str, choices = ['type', 'parent', 'hash', 'none'] + ['hash:{}'.format(n) for n in (4, 16, 64, 256)],
+                      help = 'split the database into files by type, by parent issue or by id hash, none joins them again')
+  parser.add_argument('--snapshot', action = 'store_true', help = 'keep the parsed database in .fit/ so large databases start faster')
+  parser.add_argument('--lazy', action = 'store_true', help = 'read descriptions from the database file only when they are shown')
+  parser.add_argument('--outver', choices = sorted(serializer_versions), help = 'version to write the database in, the one it has by default')
+  parser.add_argument('--watch-interval', type = float, dest = 'watch_interval', default = 1, help = 'seconds between checks for edits to the database file, 0 turns it off')
+  commands = parser.add_subparsers(dest = 'command', metavar = 'command', help = 'without one fit serves the database')
+  batch = commands.add_parser('batch', help = 'apply add/update/move ops to the database and write it once')
+  batch.add_argument('input', help = 'JSON lines or CSV file of ops, - for stdin')
+  batch.add_argument('--format', choices = ['jsonl', 'csv'], help = 'csv for .csv files and JSON lines otherwise by default')
+  export = commands.add_parser('export', help = 'write the rows of the database as JSON lines or CSV')
+  export.add_argument('output', nargs = '?', default = '-', help = 'file to write, - (the default) for stdout')
+  export.add_argument('--format', choices = ['jsonl', 'csv'], help = 'csv for .csv files and JSON lines otherwise by default')
+  export.add_argument('--type', type = str, help = 'only these types, separated by commas')
+  export.add_argument('--status', type = str, help = 'only rows with this status')
+  convert = commands.add_parser('convert', help = 'write the database in another version, one entry at a time')
+  convert.add_argument('output', nargs = '?', help = 'file to write, the database itself by default')
+  convert.add_argument('--to', choices = sorted(serializer_versions), default = '2', help = 'version to write, 2 by default')
+  convert.add_argument('--no-check', action = 'store_false', dest = 'check', help = 'don\'t read the new file back to compare it with the database')
   args = parser.parse_args()
-  flysrv = FlyServer(args.filename, int(args.port))
+  if args.command == 'batch':
+    sys.exit(batch_main(args))
+  if args.command == 'export':
+    sys.exit(export_main(args))
+  if args.command == 'convert':
+    sys.exit(convert_main(args))
+  flysrv = FlyServer(args.filename, int(args.port), journal = args.journal, compact_interval = args.compact_interval,
+                      threaded = args.threaded, watch_interval = args.watch_interval,
+                      search_cache = args.search_cache, write_delay = args.write_delay, metrics = args.metrics,
+                      profile = args.profile, shard = args.shard, lazy = args.lazy,
+                      snapshot = args.snapshot, outver = args.outver)
+  # a plain kill shuts down like Ctrl-C does, pending changes are written first
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
   #flydb.printall()
   #print("Serving {} on port {}, control-C to stop".format(path, port))
   try:
     flysrv.serve_forever()
   except KeyboardInterrupt:
     print("\b\bShutting down.")
+  finally:
+    flysrv.close()
 
 if __name__ == "__main__":
   main()
@@ -10,6 +10,26 @@ function reloadTable(tab) {
   req.send(null);
 }
 
+var boardVersion = null;
+
+function reloadBoard() {
+  var req = new XMLHttpRequest();
+  req.onreadystatechange = function() {
+    if(this.readyState == 4 && this.status == 200) {
+      boardVersion = req.getResponseHeader("ETag");
+      var board = JSON.parse(req.responseText);
+      for(var status in board) {
+        var el = document.getElementById(status);
+        if(el != null) {
+          el.innerHTML = board[status];
+        }
+      }
+    }
+  }
+  req.open("GET", "http://localhost:" + window.location.port + "/api/board", true);
+  req.send(null);
+}
+
 function reloadDb() {
   var req = new XMLHttpRequest();
   req.onreadystatechange = function() {}
@@ -111,7 +131,7 @@ function submitIssue(issueId) {
   req.onreadystatechange = function() {
     if(this.readyState == 4 && this.status == 200) {
       document.getElementById("frm-add").reset();
-      reloadTable(table);
+      reloadBoard();
       if(issueId != null) {
         refreshIssue(issueId);
       }
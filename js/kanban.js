@@ -1,6 +1,86 @@
+function watchBoard() {
+  var req = new XMLHttpRequest();
+  req.onreadystatechange = function() {
+    if(this.readyState == 4 && this.status == 200) {
+      if(JSON.parse(req.responseText).version != boardVersion) {
+        reloadBoard();
+      }
+    }
+  }
+  req.open("GET", "http://localhost:" + window.location.port + "/api/version", true);
+  req.send(null);
+}
+
+var boardTimer = null;
+
+function scheduleBoard() {
+  // a drag sends a status and a place event, fetch the board once for both
+  if(boardTimer == null) {
+    boardTimer = setTimeout(function() {
+      boardTimer = null;
+      reloadBoard();
+    }, 100);
+  }
+}
+
+function openIssue() {
+  var el = document.getElementById("view_issue");
+  var id = document.getElementById("frm-Id");
+  if(el == null || el.style.display != "block" || id == null) {
+    return null;
+  }
+  return id.value;
+}
+
+function onBoard(row) {
+  var type = (row["Type"] || "").toLowerCase();
+  return type == "todo" || type == "bug" || document.getElementById(row["Id"]) != null;
+}
+
+function listenBoard() {
+  if(!window.EventSource) {
+    setInterval(watchBoard, 2000);
+    return;
+  }
+  var events = new EventSource("http://localhost:" + window.location.port + "/api/events");
+  events.addEventListener("hello", function(e) {
+    if(JSON.parse(e.data).version != boardVersion) {
+      scheduleBoard();
+    }
+  });
+  events.addEventListener("add", function(e) {
+    var row = JSON.parse(e.data).args[0];
+    if(onBoard(row)) {
+      scheduleBoard();
+    }
+    if(row["Parent"] != null && row["Parent"] == openIssue()) {
+      refreshIssue(row["Parent"]);
+    }
+  });
+  events.addEventListener("update", function(e) {
+    var row = JSON.parse(e.data).args[0];
+    if(onBoard(row)) {
+      scheduleBoard();
+    }
+    if(row["Id"] == openIssue()) {
+      refreshIssue(row["Id"]);
+    }
+  });
+  ["status", "place", "sync", "reload", "batch"].forEach(function(op) {
+    events.addEventListener(op, function(e) {
+      scheduleBoard();
+      if(op == "sync" || op == "reload" || op == "batch") {
+        var issue = openIssue();
+        if(issue != null) {
+          refreshIssue(issue);
+        }
+      }
+    });
+  });
+}
+
 function reload() {
   reloadDb();
-  reloadTable("Backlog");
-  reloadTable("WIP");
-  reloadTable("Done");
+  reloadBoard();
+  listenBoard();
 }
@@ -1,12 +1,32 @@
-function updatePreview() {
-  var text = document.getElementById("desc").value;
+var previewKey = Math.random().toString(36).slice(2);
+var previewSeq = 0;
+var previewTimer = null;
+var previewReq = null;
+
+function sendPreview(text) {
+  if(previewReq != null) {
+    previewReq.abort();
+  }
   var req = new XMLHttpRequest();
   req.onreadystatechange = function() {
     if(this.readyState == 4 && this.status == 200) {
       document.getElementById("preview").innerHTML = req.responseText;
     }
   }
-  req.open("POST", "http://localhost:" + window.location.port + "/api/md", true);
+  previewSeq += 1;
+  req.open("POST", "http://localhost:" + window.location.port + "/api/md/" + previewKey + "/" + previewSeq, true);
   req.setRequestHeader("Content-Type", "application/x-www-form-urlencoded");
   req.send(text);
+  previewReq = req;
+}
+
+function updatePreview() {
+  var desc = document.getElementById("desc");
+  if(desc == null) {
+    return;
+  }
+  clearTimeout(previewTimer);
+  previewTimer = setTimeout(function() {
+    sendPreview(desc.value);
+  }, 200);
 }
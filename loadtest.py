@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+import sys
+import os
+import argparse
+import http.client
+import shutil
+import tempfile
+import threading
+import time
+import bench
+import fit
+
+def kanban_page(srv):
+  # what a browser fetches when it opens the board
+  paths = ['/kanban', '/css/default.css', '/css/drag.css', '/js/default.js', '/js/drag.js', '/js/kanban.js']
+  paths.extend('/api/status/{}'.format(s) for s in srv.db.get_config('Status'))
+  return paths
+
+def client(port, paths, deadline, latencies):
+  conn = http.client.HTTPConnection('localhost', port, timeout = 30)
+  while time.perf_counter() < deadline:
+    for p in paths:
+      start = time.perf_counter()
+      conn.request('GET', p)
+      conn.getresponse().read()
+      latencies.append(time.perf_counter() - start)
+  conn.close()
+
+def slow_client(port, deadline, latencies):
+  # keeps the server busy rendering large, never cached previews
+  conn = http.client.HTTPConnection('localhost', port, timeout = 60)
+  n = 0
+  while time.perf_counter() < deadline:
+    n += 1
+    doc = ''.join('Paragraph {} of preview {} with *some* markdown.\n\n'.format(i, n) for i in range(2000))
+    conn.request('POST', '/api/md', body = doc.encode('utf-8'))
+    conn.getresponse().read()
+  conn.close()
+
+def run(srv, clients, duration, slow):
+  thread = threading.Thread(target = srv.serve_forever, daemon = True)
+  thread.start()
+  port = srv.httpd.server_address[1]
+  paths = kanban_page(srv)
+  latencies = []
+  deadline = time.perf_counter() + duration
+  workers = [threading.Thread(target = client, args = (port, paths, deadline, latencies)) for i in range(clients)]
+  if slow:
+    workers.append(threading.Thread(target = slow_client, args = (port, deadline, latencies)))
+  start = time.perf_counter()
+  for w in workers:
+    w.start()
+  for w in workers:
+    w.join()
+  elapsed = time.perf_counter() - start
+  srv.httpd.shutdown()
+  srv.close()
+  latencies.sort()
+  p50 = latencies[len(latencies) // 2]
+  p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+  return len(latencies) / elapsed, p50, p99
+
+def main():
+  parser = argparse.ArgumentParser(description = 'fit load test, single threaded against threaded server.')
+  parser.add_argument('-n', '--entries', type = int, default = 5000, help = 'entries in the synthetic database')
+  parser.add_argument('-c', '--clients', type = int, default = 8, help = 'concurrent clients')
+  parser.add_argument('-d', '--duration', type = float, default = 5, help = 'seconds per run')
+  parser.add_argument('--slow', action = 'store_true', help = 'add a client posting large markdown previews')
+  args = parser.parse_args()
+  tmp = tempfile.mkdtemp()
+  stderr = sys.stderr
+  try:
+    filename = os.path.join(tmp, 'todo.txt')
+    bench.gen_db(filename, args.entries)
+    # request logging would dominate the measurement
+    sys.stderr = open(os.devnull, 'w')
+    for name, threaded in (('single', False), ('threaded', True)):
+      srv = fit.FlyServer(filename, 0, threaded = threaded)
+      rps, p50, p99 = run(srv, args.clients, args.duration, args.slow)
+      print("{:>8}: {:.0f} req/s, p50 {:.1f}ms, p99 {:.1f}ms".format(name, rps, p50 * 1000, p99 * 1000), file = stderr)
+  finally:
+    sys.stderr = stderr
+    shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,500 @@
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+import concurrent.futures
+
+import fit
+
+# values the file formats have a hard time with
+awkward = ['', 'plain', 'x\\y', 'end\\', '\\', '\\\\', 'say "hi"', '"', '\\"', '"quoted"', 'semi; colon',
+           'a\\sb', 'line one\nline two', '\nstarts with newline', 'ends with newline\n', 'crlf\r\nline',
+           '  indented\n    code\ntrailing\n\n----\nafter rule\n', '----', 'a\\\\"\nb', 'tab\tcr\r']
+# files are read with universal newlines, a \r in a value doesn't come back from one
+stored = [v for v in awkward if not '\r' in v]
+
+def random_strings(n, seed = 1):
+  rnd = random.Random(seed)
+  alphabet = ['\\', '"', ';', 's', 'n', 'r', 't', '\n', '\r', '\r\n', 'a', ' ', '-', '----']
+  return [''.join(rnd.choice(alphabet) for i in range(rnd.randint(0, 12))) for j in range(n)]
+
+def entries_for(values):
+  return [['id{}'.format(n), v] for n, v in enumerate(values)]
+
+def write_entries(ver, entries):
+  out = io.StringIO()
+  out.write("Version={}\n".format(ver))
+  fit.serializer_versions[ver]().write_all(out, {"Config": {'Fields': ['Id', 'Description']}, "Entries": entries})
+  return out.getvalue()
+
+def read_entries(text):
+  datafile = io.StringIO(text)
+  ver = datafile.readline().split('=')[1].strip()
+  return fit.serializer_versions[ver]().read_all(datafile)["Entries"]
+
+def dump(db):
+  return [dict(r.items()) for r in db.rows]
+
+class CodecTest(unittest.TestCase):
+  def test_escape_round_trip(self):
+    for chars in ['"\\', ';\n\\', '"\n\r\t\\']:
+      for s in awkward + random_strings(5000):
+        self.assertEqual(fit.unescape(fit.escape(s, chars), chars), s, (chars, s))
+
+  def test_version2_value_round_trip(self):
+    # written with only quotes escaped, read back with backslashes decoded too
+    for s in awkward + random_strings(5000):
+      self.assertEqual(fit.unescape(fit.escape(s, '"'), '"\\'), s, s)
+
+  def test_version1_round_trip(self):
+    for s in awkward + random_strings(5000):
+      escaped = fit._escape(s)
+      self.assertFalse(';' in escaped or '\n' in escaped, s)
+      self.assertEqual(fit._unescape(escaped), s, s)
+
+  def test_lone_backslash_at_end_is_dropped(self):
+    self.assertEqual(fit._unescape('a\\'), 'a')
+    self.assertEqual(fit.unescape('a\\', '"\\'), 'a')
+
+  def test_version1_file(self):
+    # Version=1 strips the whitespace around values, it can't hold that
+    values = [v for v in awkward + random_strings(2000) if v == v.strip()]
+    self.assertEqual(read_entries(write_entries('1', entries_for(values))), entries_for(values))
+
+  def test_version2_file(self):
+    values = awkward + ['\n'.join(random_strings(4, seed)) for seed in range(500)]
+    values = [v for v in values if v == v.strip(' \t\r\f\v')]
+    self.assertEqual(read_entries(write_entries('2', entries_for(values))), entries_for(values))
+
+  def test_lazy_source(self):
+    values = [v for v in stored if v == v.strip(' \t\f\v')]
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, 'todo.txt')
+      with open(filename, 'w', newline = '\n') as f:
+        f.write(write_entries('2', entries_for(values)))
+      source = fit.LazySource(filename)
+      for lazy in [(), ('description',)]:
+        self.assertEqual([source.decode_all(v) for v, h in source.entries(lazy)], entries_for(values))
+
+class StorageTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.filename = os.path.join(self.tmp, 'todo.txt')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def fill(self, db, n = 20):
+    for i in range(n):
+      db.add_row_from_dict({'Id': 'r{}'.format(i), 'Type': ['Todo', 'Bug', 'Wiki'][i % 3],
+                            'Title': 'row {} "{}"'.format(i, stored[i % len(stored)].strip()),
+                            'Description': stored[i % len(stored)].strip(' \t')})
+    db.add_row_from_dict({'Id': 'a;b', 'Type': 'Comment', 'Parent': 'r1', 'Title': 'comment'})
+
+  def edit(self, db):
+    db.update_row_from_dict({'Id': 'r3', 'Title': 'new title', 'Description': 'new\ndescription "q"'})
+    db.change_row('r4', 'WIP')
+    db.place_before('r7', 'r0')
+    db.add_row_from_dict({'Id': 'r99', 'Title': 'added later'})
+
+  def make(self, **kw):
+    kw.setdefault('outver', '2')
+    db = fit.FlyDb(self.filename, **kw)
+    self.fill(db)
+    db.write_db()
+    return db
+
+  def reopen(self, db, **kw):
+    db.close()
+    return fit.FlyDb(self.filename, **kw)
+
+  def test_plain(self):
+    db = self.make()
+    self.edit(db)
+    db.write_db()
+    self.assertEqual(dump(self.reopen(db)), dump(db))
+
+  def test_atomic_write(self):
+    db = self.make()
+    os.chmod(self.filename, 0o640)
+    link = os.path.join(self.tmp, 'link.txt')
+    os.symlink(self.filename, link)
+    linked = fit.FlyDb(link)
+    self.edit(linked)
+    linked.write_db()
+    self.assertTrue(os.path.islink(link))
+    self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o640)
+    self.assertFalse(os.path.exists(self.filename + '.tmp'))
+    self.assertEqual(len(fit.FlyDb(self.filename).get_rows(id = 'r99')), 1)
+    # written behind, only close() gets to it here
+    delayed = fit.FlyDb(self.filename, write_delay = 60)
+    delayed.change_row('r1', 'Done')
+    delayed.flush()
+    self.assertEqual(fit.FlyDb(self.filename).get_rows(id = 'r1')[0]['Status'], 'Backlog')
+    delayed.close()
+    self.assertEqual(fit.FlyDb(self.filename).get_rows(id = 'r1')[0]['Status'], 'Done')
+
+  def test_version1(self):
+    db = self.make(outver = '1')
+    self.edit(db)
+    db.write_db()
+    with fit.FlyDbStream(self.filename) as stream:
+      self.assertEqual(stream.version, '1')
+    self.assertEqual(dump(self.reopen(db)), dump(db))
+
+  def test_journal(self):
+    db = self.make(journal = True)
+    self.edit(db)
+    db.flush()
+    self.assertTrue(os.path.exists(db.journal_name))
+    # not compacted, the rows come back from the journal
+    again = fit.FlyDb(self.filename, journal = True)
+    self.assertEqual(dump(again), dump(db))
+    self.assertEqual(fit.FlyDb(self.filename).get_rows(id = 'r99'), [])
+
+  def test_journal_crash_after_compaction(self):
+    db = self.make(journal = True)
+    self.edit(db)
+    db.flush()
+    # stopped between writing the database and removing the journal
+    db.write_db()
+    again = fit.FlyDb(self.filename, journal = True)
+    self.assertEqual(dump(again), dump(db))
+    again.compact()
+    self.assertFalse(os.path.exists(db.journal_name))
+
+  def test_sharded(self):
+    for sharding in ['type', 'parent', 'hash:4']:
+      self.filename = os.path.join(self.tmp, sharding.replace(':', '') + '.txt')
+      db = self.make(search = True)
+      expected = dump(db)
+      db.reshard(sharding)
+      self.assertTrue(os.path.isdir(db.shard_dir))
+      again = fit.FlyDb(self.filename, search = True)
+      self.assertEqual(again.sharding, sharding)
+      self.assertEqual(again.get_rows(id = 'a;b')[0]['Parent'], 'r1')
+      self.assertEqual(dump(again), expected)
+      # every row indexed once
+      self.assertEqual(again.search('comment')[0], 1)
+      self.assertEqual(again.text_index.size, again.count)
+      self.edit(again)
+      again.write_db()
+      expected = dump(again)
+      again.reshard('none')
+      self.assertFalse(os.path.exists(db.shard_dir))
+      self.assertEqual(dump(fit.FlyDb(self.filename)), expected)
+
+  def test_sharded_writes_what_changed(self):
+    db = self.make()
+    db.reshard('type')
+    db = self.reopen(db)
+    db.update_row_from_dict({'Id': 'r1', 'Title': 'change me'})
+    manifest = os.stat(self.filename).st_ino
+    db.write_db()
+    # a title or status only lives in the shard
+    self.assertEqual(os.stat(self.filename).st_ino, manifest)
+    self.assertFalse(db.sync())
+    for change in [lambda: db.place_before('r2', 'r0'), lambda: db.update_row_from_dict({'Id': 'r4', 'Type': 'Todo'}),
+                   lambda: db.add_row_from_dict({'Id': 'r50'})]:
+      change()
+      db.write_db()
+      self.assertNotEqual(os.stat(self.filename).st_ino, manifest)
+      manifest = os.stat(self.filename).st_ino
+    self.assertEqual(dump(fit.FlyDb(self.filename)), dump(db))
+    # a shard that was read is looked at, an edit by hand is picked up
+    shard = db._shard_file(db.get_rows(id = 'r1')[0].shard)
+    with open(shard) as f:
+      text = f.read()
+    with open(shard, 'w') as f:
+      f.write(text.replace('change me', 'changed by hand'))
+    os.utime(shard, ns = (time.time_ns(), time.time_ns() + 10 ** 9))
+    self.assertTrue(db.sync())
+    self.assertEqual(db.get_rows(id = 'r1')[0]['Title'], 'changed by hand')
+    self.assertFalse(db.sync())
+
+  def test_reshard_clears_journal(self):
+    db = self.make(journal = True)
+    self.edit(db)
+    db.flush()
+    db.reshard('type')
+    self.assertFalse(os.path.exists(db.journal_name))
+    self.assertEqual(dump(fit.FlyDb(self.filename, journal = True)), dump(db))
+
+  def test_lazy(self):
+    db = self.make()
+    lazy = fit.FlyDb(self.filename, lazy = True)
+    self.assertEqual(dump(lazy), dump(db))
+    self.edit(lazy)
+    lazy.write_db()
+    self.assertEqual(dump(fit.FlyDb(self.filename)), dump(lazy))
+
+  def test_lazy_file_changed_in_place(self):
+    db = self.make()
+    expected = dump(db)
+    lazy = fit.FlyDb(self.filename, lazy = True)
+    r5 = lazy.get_rows(id = 'r5')[0]
+    with open(self.filename) as f:
+      text = f.read()
+    # truncated in place, nothing is read through the offsets rows hold
+    with open(self.filename, 'r+') as f:
+      f.truncate(10)
+    self.assertEqual(r5['Description'], '')
+    # and written back, the rows are read again
+    with open(self.filename, 'r+') as f:
+      f.write(text)
+    self.assertTrue(lazy.sync())
+    self.assertEqual(dump(lazy), expected)
+    # edited in place, a row read before sync gets to it sees the edit
+    lazy = fit.FlyDb(self.filename, lazy = True)
+    with open(self.filename, 'r+') as f:
+      f.write(text.replace('r3', 'R3', 1))
+    os.utime(self.filename, ns = (time.time_ns(), time.time_ns() + 10 ** 9))
+    self.assertEqual(lazy.get_rows(id = 'r5')[0]['Description'], expected[5]['Description'])
+    self.assertEqual(len(lazy.get_rows(id = 'R3')), 1)
+    # edited in place, sync picks the edit up
+    db.update_row_from_dict({'Id': 'r5', 'Description': 'edited "by hand"'})
+    db.write_db()
+    lazy = fit.FlyDb(self.filename, lazy = True)
+    with open(self.filename) as f:
+      text = f.read()
+    with open(self.filename, 'r+') as f:
+      f.write(text.replace('edited \\"by hand\\"', 'changed \\"by hand\\"'))
+    os.utime(self.filename, ns = (time.time_ns(), time.time_ns() + 10 ** 9))
+    self.assertTrue(lazy.sync())
+    self.assertEqual(lazy.get_rows(id = 'r5')[0]['Description'], 'changed "by hand"')
+    self.assertEqual(dump(lazy), dump(fit.FlyDb(self.filename)))
+
+  def test_snapshot(self):
+    db = self.make(snapshot = True)
+    db.close()
+    first = fit.FlyDb(self.filename, snapshot = True)
+    first.close()
+    self.assertTrue(os.path.exists(first._snapshot_name()))
+    second = fit.FlyDb(self.filename, snapshot = True)
+    self.assertNotEqual(second.snapshot_stat, None)
+    # the rows parsing the text gives
+    self.assertEqual(dump(second), dump(fit.FlyDb(self.filename)))
+    # the file changed, the snapshot is not used
+    self.edit(second)
+    second.write_db()
+    self.assertEqual(dump(fit.FlyDb(self.filename, snapshot = True)), dump(fit.FlyDb(self.filename)))
+
+  def test_search_cache(self):
+    db = self.make(search = True, search_cache = True)
+    db.close()
+    built = fit.FlyDb(self.filename, search = True, search_cache = True)
+    built.close()
+    cached = fit.FlyDb(self.filename, search = True, search_cache = True)
+    for q in ['row', 'r*', 'new', 'quoted', 'row 1*']:
+      a, b = built.search(q), cached.search(q)
+      self.assertEqual((a[0], [r['Id'] for s, r in a[1]]), (b[0], [r['Id'] for s, r in b[1]]), q)
+
+  def test_search_word_from_buckets(self):
+    db = self.make(search = True)
+    rnd = random.Random(2)
+    for i in range(300):
+      db.add_row_from_dict({'Title': 'common ' * rnd.randint(1, 4) + rnd.choice(['commons', 'comet', 'x']),
+                            'Description': 'common ' * rnd.randint(0, 3)})
+    # built by the first search, there was no file when db was opened
+    db.search('common')
+    index = db.text_index
+    for q in ['common', 'com*', 'co*', 'comet', 'c*']:
+      for limit in [0, 1, 7, 20, 500]:
+        index.bucket_min = 10 ** 9
+        expected = index.search(q, limit = limit)
+        index.bucket_min = 10
+        self.assertEqual(index.search(q, limit = limit), expected, (q, limit))
+
+  def test_batch(self):
+    db = self.make()
+    r1 = db.get_rows(id = 'r1')[0]
+    title = r1['Title']
+    lines = ['Id,Title,Status,Description\n', 'r1,,WIP,\n', ',brand new,,from csv\n']
+    self.assertEqual(db.apply_batch(fit.read_ops(lines, 'csv')), 2)
+    # empty cells leave a field alone
+    self.assertEqual((r1['Title'], r1['Status']), (title, 'WIP'))
+    self.assertEqual(db.rows[-1]['Title'], 'brand new')
+    db.write_db()
+    expected = dump(db)
+    for ops in [[{'Title': 'ok'}, {'op': 'add', 'Id': ' '}], [{'op': 'update', 'Title': 'x'}],
+                [{'op': 'move', 'Id': 'r1', 'Before': 'nope'}], [{'op': 'add', 'Id': 5}]]:
+      with self.assertRaises(ValueError):
+        db.apply_batch(ops)
+    self.assertEqual(dump(db), expected)
+    self.assertEqual(dump(self.reopen(db)), expected)
+
+  def test_batch_field_types(self):
+    db = self.make(search = True)
+    db.search('row')
+    expected = dump(db)
+    for ops in [[{'op': 'add', 'Id': 'D', 'Title': 7}], [{'Title': 'ok'}, {'Id': 'r1', 'Status': 3}],
+                [{'Title': 'ok'}, {'Title': None}], [{'op': 'move', 'Id': 'r1', 'Before': ['r2']}]]:
+      with self.assertRaises(ValueError):
+        db.apply_batch(ops)
+    self.assertEqual(dump(db), expected)
+    self.assertEqual(db.search('ok')[0], 0)
+    db.write_db()
+    self.assertEqual(dump(self.reopen(db)), expected)
+
+  def test_export_round_trip(self):
+    db = self.make()
+    fields = db.get_columns()
+    for format in ['jsonl', 'csv']:
+      lines = ''.join(fit.export_lines(fields, db.rows, format)).splitlines(True)
+      ops = list(fit.read_ops(lines, format))
+      self.assertEqual(len(ops), db.count)
+      self.assertEqual(ops[3]['Title'], db.rows[3]['Title'])
+
+  def test_convert(self):
+    db = self.make(outver = '2')
+    self.edit(db)
+    db.write_db()
+    expected = dump(db)
+    v1 = os.path.join(self.tmp, 'v1.txt')
+    count = fit.convert_db(self.filename, v1, '1')[0]
+    self.assertEqual(count, db.count)
+    with fit.FlyDbStream(v1) as stream:
+      self.assertEqual(stream.version, '1')
+    self.assertEqual(dump(fit.FlyDb(v1)), expected)
+    fit.convert_db(v1, self.filename, '2')
+    self.assertEqual(dump(fit.FlyDb(self.filename)), expected)
+
+  def test_convert_mismatch_leaves_target(self):
+    db = self.make(outver = '2')
+    db.update_row_from_dict({'Id': 'r2', 'Title': ' padded '})
+    db.write_db()
+    target = os.path.join(self.tmp, 'v1.txt')
+    with open(target, 'w') as f:
+      f.write('untouched')
+    with self.assertRaises(ValueError):
+      fit.convert_db(self.filename, target, '1')
+    with open(target) as f:
+      self.assertEqual(f.read(), 'untouched')
+    self.assertFalse(os.path.exists(target + '.tmp'))
+
+class ServerTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.filename = os.path.join(self.tmp, 'todo.txt')
+    db = fit.FlyDb(self.filename, outver = '2')
+    for i in range(10):
+      db.add_row_from_dict({'Id': 'r{}'.format(i), 'Title': 'kanban board {}'.format(i)})
+    db.write_db()
+    self.srv = fit.FlyServer(self.filename, 0, watch_interval = 0)
+
+  def tearDown(self):
+    self.srv.close()
+    shutil.rmtree(self.tmp)
+
+  def request(self, path, body = None):
+    # through the WSGI app, without sockets. returns the status and the body
+    path, _, query = path.partition('?')
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query}
+    if body != None:
+      environ.update({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)})
+    status = []
+    data = b''.join(self.srv._serve(environ, lambda s, headers, exc_info = None: status.append(s)))
+    return status[0], data
+
+  def test_search_get_and_post(self):
+    status, data = self.request('/api/search?q=kanban+boa*&limit=3')
+    self.assertEqual(status, '200 OK')
+    self.assertEqual(json.loads(data)['total'], 10)
+    self.assertEqual(self.request('/api/search', b'q=kanban+boa*&limit=3'), (status, data))
+    self.assertEqual(self.request('/api/search', b'q=x&limit=many')[0], '400 Bad Request')
+
+@unittest.skipIf(shutil.which('git') == None, 'needs git')
+class GitTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.git('init', '-q', '-b', 'main')
+    self.git_repo = fit.Git(self.tmp, check_interval = 0)
+
+  def tearDown(self):
+    self.git_repo.close()
+    shutil.rmtree(self.tmp)
+
+  def git(self, *cmd, date = 0):
+    env = dict(os.environ, GIT_AUTHOR_NAME = 'a', GIT_AUTHOR_EMAIL = 'a@b', GIT_COMMITTER_NAME = 'a',
+               GIT_COMMITTER_EMAIL = 'a@b', GIT_AUTHOR_DATE = '{} +0000'.format(10 ** 9 + date))
+    env['GIT_COMMITTER_DATE'] = env['GIT_AUTHOR_DATE']
+    return subprocess.run(['git'] + list(cmd), cwd = self.tmp, env = env, check = True,
+                          capture_output = True).stdout.decode().strip()
+
+  def commits(self, n, dates):
+    for i in range(n):
+      self.git('commit', '-q', '--allow-empty', '-m', 'c{}'.format(i), date = dates(i))
+
+  def test_log_across_merge(self):
+    # a branch dated in between the commits of main, merged after part of the log was read
+    self.commits(1, lambda i: 0)
+    self.git('branch', 'side')
+    self.commits(150, lambda i: 2 * i + 2)
+    g = self.git_repo
+    g._update()
+    g._fetch(100)
+    self.assertEqual(len(g.commits), 100)
+    self.git('checkout', '-q', 'side')
+    self.commits(50, lambda i: 2 * i + 1)
+    self.git('checkout', '-q', 'main')
+    self.git('merge', '-q', '--no-ff', '-m', 'merge', 'side', date = 1000)
+    g._update()
+    g._fetch(10 ** 6)
+    hashes = [c.hash for c in g.commits]
+    self.assertEqual(len(hashes), len(set(hashes)))
+    self.assertEqual(sorted(hashes), sorted(self.git('rev-list', 'HEAD').split()))
+
+  def test_readers_dont_wait(self):
+    self.commits(250, lambda i: i)
+    g = self.git_repo
+    g.refresh(10)
+    first = self.git('rev-list', '--max-parents=0', 'HEAD')
+    # the worker is busy, what is read is there and the rest doesn't hold anyone up
+    g.executor.submit(time.sleep, 1)
+    start = time.monotonic()
+    self.assertEqual(len(list(itertools.islice(g.iter_commits(), 100))), 100)
+    self.assertRaises(concurrent.futures.TimeoutError, lambda: list(g.iter_commits()))
+    self.assertRaises(concurrent.futures.TimeoutError, g.commit, first)
+    self.assertLess(time.monotonic() - start, 0.5)
+    # asked again like the page does, the worker has read on meanwhile
+    for attempt in range(10):
+      g.refresh(10)
+      try:
+        commits = list(g.iter_commits())
+        break
+      except concurrent.futures.TimeoutError:
+        pass
+    self.assertEqual(len(commits), 250)
+    self.assertEqual(g.commit(first[:8]).message.strip(), 'c0')
+
+class MarkdownTest(unittest.TestCase):
+  docs = ['# Title\n\nsome text\n\nmore text',
+          '* one\n* two\n\n* three\n\n    indented under three',
+          '```\ncode\n\nwith blank\n```\n\nafter',
+          '> a\n\n> b',
+          '> quote\n\ntext\n\n> another',
+          '1. first\n\n2. second\n\n   continued',
+          '<div>\n\nhtml block\n\n</div>\n\ntext',
+          'see [this][ref]\n\n[ref]: http://example.com',
+          'para\n\n    code block\n\n    more code']
+
+  def test_blocks_render_like_whole(self):
+    blocks = fit.MarkdownCache()
+    whole = fit.MarkdownCache()
+    for doc in self.docs:
+      self.assertEqual(blocks.render_blocks(doc), whole.render(doc), doc)
+      # and again from the cache
+      self.assertEqual(blocks.render_blocks(doc), whole.render(doc), doc)
+
+  def test_blocks_join_back(self):
+    for doc in self.docs:
+      self.assertEqual('\n\n'.join(fit.markdown_blocks(doc)), doc)
+
+if __name__ == '__main__':
+  unittest.main()